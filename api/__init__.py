@@ -1,6 +1,5 @@
-import os, json, re
-from flask import Flask, current_app, g
-from sqlalchemy import create_engine
+import os, json, re, time, logging
+from flask import Flask, current_app, g, request
 from datetime import timedelta
 
 # Blueprint imports 
@@ -9,6 +8,9 @@ from .main import homepage
 from .data import data_api
 from .imgserver import imgserver
 from .download import download
+from .internal import internal
+from .db import get_engine
+from .utils import FastJSONProvider, request_duration
 
 
 
@@ -28,7 +30,13 @@ from .download import download
 
 
 
+# The data routes log their intermediate dataframes at DEBUG level - set LOG_LEVEL=DEBUG to see them
+logging.basicConfig(level = os.environ.get('LOG_LEVEL', 'INFO').upper())
+
 app = Flask(__name__, static_url_path='/static')
+
+# numpy / pandas aware JSON responses, written with orjson when it is installed - see api/utils/fastjson.py
+app.json = FastJSONProvider(app)
 app.debug = True # remove for production
 
 # does your application require uploaded filenames to be modified to timestamps or left as is
@@ -42,18 +50,32 @@ app.secret_key = os.environ.get("FLASK_APP_SECRET_KEY")
 
 
 # set the database connection string, database, and type of database we are going to point our application at
-#app.eng = create_engine(os.environ.get("DB_CONNECTION_STRING"))
+# The engine (and its connection pool) is shared by every request in a worker process
+# Pool size, overflow, recycle and pre ping settings are read from environment variables - see api/db.py
 def connect_db():
-    return create_engine(os.environ.get("DB_CONNECTION_STRING"))
+    return get_engine()
 
 @app.before_request
 def before_request():
     g.eng = connect_db()
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def after_request(response):
+    # request duration histogram for /metrics
+    # (for a streamed response this is the time until the response starts, not until the last byte goes out)
+    if 'request_start' in g:
+        request_duration.observe(
+            time.perf_counter() - g.request_start,
+            route = request.endpoint or 'none', method = request.method, status = response.status_code
+        )
+    return response
 
 @app.teardown_request
 def teardown_request(exception):
-    if hasattr(g, 'eng'):
-        g.eng.dispose()
+    # Connections are returned to the pool as soon as pandas is done with them
+    # the engine is not disposed here, otherwise every request would pay for a brand new connection
+    g.pop('eng', None)
 
 
 
@@ -61,4 +83,5 @@ def teardown_request(exception):
 app.register_blueprint(homepage)
 app.register_blueprint(data_api)
 app.register_blueprint(imgserver)
-app.register_blueprint(download)
\ No newline at end of file
+app.register_blueprint(download)
+app.register_blueprint(internal)
\ No newline at end of file
@@ -1,12 +1,19 @@
-import traceback
+import logging
+import numpy as np
 import pandas as pd
-from flask import Blueprint, request, render_template, jsonify, g
+from flask import Blueprint, request, render_template, jsonify, g, Response
 
-from .utils import get_raw_wq_data, wq_index, calc_ahp_weights, calc_ranksum_weights, fix_thresh_units, mashup_index
+from .utils import get_raw_wq_data, set_threshold_values, wq_index, calc_ahp_weights, calc_ranksum_weights, fix_thresh_units, mashup_index, rawdata_catalog, \
+    rank_sensitivity, emc_index, USE_EMC_INDEX, result_cache, raw_snapshot, USE_SNAPSHOT, timed, \
+    sitenames_query, bmpnames_query, bmptypes_query, analytes_query, threshval_query, percentile_rank_query, \
+    threshvals_batch_query, percentile_ranks_batch_query, thresh_percentiles_query
 
 data_api = Blueprint('data_api', __name__, template_folder = 'templates')
 
-# for printing
+# The intermediate dataframes are logged at DEBUG level - the logging call only formats them if DEBUG is actually on
+logger = logging.getLogger(__name__)
+
+# for printing (the debug logs)
 pd.set_option('display.max_columns', 15)
 
 @data_api.route('/sitenames', methods = ['GET'])
@@ -26,11 +33,10 @@ def sitenames():
         return jsonify(resp), 400
     
     
-    # SQL injection is prevented with the above early return
-    tablename = f"analysis_{analysistype}"
+    qry, params = sitenames_query(analysistype)
     
     # I think it needs to be a list because i have a feeling it complains about serializing the numpy arrays (.values)
-    sitenames = pd.read_sql(f"SELECT DISTINCT sitename FROM {tablename} ORDER BY 1", eng).sitename.tolist()
+    sitenames = pd.read_sql(qry, eng, params = params).sitename.tolist()
     
     return jsonify(sitenames=sitenames)
 
@@ -59,10 +65,8 @@ def bmpnames():
         }
         return jsonify(resp), 400
     
-    # SQL injection is prevented with the above early return
-    tablename = f"analysis_{analysistype}"
-    
-    valid_sitenames = pd.read_sql(f"SELECT DISTINCT sitename FROM {tablename} ORDER BY 1", eng).sitename.values
+    qry, params = sitenames_query(analysistype)
+    valid_sitenames = pd.read_sql(qry, eng, params = params).sitename.values
     
     # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
     if sitename not in valid_sitenames:
@@ -97,14 +101,9 @@ def bmpnames():
         return jsonify(resp), 400
     
     # Now we are ready to construct the query
-    qry = "SELECT DISTINCT {}bmp AS bmpname FROM {} {} ORDER BY 1".format(
-        bmpplacement,
-        tablename,
-        f"WHERE sitename = '{sitename}'" if sitename is not None else '',
-        f"AND firstbmp = '{firstbmp}'" if firstbmp is not None else '',
-    )
+    qry, params = bmpnames_query(analysistype, bmpplacement, sitename = sitename)
     
-    bmpnames = pd.read_sql(qry, eng).bmpname.tolist()
+    bmpnames = pd.read_sql(qry, eng, params = params).bmpname.tolist()
     
     # return repsonse
     return jsonify(bmpnames=bmpnames)
@@ -120,8 +119,8 @@ def bmpnames():
 def bmptypes():
     eng = g.eng
 
-    qry = "SELECT bmpcode, bmpcategory FROM lu_bmptype ORDER BY bmpcode"
-    bmptypes = pd.read_sql(qry, eng).to_dict('records')
+    qry, params = bmptypes_query()
+    bmptypes = pd.read_sql(qry, eng, params = params).to_dict('records')
     
     # return repsonse
     return jsonify(bmptypes=bmptypes)
@@ -159,7 +158,8 @@ def analytes():
         
         
         # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
-        valid_sitenames = pd.read_sql(f"SELECT DISTINCT sitename FROM vw_mashup_index_comparison_rawdata ORDER BY 1", eng).sitename.values
+        # (the distinct values are held in memory by the catalog, so this does not hit the database)
+        valid_sitenames = rawdata_catalog.values(eng, 'sitename')
         
         if sitename not in valid_sitenames:
             resp = {
@@ -171,7 +171,7 @@ def analytes():
             
         
         # Now we are ready to construct the query
-        qry = f"SELECT DISTINCT analyte AS analytename, inflow_emc_unit AS unit FROM vw_mashup_index_comparison_rawdata WHERE sitename = '{sitename}' AND firstbmp = '{firstbmp}' AND lastbmp = '{lastbmp}' ORDER BY 1"
+        qry, params = analytes_query(sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp)
     
     else:
         
@@ -184,7 +184,7 @@ def analytes():
         
         # future proofing in case they want to look at it by BMP type
         # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
-        valid_bmptypes = pd.read_sql(f"SELECT DISTINCT firstbmptype FROM vw_mashup_index_comparison_rawdata ORDER BY 1", eng).firstbmptype.values
+        valid_bmptypes = rawdata_catalog.values(eng, 'bmptype')
         if bmptype not in valid_bmptypes:
             resp = {
                 "error": "Invalid bmptype",
@@ -194,13 +194,16 @@ def analytes():
         
         # Now we are ready to construct the query
         # Just go off firstbmptype
-        qry = f"SELECT DISTINCT analyte AS analytename, inflow_emc_unit AS unit FROM vw_mashup_index_comparison_rawdata WHERE firstbmptype = '{bmptype}' ORDER BY 1"
+        qry, params = analytes_query(bmptype = bmptype)
         
         
     
-    analytes = pd.read_sql(qry, eng).to_dict('records')
-    print("analytes")
-    print(analytes)
+    if USE_SNAPSHOT:
+        # the distinct analytes and units of the rows in the in memory snapshot - the query above does not get run
+        analytes = raw_snapshot.analytes(eng, sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp, bmptype = bmptype)
+    else:
+        analytes = pd.read_sql(qry, eng, params = params).to_dict('records')
+    logger.debug("analytes\n%s", analytes)
     
     # return repsonse
     return jsonify(analytes=analytes)
@@ -208,6 +211,32 @@ def analytes():
 
 
 
+##########################################################################################################################################################
+##########################################################################################################################################################
+##########################################################################################################################################################
+
+
+# Everything /sitenames, /bmpnames, /bmptypes and /analytes give back, in one response
+# sites -> firstbmp -> lastbmp -> analytes (with units), plus the bmptypes and their analytes (see Catalog.tree for the layout)
+# so the UI can fill in all of its dropdowns from one request, and send If-None-Match to check if it is still current
+@data_api.route('/catalog', methods = ['GET'])
+def catalog():
+    eng = g.eng
+    
+    tree, etag = rawdata_catalog.tree(eng)
+    
+    if etag in request.if_none_match:
+        resp = Response(status = 304)
+        resp.set_etag(etag)
+        return resp
+    
+    resp = jsonify(tree)
+    resp.set_etag(etag)
+    return resp
+
+
+
+
 ##########################################################################################################################################################
 ##########################################################################################################################################################
 ##########################################################################################################################################################
@@ -227,12 +256,10 @@ def threshvals():
     analyte = request.args.get('analyte')
     inflow_or_outflow = request.args.get('inflow_or_outflow', 'inflow')
     
-    print(f"sitename: {sitename}")
-    print(f"firstbmp: {firstbmp}")
-    print(f"percentile: {percentile}")
-    print(f"bmptype: {bmptype}")
-    print(f"inflow_or_outflow: {inflow_or_outflow}")
-    print(f"analyte: {analyte}")
+    logger.debug(
+        "sitename: %s, firstbmp: %s, percentile: %s, bmptype: %s, inflow_or_outflow: %s, analyte: %s",
+        sitename, firstbmp, percentile, bmptype, inflow_or_outflow, analyte
+    )
     
     if inflow_or_outflow not in ('inflow','outflow'):
         return jsonify({"error": "Invalid query string arg", "message": "inflow_or_outflow arg must be 'inflow' or 'outflow'"}), 400
@@ -240,6 +267,8 @@ def threshvals():
     if percentile is not None:
         if not all([x.isdigit() for x in str(percentile).split('.')]):
             return jsonify({"error": "Invalid query string arg", "message": "Percentile query string arg is not a valid number"}), 400
+        if not (0 <= float(percentile) <= 1):
+            return jsonify({"error": "Invalid query string arg", "message": "Percentile query string arg must be between 0 and 1"}), 400
     else:
         return jsonify({"error": "Missing required query string arg", "message": "percentile query string arg is required"}), 400
     
@@ -261,7 +290,8 @@ def threshvals():
         
         
         # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
-        valid_sitenames = pd.read_sql(f"SELECT DISTINCT sitename FROM vw_mashup_index_comparison_rawdata ORDER BY 1", eng).sitename.values
+        # (the distinct values are held in memory by the catalog, so this does not hit the database)
+        valid_sitenames = rawdata_catalog.values(eng, 'sitename')
         
         if sitename not in valid_sitenames:
             resp = {
@@ -272,8 +302,8 @@ def threshvals():
         
             
         
-        # Now we are ready to construct the query
-        analyteqry = f"SELECT DISTINCT analyte FROM vw_mashup_index_comparison_rawdata WHERE sitename = '{sitename}' AND firstbmp = '{firstbmp}' AND lastbmp = '{lastbmp}' ORDER BY 1"
+        # analytes that were sampled at this site/bmp combination
+        valid_analytes = rawdata_catalog.analytes_for(eng, sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp)
     
     else:
         
@@ -286,7 +316,7 @@ def threshvals():
         
         # future proofing in case they want to look at it by BMP type
         # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
-        valid_bmptypes = pd.read_sql(f"SELECT DISTINCT firstbmptype FROM vw_mashup_index_comparison_rawdata ORDER BY 1", eng).firstbmptype.values
+        valid_bmptypes = rawdata_catalog.values(eng, 'bmptype')
         if bmptype not in valid_bmptypes:
             resp = {
                 "error": "Invalid bmptype",
@@ -294,36 +324,28 @@ def threshvals():
             }
             return jsonify(resp), 400
         
-        # Now we are ready to construct the query
+        # analytes that were sampled at this bmptype
         # Just go off firstbmptype
-        analyteqry = f"SELECT DISTINCT analyte FROM vw_mashup_index_comparison_rawdata WHERE firstbmptype = '{bmptype}' ORDER BY 1"
+        valid_analytes = rawdata_catalog.analytes_for(eng, bmptype = bmptype)
         
-    if analyte not in pd.read_sql(analyteqry, eng).analyte.values:
+    if analyte not in valid_analytes:
         return jsonify({"error": "Invalid query string arg", "message": f"Invalid analyte {analyte}"}), 400
     
-    mainqry = f"""
-        SELECT 
-            PERCENTILE_CONT({percentile}) WITHIN GROUP (ORDER BY {inflow_or_outflow}_emc) AS threshval
-        FROM 
-            vw_mashup_index_comparison_rawdata
-        WHERE 
-            analyte = '{analyte}' 
-    """
-        
+    # Answer from the in memory index of sorted EMCs when it is turned on (it is by default) - same result as the query below
+    if USE_EMC_INDEX:
+        scope = ('site', sitename, firstbmp) if bmptype is None else ('bmptype', bmptype)
+        threshval = emc_index.percentile(eng, scope, analyte, inflow_or_outflow, float(percentile))
+        return jsonify(threshval=threshval)
+    
     if bmptype is None:
-        mainqry += f"""
-            AND sitename = '{sitename}'
-            AND firstbmp = '{firstbmp}'
-        """
+        qry, params = threshval_query(analyte, percentile, inflow_or_outflow, sitename = sitename, firstbmp = firstbmp)
     else:
-        mainqry += f"""
-            AND firstbmptype = '{bmptype}'
-        """
+        qry, params = threshval_query(analyte, percentile, inflow_or_outflow, bmptype = bmptype)
     
-    threshvallist = pd.read_sql(mainqry, eng).threshval.tolist()
+    threshvallist = pd.read_sql(qry, eng, params = params).threshval.tolist()
     threshval = threshvallist[0] if len(threshvallist) > 0 else -88
     
-    print(f"threshvallist: {threshvallist}")
+    logger.debug("threshvallist: %s", threshvallist)
     
     # return repsonse
     return jsonify(threshval=threshval)
@@ -382,7 +404,8 @@ def percentilevals():
         
         
         # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
-        valid_sitenames = pd.read_sql(f"SELECT DISTINCT sitename FROM vw_mashup_index_comparison_rawdata ORDER BY 1", eng).sitename.values
+        # (the distinct values are held in memory by the catalog, so this does not hit the database)
+        valid_sitenames = rawdata_catalog.values(eng, 'sitename')
         
         if sitename not in valid_sitenames:
             resp = {
@@ -393,8 +416,8 @@ def percentilevals():
         
             
         
-        # Now we are ready to construct the query
-        analyteqry = f"SELECT DISTINCT analyte FROM vw_mashup_index_comparison_rawdata WHERE sitename = '{sitename}' AND firstbmp = '{firstbmp}' AND lastbmp = '{lastbmp}' ORDER BY 1"
+        # analytes that were sampled at this site/bmp combination
+        valid_analytes = rawdata_catalog.analytes_for(eng, sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp)
     
     else:
         
@@ -407,7 +430,7 @@ def percentilevals():
         
         # future proofing in case they want to look at it by BMP type
         # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
-        valid_bmptypes = pd.read_sql(f"SELECT DISTINCT firstbmptype FROM vw_mashup_index_comparison_rawdata ORDER BY 1", eng).firstbmptype.values
+        valid_bmptypes = rawdata_catalog.values(eng, 'bmptype')
         if bmptype not in valid_bmptypes:
             resp = {
                 "error": "Invalid bmptype",
@@ -415,36 +438,27 @@ def percentilevals():
             }
             return jsonify(resp), 400
         
-        # Now we are ready to construct the query
+        # analytes that were sampled at this bmptype
         # Just go off firstbmptype
-        analyteqry = f"SELECT DISTINCT analyte FROM vw_mashup_index_comparison_rawdata WHERE firstbmptype = '{bmptype}' ORDER BY 1"
+        valid_analytes = rawdata_catalog.analytes_for(eng, bmptype = bmptype)
         
-    if analyte not in pd.read_sql(analyteqry, eng).analyte.values:
+    if analyte not in valid_analytes:
         return jsonify({"error": "Invalid query string arg", "message": "Invalid analyte"}), 400
     
     
-    mainqry = f"""
-        WITH RankedValues AS (
-            SELECT
-                inflow_emc,
-                CUME_DIST() OVER (ORDER BY inflow_emc) AS cumulative_distribution
-            FROM vw_mashup_index_comparison_rawdata
-            WHERE analyte = '{analyte}' 
-            {
-                "AND sitename = '{}' AND firstbmp = '{}'".format(sitename, firstbmp) if bmptype is None else "AND firstbmptype = '{}'".format(bmptype)
-            }
-        ),
-        PercentileRank AS (
-            SELECT
-                MAX(cumulative_distribution) AS percentile_rank
-            FROM RankedValues
-            WHERE inflow_emc <= {threshval}
-        )
-        SELECT percentile_rank
-        FROM PercentileRank
-    """
+    # Answer from the in memory index of sorted EMCs when it is turned on (it is by default) - same result as the query below
+    # (which ranks against inflow_emc, whatever inflow_or_outflow says)
+    if USE_EMC_INDEX:
+        scope = ('site', sitename, firstbmp) if bmptype is None else ('bmptype', bmptype)
+        percentile_rank = emc_index.percentile_rank(eng, scope, analyte, 'inflow', float(threshval))
+        return jsonify(percentile_rank=percentile_rank)
+    
+    if bmptype is None:
+        qry, params = percentile_rank_query(analyte, threshval, sitename = sitename, firstbmp = firstbmp)
+    else:
+        qry, params = percentile_rank_query(analyte, threshval, bmptype = bmptype)
 
-    percentile_val_list = pd.read_sql(mainqry, eng).percentile_rank.tolist()
+    percentile_val_list = pd.read_sql(qry, eng, params = params).percentile_rank.tolist()
     percentile_rank = percentile_val_list[0] if len(percentile_val_list) > 0 else -88
     
     # return repsonse
@@ -452,13 +466,173 @@ def percentilevals():
 
 
 
+#-----------------------------------------------------------------------------------------------------------------------------------------------
+################################################################################################################################################
+################################################################################################################################################
+################################################################################################################################################
+#-----------------------------------------------------------------------------------------------------------------------------------------------
+
+
+# Batch versions of /threshval and /percentileval
+# The analyte table needs a value for every analyte row - these answer all of them with one grouped query instead of one request (and one query) per row
+#
+# Both take a json body like
+# {
+#     "sitename"          : <sitename>,
+#     "firstbmp"          : <firstbmp> (or bmpname),
+#     "bmptype"           : <bmptype> (instead of sitename/firstbmp),
+#     "inflow_or_outflow" : "inflow" or "outflow" (default inflow),
+#     "analytes"          : [ { "analytename": <analyte>, "percentile": <0 to 1> }, ... ]    for /threshval-batch
+#                           [ { "analytename": <analyte>, "threshval": <number> }, ... ]     for /percentileval-batch
+# }
+# and return a map of analyte name to value (null for an analyte with no data)
+
+
+def _validate_batch_lookup(eng, params, valuekey):
+    # Shared input checks for the two batch routes
+    # returns (error response or None, the site/bmp or bmptype filter for the query builders, list of (analyte, value) pairs, inflow or outflow, the EMC index scope)
+    sitename = params.get('sitename')
+    firstbmp = params.get('firstbmp', params.get('bmpname'))
+    lastbmp = params.get('lastbmp', firstbmp)
+    bmptype = params.get('bmptype')
+    inflow_or_outflow = params.get('inflow_or_outflow', 'inflow')
+    analytes = params.get('analytes')
+    
+    def error(resp):
+        return (jsonify(resp), 400), None, None, None, None
+    
+    if inflow_or_outflow not in ('inflow','outflow'):
+        return error({"error": "Invalid parameter value", "message": "inflow_or_outflow must be 'inflow' or 'outflow'"})
+    
+    if not isinstance(analytes, list) or (len(analytes) == 0) or not all([isinstance(a, dict) for a in analytes]):
+        return error({"error": "Invalid parameter value", "message": "analytes param should be a non empty list of dictionaries"})
+    
+    if not all([set(['analytename', valuekey]).issubset(set(a.keys())) for a in analytes]):
+        return error({"error": "Invalid parameter values", "message": f"all dictionaries in the analytes list must have attributes analytename and {valuekey}"})
+    
+    analytenames = [a.get('analytename') for a in analytes]
+    if len(set(analytenames)) != len(analytenames):
+        return error({"error": "Invalid parameter values", "message": "Each analyte can only be in the analytes list once"})
+    
+    try:
+        values = [float(a.get(valuekey)) for a in analytes]
+    except (TypeError, ValueError):
+        return error({"error": "Invalid parameter values", "message": f"{valuekey} values must be numeric"})
+    
+    if (valuekey == 'percentile') and not all([0 <= v <= 1 for v in values]):
+        return error({"error": "Invalid parameter values", "message": "percentile values must be between 0 and 1"})
+    
+    if bmptype is None:
+        if (sitename is None) or (firstbmp is None):
+            return error({"error": "Missing required data", "message": "sitename and firstbmp (or a bmptype) must be provided"})
+        
+        # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
+        if sitename not in rawdata_catalog.values(eng, 'sitename'):
+            return error({"error": "Invalid sitename", "message": "sitename provided not found in the list of valid sitenames"})
+        
+        valid_analytes = rawdata_catalog.analytes_for(eng, sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp)
+        
+        # same filter as /threshval and /percentileval
+        filters = {"sitename": sitename, "firstbmp": firstbmp}
+        scope = ('site', sitename, firstbmp)
+    else:
+        if any([ x is not None for x in [sitename, firstbmp, lastbmp] ]):
+            return error({"error": "Invalid request", "message": "Either specify a BMP Type, or a sitename/bmp combination - not both"})
+        
+        if bmptype not in rawdata_catalog.values(eng, 'bmptype'):
+            return error({"error": "Invalid bmptype", "message": "bmptype provided not found in the list of bmp types in the water quality analysis table"})
+        
+        valid_analytes = rawdata_catalog.analytes_for(eng, bmptype = bmptype)
+        
+        filters = {"bmptype": bmptype}
+        scope = ('bmptype', bmptype)
+    
+    invalid = [a for a in analytenames if a not in valid_analytes]
+    if len(invalid) > 0:
+        return error({"error": "Invalid parameter values", "message": f"Invalid analyte(s) {', '.join(map(str, invalid))}"})
+    
+    return None, filters, list(zip(analytenames, values)), inflow_or_outflow, scope
+
+
+# Only applies to Water Quality
+@data_api.route('/threshval-batch', methods = ['POST'])
+def threshvals_batch():
+    eng = g.eng
+    
+    errorresp, filters, pairs, inflow_or_outflow, scope = _validate_batch_lookup(eng, request.json, 'percentile')
+    if errorresp is not None:
+        return errorresp
+    
+    if USE_EMC_INDEX:
+        return jsonify(threshvals = {
+            analyte: emc_index.percentile(eng, scope, analyte, inflow_or_outflow, percentile) for analyte, percentile in pairs
+        })
+    
+    # One PERCENTILE_CONT column per requested (analyte, percentile) pair, all in one grouped query
+    qry, params = threshvals_batch_query(eng, pairs, inflow_or_outflow, **filters)
+    resultdf = pd.read_sql(qry, eng, params = params).set_index('analyte')
+    
+    threshvals = {
+        analyte: (
+            float(resultdf.at[analyte, f"threshval_{i}"])
+            if (analyte in resultdf.index) and pd.notnull(resultdf.at[analyte, f"threshval_{i}"])
+            else None
+        )
+        for i, (analyte, percentile) in enumerate(pairs)
+    }
+    
+    return jsonify(threshvals = threshvals)
+
+
+# Only applies to Water Quality
+@data_api.route('/percentileval-batch', methods = ['POST'])
+def percentilevals_batch():
+    eng = g.eng
+    
+    errorresp, filters, pairs, inflow_or_outflow, scope = _validate_batch_lookup(eng, request.json, 'threshval')
+    if errorresp is not None:
+        return errorresp
+    
+    if USE_EMC_INDEX:
+        return jsonify(percentile_ranks = {
+            analyte: emc_index.percentile_rank(eng, scope, analyte, inflow_or_outflow, threshval) for analyte, threshval in pairs
+        })
+    
+    # The percentile rank /percentileval gets from CUME_DIST is the share of the analyte's rows at or below the threshold value
+    # so instead of a window over every row, it is a filtered count divided by the total count
+    qry, params = percentile_ranks_batch_query(eng, pairs, inflow_or_outflow, **filters)
+    resultdf = pd.read_sql(qry, eng, params = params).set_index('analyte')
+    
+    # Same as CUME_DIST - no rows at or below the threshold value means no percentile rank
+    percentile_ranks = {
+        analyte: (
+            float(resultdf.at[analyte, f"n_below_{i}"] / resultdf.at[analyte, 'n_total'])
+            if (analyte in resultdf.index) and (resultdf.at[analyte, f"n_below_{i}"] > 0)
+            else None
+        )
+        for i, (analyte, threshval) in enumerate(pairs)
+    }
+    
+    return jsonify(percentile_ranks = percentile_ranks)
+
+
+
 #############################################################################################################################################################    
 #############################################################################################################################################################    
 #############################################################################################################################################################    
+
+
+def _ahp_weights_by_row(wqindexdf):
+    # AHP weight of each row of wqindexdf (it needs the rank column)
+    # calc_ahp_weights hands the weights back sorted from largest to smallest - which is the order of the ranks -
+    # so they are worked out on the rows sorted by rank, then lined back up with the rows they belong to
+    ranked = wqindexdf.sort_values(['rank'], kind = 'stable')
+    return pd.Series(calc_ahp_weights(ranked.analyte.values, ranked['rank'].values), index = ranked.index).reindex(wqindexdf.index)
     
     
 # Actually get the data (This route is for water quality - if they request for hydrology we can build that later - too much time to put in to build that right now)
 @data_api.route('/direct-comparison-data', methods = ['GET', 'POST'])
+@result_cache.cached
 def directcomparison():
     eng = g.eng
     
@@ -531,7 +705,9 @@ def directcomparison():
         
         
         # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
-        valid_sitenames = pd.read_sql(f"SELECT DISTINCT sitename FROM vw_mashup_index_comparison_rawdata ORDER BY 1", eng).sitename.values
+        # (the distinct values are held in memory by the catalog, so this does not hit the database)
+        with timed('validation'):
+            valid_sitenames = rawdata_catalog.values(eng, 'sitename')
         
         if sitename not in valid_sitenames:
             resp = {
@@ -551,7 +727,8 @@ def directcomparison():
         
         # future proofing in case they want to look at it by BMP type
         # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
-        valid_bmptypes = pd.read_sql(f"SELECT DISTINCT firstbmptype FROM vw_mashup_index_comparison_rawdata ORDER BY 1", eng).firstbmptype.values
+        with timed('validation'):
+            valid_bmptypes = rawdata_catalog.values(eng, 'bmptype')
         if bmptype not in valid_bmptypes:
             resp = {
                 "error": "Invalid bmptype",
@@ -567,26 +744,26 @@ def directcomparison():
             "unit"  : a.get('unit')
         }
     
-    print('threshold_values')
-    print(threshold_values)
+    logger.debug("threshold_values\n%s", threshold_values)
     
     # anyways, if both are given it goes with threshold values
     # if neither are given it grabs all analytes
     # if analytes is not provided, it is none and its no big deal
-    wqdata = get_raw_wq_data(conn=eng,sitename=sitename,firstbmp=firstbmp,lastbmp=lastbmp,bmptype=bmptype,threshold_values=threshold_values)
+    with timed('get_raw_wq_data'):
+        wqdata = get_raw_wq_data(conn=eng,sitename=sitename,firstbmp=firstbmp,lastbmp=lastbmp,bmptype=bmptype,threshold_values=threshold_values)
     
-    print('wqdata')
-    print(wqdata)
+    logger.debug("wqdata\n%s", wqdata)
     
-    wqdata = fix_thresh_units(wqdata)
+    with timed('fix_thresh_units'):
+        wqdata = fix_thresh_units(wqdata)
     
-    print('wqdata after fix thresh units')
-    print(wqdata)
+    logger.debug("wqdata after fix thresh units\n%s", wqdata)
     
-    wqindexdf = wq_index(wqdata, grouping_columns = ['sitename', 'firstbmp', 'lastbmp'])
+    # the bmptype query only has the bmptype column to group on, not the site and bmps
+    with timed('wq_index'):
+        wqindexdf = wq_index(wqdata, grouping_columns = ['sitename', 'firstbmp', 'lastbmp'] if bmptype is None else ['bmptype'])
     
-    print('wqindexdf')
-    print(wqindexdf)
+    logger.debug("wqindexdf\n%s", wqindexdf)
     
     # build rankings dictionary in a convenient way to tack on to the index df
     rankings_dict = dict()
@@ -596,15 +773,18 @@ def directcomparison():
     wqindexdf['rank'] = wqindexdf.analyte.apply(lambda a: rankings_dict.get(a))
     
     # AHP needs the constituents and the rankings for each (numpy arrays)
-    wqindexdf['ahp_weights'] = calc_ahp_weights(wqindexdf.sort_values(['rank']).analyte.values, wqindexdf.sort_values(['rank'])['rank'].values)
+    with timed('calc_ahp_weights'):
+        wqindexdf['ahp_weights'] = _ahp_weights_by_row(wqindexdf)
 
     # Ranksum just needs the rankings (numpy array)
-    wqindexdf['ranksum_weights'] = calc_ranksum_weights(wqindexdf['rank'].values)
+    with timed('calc_ranksum_weights'):
+        wqindexdf['ranksum_weights'] = calc_ranksum_weights(wqindexdf['rank'].values)
     
     ahpmash = mashup_index(wqindexdf.performance_index.values, wqindexdf.ahp_weights.values)
     rankmash = mashup_index(wqindexdf.performance_index.values, wqindexdf.ranksum_weights.values)
     
     
+    # each value goes through python's round() - DataFrame.round (numpy) rounds the binary value and can land the other way on a tie (2.675 -> 2.68, not 2.67)
     wqindexdf['performance_index'] = wqindexdf['performance_index'].apply(lambda x: round(x, 2))
     wqindexdf['ahp_weights'] = wqindexdf.ahp_weights.apply(lambda w: round(w, 4))
     wqindexdf['ranksum_weights'] = wqindexdf.ranksum_weights.apply(lambda w: round(w, 4))
@@ -621,8 +801,7 @@ def directcomparison():
         ) \
         .to_dict('records')
     
-    print('wqindexdf')
-    print(wqindexdf)
+    logger.debug("wqindexdf\n%s", wqindexdf)
     
     resp = {
         "sitename"             : sitename,
@@ -638,6 +817,163 @@ def directcomparison():
         "ranksum_mashup_score" : round(rankmash, 2)
     }
     
+    # return repsonse
+    with timed('serialization'):
+        return jsonify(resp)
+    
+
+
+    
+#############################################################################################################################################################    
+#############################################################################################################################################################    
+#############################################################################################################################################################    
+
+
+# How much the AHP and Rank Sum mashup scores diverge over every possible ranking of the selected analytes (not just the one the user typed in)
+# The individual analyte scores do not depend on the ranking, so wq_index only runs once - the rankings are scored in batches after that
+@data_api.route('/rank-sensitivity-data', methods = ['GET', 'POST'])
+def ranksensitivity():
+    eng = g.eng
+    
+    params = request.json
+    
+    sitename = params.get('sitename')
+    firstbmp = params.get('firstbmp', params.get('bmpname'))
+    lastbmp = params.get('lastbmp', firstbmp) # default to setting it the same as firstbmp
+    
+    # analytes should be a list - same as for direct-comparison-data, except the rank is optional
+    # [
+    #     {
+    #         "analytename"     : <actual name of the analyte>,
+    #         "threshold_value" : <actual threshold value>,
+    #         "unit" : <units of threshold value>,
+    #         "rank"         : <user-defined analyte priority rank (optional)>
+    #     },
+    #     ....
+    # ]
+    
+    analytes = params.get('analytes')
+    
+    if not isinstance(analytes, list):
+        resp = {
+            "error": "Invalid parameter value",
+            "message": "analytes param should be a list"
+        }
+        return jsonify(resp), 400
+    
+    if len(analytes) < 2:
+        resp = {
+            "error": "Invalid parameter value",
+            "message": "Analytes param only has one value - a mashup index score requires two"
+        }
+        return jsonify(resp), 400
+        
+    
+    if not all([isinstance(a, dict) for a in analytes]):
+        resp = {
+            "error": "Invalid parameter value",
+            "message": "analytes param should be a list of dictionaries"
+        }
+        return jsonify(resp), 400
+    
+    if not all([set(['analytename','threshold_value','unit']).issubset(set(a.keys())) for a in analytes]):
+        resp = {
+            "error": "Invalid parameter values",
+            "message": "all dictionaries in the analytes list must have attributes analytename, threshold_value and unit"
+        }
+        return jsonify(resp), 400
+    
+    
+    bmptype = params.get('bmptype')
+    
+    if bmptype is None:
+        # Sitename and firstbmp are required
+        if sitename is None:
+            resp = {
+                "error": "Missing required data",
+                "message": "sitename name must be provided via query string arg sitename"
+            }
+            return jsonify(resp), 400
+        
+        if firstbmp is None:
+            resp = {
+                "error": "Missing required data",
+                "message": "firstbmp name must be provided via query string arg firstbmp"
+            }
+            return jsonify(resp), 400
+        
+        
+        # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
+        # (the distinct values are held in memory by the catalog, so this does not hit the database)
+        valid_sitenames = rawdata_catalog.values(eng, 'sitename')
+        
+        if sitename not in valid_sitenames:
+            resp = {
+                "error": "Invalid sitename",
+                "message": "sitename provided not found in the list of valid sitenames"
+            }
+            return jsonify(resp), 400
+        
+    
+    else:
+        if any([ x is not None for x in [sitename, firstbmp, lastbmp] ]):
+            resp = {
+                "error": "Invalid request",
+                "message": "Either specify a BMP Type, or a sitename/bmp combination - not both"
+            }
+            return jsonify(resp), 400
+        
+        valid_bmptypes = rawdata_catalog.values(eng, 'bmptype')
+        if bmptype not in valid_bmptypes:
+            resp = {
+                "error": "Invalid bmptype",
+                "message": "bmptype provided not found in the list of bmp types in the water quality analysis table"
+            }
+            return jsonify(resp), 400
+    
+    # build threshold_values according to how the function specifies - a dictionary whose keys are the analyte names and values are the threshold values
+    threshold_values = dict()
+    for a in analytes:
+        threshold_values[a.get('analytename')] = {
+            "threshold_value" : a.get('threshold_value'),
+            "unit"  : a.get('unit')
+        }
+    
+    wqdata = get_raw_wq_data(conn=eng,sitename=sitename,firstbmp=firstbmp,lastbmp=lastbmp,bmptype=bmptype,threshold_values=threshold_values)
+    wqdata = fix_thresh_units(wqdata)
+    # the bmptype query only has the bmptype column to group on, not the site and bmps
+    wqindexdf = wq_index(wqdata, grouping_columns = ['sitename', 'firstbmp', 'lastbmp'] if bmptype is None else ['bmptype'])
+    
+    if len(wqindexdf) < 2:
+        resp = {
+            "error": "Not enough data",
+            "message": "Fewer than two of the analytes have data for this selection - a mashup index score requires two"
+        }
+        return jsonify(resp), 400
+    
+    sweep = rank_sensitivity(wqindexdf.performance_index.values)
+    
+    resp = {
+        "sitename"             : sitename,
+        "bmpname"              : firstbmp,
+        "firstbmp"             : firstbmp,
+        "lastbmp"              : lastbmp,
+        "bmptype"              : bmptype,
+        "analytenames"         : wqindexdf.analyte.tolist(),
+        "individual_scores"    : [round(x, 2) for x in wqindexdf.performance_index.tolist()],
+        "n_params"             : len(wqindexdf),
+        **sweep
+    }
+    
+    # Where the ranking the user actually entered lands, if they gave one
+    # (worked out the same way /direct-comparison-data gets its scores, so the two always agree)
+    rankings_dict = { a.get('analytename'): a.get('rank') for a in analytes }
+    if all([ rankings_dict.get(a) is not None for a in wqindexdf.analyte ]):
+        wqindexdf['rank'] = wqindexdf.analyte.apply(lambda a: rankings_dict.get(a))
+        resp["rankings"] = rankings_dict
+        resp["user_ahp_mashup_score"] = round(mashup_index(wqindexdf.performance_index.values, _ahp_weights_by_row(wqindexdf).values), 2)
+        resp["user_ranksum_mashup_score"] = round(mashup_index(wqindexdf.performance_index.values, calc_ranksum_weights(wqindexdf['rank'].values)), 2)
+    
     # return repsonse
     return jsonify(resp)
     
@@ -651,6 +987,7 @@ def directcomparison():
     
 # Actually get the data (This route is for water quality - if they request for hydrology we can build that later - too much time to put in to build that right now)
 @data_api.route('/thresh-comparison-data', methods = ['GET', 'POST'])
+@result_cache.cached
 def threshdata():
 
     eng = g.eng
@@ -663,8 +1000,7 @@ def threshdata():
     
     
     analytes = params.get('analytes')
-    print("analytes")
-    print(analytes)
+    logger.debug("analytes\n%s", analytes)
     # analytes should be a list
     # [
     #     {
@@ -736,7 +1072,9 @@ def threshdata():
         
         
         # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
-        valid_sitenames = pd.read_sql(f"SELECT DISTINCT sitename FROM vw_mashup_index_comparison_rawdata ORDER BY 1", eng).sitename.values
+        # (the distinct values are held in memory by the catalog, so this does not hit the database)
+        with timed('validation'):
+            valid_sitenames = rawdata_catalog.values(eng, 'sitename')
         
         if sitename not in valid_sitenames:
             resp = {
@@ -756,7 +1094,8 @@ def threshdata():
         
         # future proofing in case they want to look at it by BMP type
         # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
-        valid_bmptypes = pd.read_sql(f"SELECT DISTINCT firstbmptype FROM vw_mashup_index_comparison_rawdata ORDER BY 1", eng).firstbmptype.values
+        with timed('validation'):
+            valid_bmptypes = rawdata_catalog.values(eng, 'bmptype')
         if bmptype not in valid_bmptypes:
             resp = {
                 "error": "Invalid bmptype",
@@ -771,66 +1110,77 @@ def threshdata():
             }
             return jsonify(resp), 400
     
+    if not all([ 0 <= float(t.get('percentile')) <= 1 for t in thresh_percentiles_and_colors ]):
+            resp = {
+                "error": "Invalid thresh percentiles value",
+                "message": "Threshold percentile value must be between 0 and 1"
+            }
+            return jsonify(resp), 400
     
     
-    percentile_cont_str = ',\n'.join(
-        [
-            f"PERCENTILE_CONT({t.get('percentile')}) WITHIN GROUP ( ORDER BY inflow_emc ) AS thresh_{round(t.get('percentile') * 100)}" 
-            for t in thresh_percentiles_and_colors
-        ]
-    )
-    
-    
-    thresh_percentiles_sql = f"""
-        SELECT
-            analyte,
-            {percentile_cont_str}
-        FROM
-            vw_mashup_index_comparison_rawdata
-        WHERE
-            analyte IN ( '{"', '".join([a.get('analytename') for a in analytes])}' ) 
-        GROUP BY
-            analyte
-    """
     
-    thresh_percentiles_df = pd.read_sql(thresh_percentiles_sql, eng)
+    with timed('thresh_percentiles'):
+        if USE_EMC_INDEX:
+            # same table the PERCENTILE_CONT query below gives back, built from the in memory index of sorted EMCs
+            # (one row per analyte that has any data, one thresh_ column per percentile)
+            thresh_percentiles_df = pd.DataFrame([
+                {
+                    "analyte": analytename,
+                    **{
+                        f"thresh_{round(t.get('percentile') * 100)}": emc_index.percentile(eng, ('all',), analytename, 'inflow', float(t.get('percentile')))
+                        for t in thresh_percentiles_and_colors
+                    }
+                }
+                for analytename in dict.fromkeys([a.get('analytename') for a in analytes])
+                if emc_index.get(eng, ('all',), analytename, 'inflow')[1] > 0
+            ], columns = ['analyte', *[f"thresh_{round(t.get('percentile') * 100)}" for t in thresh_percentiles_and_colors]])
+        else:
+            # one PERCENTILE_CONT column (thresh_<percentile * 100>) per threshold, for each analyte
+            thresh_percentiles_qry, thresh_percentiles_params = thresh_percentiles_query(
+                eng, [a.get('analytename') for a in analytes], [t.get('percentile') for t in thresh_percentiles_and_colors]
+            )
+            thresh_percentiles_df = pd.read_sql(thresh_percentiles_qry, eng, params = thresh_percentiles_params)
     
     thresh_units_df = pd.DataFrame(analytes).rename(columns = {'analytename': 'analyte'})
     
     thresh_percentiles_df = thresh_percentiles_df.merge(thresh_units_df, how = 'left', on = 'analyte')
     
-    print("thresh_percentiles_df")
-    print(thresh_percentiles_df)
+    logger.debug("thresh_percentiles_df\n%s", thresh_percentiles_df)
     
-    # build threshold_values according to how the function specifies - a dictionary whose keys are the analyte names and values are the threshold values
+    # The raw data is the same for every percentile - only the thresholds change
+    # so it gets queried once here, and each percentile's thresholds are applied to it in memory in the loop below
+    with timed('get_raw_wq_data'):
+        rawdata = get_raw_wq_data(conn=eng,sitename=sitename,firstbmp=firstbmp,lastbmp=lastbmp,bmptype=bmptype,analytes=thresh_percentiles_df.analyte.tolist())
+    
+    # build rankings dictionary in a convenient way to tack on to the index df
+    rankings_dict = dict()
+    for a in analytes:
+        rankings_dict[a.get('analytename')] = a.get('rank')
     
     all_scores = []
     for col in [c for c in thresh_percentiles_df.columns if 'thresh' in str(c)]:
+        # build threshold_values according to how the function specifies - a dictionary whose keys are the analyte names and values are the threshold values
         threshold_values = thresh_percentiles_df[['analyte', col, 'unit', 'rank']].rename(columns = {col: 'threshold_value'}).set_index('analyte').to_dict(orient='index')
-        print("threshold_values")
-        print(threshold_values)
+        logger.debug("threshold_values\n%s", threshold_values)
         
-        # anyways, if both are given it goes with threshold values
-        # if neither are given it grabs all analytes
-        # if analytes is not provided, it is none and its no big deal
-        wqdata = get_raw_wq_data(conn=eng,sitename=sitename,firstbmp=firstbmp,lastbmp=lastbmp,bmptype=bmptype,threshold_values=threshold_values)
+        wqdata = set_threshold_values(rawdata, threshold_values)
         
-        wqdata = fix_thresh_units(wqdata)
+        with timed('fix_thresh_units'):
+            wqdata = fix_thresh_units(wqdata)
         
-        wqindexdf = wq_index(wqdata, grouping_columns = ['sitename', 'firstbmp', 'lastbmp'])
-        
-        # build rankings dictionary in a convenient way to tack on to the index df
-        rankings_dict = dict()
-        for a in analytes:
-            rankings_dict[a.get('analytename')] = a.get('rank')
+        # the bmptype query only has the bmptype column to group on, not the site and bmps
+        with timed('wq_index'):
+            wqindexdf = wq_index(wqdata, grouping_columns = ['sitename', 'firstbmp', 'lastbmp'] if bmptype is None else ['bmptype'])
         
         wqindexdf['rank'] = wqindexdf.analyte.apply(lambda a: rankings_dict.get(a))
         
         # AHP needs the constituents and the rankings for each (numpy arrays)
-        wqindexdf['ahp_weights'] = calc_ahp_weights(wqindexdf.analyte.values, wqindexdf['rank'].values)
+        with timed('calc_ahp_weights'):
+            wqindexdf['ahp_weights'] = _ahp_weights_by_row(wqindexdf)
 
         # Ranksum just needs the rankings (numpy array)
-        wqindexdf['ranksum_weights'] = calc_ranksum_weights(wqindexdf['rank'].values)
+        with timed('calc_ranksum_weights'):
+            wqindexdf['ranksum_weights'] = calc_ranksum_weights(wqindexdf['rank'].values)
         
         ahpmash = mashup_index(wqindexdf.performance_index.values, wqindexdf.ahp_weights.values)
         rankmash = mashup_index(wqindexdf.performance_index.values, wqindexdf.ranksum_weights.values)
@@ -841,20 +1191,17 @@ def threshdata():
             thresh_color = str([ v.get('plotcolor', "#000000") for v in thresh_percentiles_and_colors if v.get('percentile') == thresh_percentile][0]).upper()
             warning_message = ""
         except IndexError as e:
-            print("ERROR getting thresh color - not found")
-            traceback.print_exc()
+            logger.exception("ERROR getting thresh color - not found")
             warning_message = f"Plot color not found for percentile {thresh_percentile}"
             thresh_color = "#000000"
         
+        # each value goes through python's round() - DataFrame.round (numpy) rounds the binary value and can land the other way on a tie (2.675 -> 2.68, not 2.67)
         wqindexdf['performance_index'] = wqindexdf['performance_index'].apply(lambda x: round(x, 2))
-        
         wqindexdf['ahp_weights'] = wqindexdf.ahp_weights.apply(lambda w: round(w, 4))
         wqindexdf['ranksum_weights'] = wqindexdf.ranksum_weights.apply(lambda w: round(w, 4))
         
-        print("wqindexdf")
-        print(wqindexdf)
-        print("analytes")
-        print(analytes)
+        logger.debug("wqindexdf\n%s", wqindexdf)
+        logger.debug("analytes\n%s", analytes)
     
         tmp_analytes = pd.DataFrame(analytes).merge(
                 (
@@ -872,8 +1219,7 @@ def threshdata():
             )[['analytename','individual_score','rank','number_of_events','threshold_value','unit','threshold_percentile','ahp_weight','ranksum_weight']] \
             .to_dict('records')
         
-        print("tmp_analytes")
-        print(tmp_analytes)
+        logger.debug("tmp_analytes\n%s", tmp_analytes)
         
         
         all_scores.append({
@@ -894,7 +1240,8 @@ def threshdata():
         })
     
     # return repsonse
-    return jsonify(all_scores), 200
+    with timed('serialization'):
+        return jsonify(all_scores), 200
     
 
 
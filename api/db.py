@@ -0,0 +1,121 @@
+import os, time, threading
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+
+# Pool settings - all of these can be overridden through environment variables in the docker container
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+POOL_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() in ('1', 'true', 'yes')
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool that keeps track of how long requests wait to check out a connection
+    A wait time that keeps growing means the pool is too small for the number of concurrent requests
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wait_lock = threading.Lock()
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_last = 0.0
+        self._timing = threading.local()
+
+    def _do_get(self):
+        # QueuePool._do_get calls itself when it loses a race for an overflow slot - only time the outermost call
+        if getattr(self._timing, 'active', False):
+            return super()._do_get()
+
+        self._timing.active = True
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self._timing.active = False
+            waited = time.perf_counter() - start
+            with self._wait_lock:
+                self.wait_count += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+                self.wait_last = waited
+
+
+def _connect_args(connection_string):
+    # An embedded DuckDB file (duckdb:////path/to/file.duckdb - see export_duckdb.py) is opened read only,
+    # since only one process at a time can have it open for writing, and every uwsgi worker needs it
+    if str(connection_string).startswith('duckdb'):
+        return {"read_only": True}
+    return {}
+
+
+# One engine per worker process
+# uwsgi forks workers after the app is imported, and a pooled connection must never be shared between a parent and child process
+# so the engine is tagged with the pid that created it, and a forked child builds its own the first time it asks for one
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    global _engine, _engine_pid
+
+    if (_engine is not None) and (_engine_pid == os.getpid()):
+        return _engine
+
+    with _engine_lock:
+        if (_engine is not None) and (_engine_pid == os.getpid()):
+            return _engine
+
+        if _engine is not None:
+            # inherited from the parent process - drop the references to its connections without closing the parent's sockets
+            _engine.dispose(close=False)
+
+        connection_string = os.environ.get("DB_CONNECTION_STRING")
+        _engine = create_engine(
+            connection_string,
+            connect_args=_connect_args(connection_string),
+            poolclass=InstrumentedQueuePool,
+            pool_size=POOL_SIZE,
+            max_overflow=POOL_MAX_OVERFLOW,
+            pool_timeout=POOL_TIMEOUT,
+            pool_recycle=POOL_RECYCLE,
+            pool_pre_ping=POOL_PRE_PING
+        )
+        _engine_pid = os.getpid()
+
+    return _engine
+
+
+def pool_stats():
+    if (_engine is None) or (_engine_pid != os.getpid()):
+        return {"pid": os.getpid(), "engine_created": False}
+
+    pool = _engine.pool
+    stats = {
+        "pid"              : os.getpid(),
+        "engine_created"   : True,
+        "pool_size"        : pool.size(),
+        "checked_out"      : pool.checkedout(),
+        "checked_in"       : pool.checkedin(),
+        "overflow"         : pool.overflow(),
+        "max_overflow"     : POOL_MAX_OVERFLOW,
+        "timeout"          : POOL_TIMEOUT,
+        "recycle"          : POOL_RECYCLE,
+        "pre_ping"         : POOL_PRE_PING,
+    }
+
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool._wait_lock:
+            stats.update({
+                "checkouts"          : pool.wait_count,
+                "wait_time_total_s"  : round(pool.wait_total, 6),
+                "wait_time_avg_s"    : round(pool.wait_total / pool.wait_count, 6) if pool.wait_count > 0 else 0,
+                "wait_time_max_s"    : round(pool.wait_max, 6),
+                "wait_time_last_s"   : round(pool.wait_last, 6),
+            })
+
+    return stats
@@ -1,28 +1,52 @@
 import os
-import pandas as pd
-from io import BytesIO
+from datetime import datetime, timezone
 
-from flask import Blueprint, request, render_template, jsonify, g, send_file
+from flask import Blueprint, request, render_template, jsonify, g, send_file, Response, stream_with_context
 
-from .utils import format_existing_excel, get_raw_wq_data
+from .utils import write_styled_excel, get_raw_wq_data, iter_raw_wq_data, rawdata_catalog, \
+    stream_csv, stream_parquet, EXPORT_FORMATS, export_cache, USE_EXPORT_CACHE, get_data_version, payload_to_dataframe, json_loads, timed, \
+    raw_wq_columns
 
 
 download = Blueprint('download', __name__, static_folder = 'static')
 
+# Largest request body (bytes) /json-to-excel will take
+JSON_TO_EXCEL_MAX_BYTES = int(os.environ.get('JSON_TO_EXCEL_MAX_BYTES', 50 * 1024 * 1024))
+
 @download.route('/json-to-excel', methods = ['POST'])
 def json_to_excel_route():
     
-    dat = request.json
-    df = pd.DataFrame(dat)
+    if (request.content_length is not None) and (request.content_length > JSON_TO_EXCEL_MAX_BYTES):
+        resp = {
+            "error": "Request too large",
+            "message": f"The posted data is {request.content_length} bytes, the limit is {JSON_TO_EXCEL_MAX_BYTES} bytes"
+        }
+        return jsonify(resp), 413
     
-    # Use BytesIO as a buffer
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False)
+    # the body can also come without a content length (chunked), so the read itself is capped too
+    raw = request.stream.read(JSON_TO_EXCEL_MAX_BYTES + 1)
+    if len(raw) > JSON_TO_EXCEL_MAX_BYTES:
+        resp = {
+            "error": "Request too large",
+            "message": f"The posted data is over the limit of {JSON_TO_EXCEL_MAX_BYTES} bytes"
+        }
+        return jsonify(resp), 413
     
-    output.seek(0)
+    try:
+        with timed('parse'):
+            dat = json_loads(raw)
+            df = payload_to_dataframe(dat)
+    except (ValueError, AssertionError) as e:
+        # orjson's decode error is a ValueError too
+        resp = {
+            "error": "Invalid data",
+            "message": str(e)
+        }
+        return jsonify(resp), 400
     
-    output = format_existing_excel(output)
+    # Styled as it is written - one pass, no re-reading the file with openpyxl
+    with timed('excel'):
+        output = write_styled_excel(df)
 
     # Set the headers to send back an Excel file
     return send_file(output, download_name=f"converted_json.xlsx", as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
@@ -33,6 +57,15 @@ def rawdata():
     eng = g.eng
     
     sitename = request.args.get('sitename')
+    
+    # xlsx (default), csv or parquet
+    fmt = request.args.get('format', 'xlsx').lower()
+    if fmt not in EXPORT_FORMATS:
+        resp = {
+            "error": "Invalid format",
+            "message": f"format must be one of {', '.join(EXPORT_FORMATS.keys())}"
+        }
+        return jsonify(resp), 400
 
     # Sitename and firstbmp are required
     if sitename is None:
@@ -43,7 +76,8 @@ def rawdata():
         return jsonify(resp), 400
     
     # prevent SQL injection by requiring that the provided sitename comes from the distinct sitenames in the analysis table
-    valid_sitenames = pd.read_sql(f"SELECT DISTINCT sitename FROM vw_mashup_index_comparison_rawdata ORDER BY 1", eng).sitename.values
+    # (the distinct values are held in memory by the catalog, so this does not hit the database)
+    valid_sitenames = rawdata_catalog.values(eng, 'sitename')
     
     if sitename not in valid_sitenames:
         resp = {
@@ -52,19 +86,77 @@ def rawdata():
         }
         return jsonify(resp), 400
         
-    df = get_raw_wq_data(conn=eng,sitename=sitename)
-    
-    
-    # Use BytesIO as a buffer
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False)
-    
-    output.seek(0)
+    mimetype = EXPORT_FORMATS[fmt]['mimetype']
+    download_name = f"rawdata.{EXPORT_FORMATS[fmt]['extension']}"
+
+    if not USE_EXPORT_CACHE:
+        return _build_rawdata_response(eng, sitename, fmt, mimetype, download_name)
+
+    # The same site gets downloaded over and over - generated files are kept on disk, keyed on the data version too,
+    # so the ETag (and the cached file) changes when the data does
+    version = get_data_version(eng)
+    etag = export_cache.etag(sitename, fmt, version)
+
+    if etag in request.if_none_match:
+        resp = Response(status = 304)
+        resp.set_etag(etag)
+        return resp
+
+    path = export_cache.get(sitename, fmt, version)
+    if path is not None:
+        # send_file answers If-None-Match / If-Modified-Since on its own (conditional = True)
+        return send_file(
+            path, download_name=download_name, as_attachment=True, mimetype=mimetype,
+            etag=etag, last_modified=os.path.getmtime(path), conditional=True
+        )
+
+    return _build_rawdata_response(eng, sitename, fmt, mimetype, download_name, version = version, etag = etag)
+
+
+def _build_rawdata_response(eng, sitename, fmt, mimetype, download_name, version = None, etag = None):
+    # Generates the download - and, when a data version is given, saves it to the export cache on the way out
+    cache = version is not None
+
+    if fmt != 'xlsx':
+        # CSV and parquet are streamed - rows are read off the cursor a chunk at a time and sent as they are converted
+        # so the response starts right away and memory does not grow with the size of the site
+        chunks = iter_raw_wq_data(conn=eng, sitename=sitename)
+        # the column types come from the query, not from the first chunk - so empty EMCs up front or no rows at all still give a proper file
+        columns = raw_wq_columns()
+        body = stream_csv(chunks, columns = columns) if fmt == 'csv' else stream_parquet(chunks, columns = columns)
+        if cache:
+            body = export_cache.tee(body, sitename, fmt, version)
+        resp = Response(
+            stream_with_context(body),
+            mimetype = mimetype,
+            headers = {"Content-Disposition": f"attachment; filename={download_name}"}
+        )
+        if cache:
+            resp.set_etag(etag)
+            resp.last_modified = datetime.now(timezone.utc)
+        return resp
     
-    newoutput = format_existing_excel(output)
+    with timed('get_raw_wq_data'):
+        df = get_raw_wq_data(conn=eng,sitename=sitename)
     
-    # Set the headers to send back an Excel file
-    return send_file(newoutput, download_name=f"rawdata.xlsx", as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    if not cache:
+        # The styling is written along with the data, rather than writing the file and then going back over it with openpyxl
+        with timed('excel'):
+            newoutput = write_styled_excel(df)
+        
+        # Set the headers to send back an Excel file
+        return send_file(newoutput, download_name=download_name, as_attachment=True, mimetype=mimetype)
+
+    tmp_path = export_cache.temp_path(sitename, fmt, version)
+    try:
+        with timed('excel'):
+            write_styled_excel(df, output = tmp_path)
+    except Exception:
+        export_cache.discard(tmp_path)
+        raise
+    path = export_cache.commit(tmp_path, sitename, fmt, version)
 
-    
\ No newline at end of file
+    return send_file(
+        path, download_name=download_name, as_attachment=True, mimetype=mimetype,
+        etag=etag, last_modified=os.path.getmtime(path)
+    )
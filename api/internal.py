@@ -0,0 +1,48 @@
+import os, hmac
+from flask import Blueprint, jsonify, Response, request
+
+from .db import pool_stats
+from .utils import weight_cache_info, emc_index, export_cache, result_cache, raw_snapshot, render_metrics
+
+# Routes for looking at the health of the app itself, not the BMP data
+internal = Blueprint('internal', __name__)
+
+# These routes are not for the public - with INTERNAL_TOKEN set, a request has to send it (Authorization: Bearer <token>)
+# Without a token, only requests from the addresses in INTERNAL_ALLOWED_ADDRS get through (loopback by default, so a scraper on the same box)
+# (behind nginx, uwsgi_params passes the client's own address through as REMOTE_ADDR, not the proxy's)
+INTERNAL_TOKEN = os.environ.get('INTERNAL_TOKEN')
+INTERNAL_ALLOWED_ADDRS = [a.strip() for a in os.environ.get('INTERNAL_ALLOWED_ADDRS', '127.0.0.1,::1').split(',') if a.strip()]
+
+
+@internal.before_request
+def restrict_access():
+    if INTERNAL_TOKEN:
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        allowed = (scheme.lower() == 'bearer') and hmac.compare_digest(token.encode('utf-8'), INTERNAL_TOKEN.encode('utf-8'))
+    else:
+        allowed = request.remote_addr in INTERNAL_ALLOWED_ADDRS
+
+    if not allowed:
+        resp = {
+            "error": "Forbidden",
+            "message": "this route is only available to the app's own monitoring"
+        }
+        return jsonify(resp), 403
+
+
+@internal.route('/internal/pool-stats', methods = ['GET'])
+def poolstats():
+    # Stats are per worker process - under uwsgi each worker has its own pool, so repeated calls may land on different workers
+    return jsonify(pool_stats())
+
+
+@internal.route('/internal/cache-stats', methods = ['GET'])
+def cachestats():
+    # hit/miss counts of the in memory caches - per worker process, same as the pool stats
+    return jsonify(weights = weight_cache_info(), emc_index = emc_index.stats(), export_cache = export_cache.stats(), results = result_cache.stats(), snapshot = raw_snapshot.stats())
+
+
+@internal.route('/metrics', methods = ['GET'])
+def metrics():
+    # request and pipeline stage timing histograms, in the prometheus text format - per worker process as well
+    return Response(render_metrics(), mimetype = 'text/plain; version=0.0.4')
@@ -1,2 +1,13 @@
 from .funcs import *
-from .excel import *
\ No newline at end of file
+from .excel import *
+from .export import *
+from .exportcache import *
+from .fastjson import *
+from .resultcache import *
+from .metrics import *
+from .queries import *
+from .versioning import *
+from .catalog import *
+from .snapshot import *
+from .sensitivity import *
+from .emcindex import *
\ No newline at end of file
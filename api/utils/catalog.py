@@ -0,0 +1,134 @@
+import os, time, json, hashlib, threading
+import pandas as pd
+
+from .versioning import get_data_version
+from .queries import catalog_query, bmptypes_query
+
+# How long (seconds) the catalog is trusted before it gets reloaded, even if the data version has not changed
+CATALOG_TTL = float(os.environ.get('CATALOG_TTL', 600))
+
+
+class Catalog:
+    """
+    In memory copy of the distinct sitenames, bmps, bmptypes and analytes in vw_mashup_index_comparison_rawdata
+
+    It is used to validate user input (which also protects the queries that have the values formatted into them)
+    Everything comes from a single DISTINCT query, and is kept in sets so that a lookup does not touch the database
+    The catalog reloads itself when it is older than the TTL, or when the data version changes
+    """
+
+    dimensions = ('sitename', 'firstbmp', 'lastbmp', 'bmptype', 'analyte')
+
+    def __init__(self, ttl = CATALOG_TTL):
+        self.ttl = ttl
+        self._state = None
+        self._lock = threading.Lock()
+
+    def _load(self, conn, version):
+        qry, params = catalog_query()
+        combos = pd.read_sql(qry, conn, params = params)
+
+        state = {
+            "combos"     : combos,
+            "version"    : version,
+            "loaded_at"  : time.monotonic(),
+            "sets"       : { dim: frozenset(combos[dim].dropna().tolist()) for dim in self.dimensions },
+
+            # analytes available for each site/bmp combination and each bmptype
+            "site_analytes" : {
+                k: frozenset(v) for k, v in combos.groupby(['sitename', 'firstbmp', 'lastbmp']).analyte.unique().items()
+            },
+            "bmptype_analytes" : {
+                k: frozenset(v) for k, v in combos.groupby('bmptype').analyte.unique().items()
+            },
+        }
+
+        # swapping in a whole new dictionary means readers never see a half built catalog
+        self._state = state
+        return state
+
+    def state(self, conn):
+        version = get_data_version(conn)
+        state = self._state
+
+        if (state is not None) and (state['version'] == version) and ((time.monotonic() - state['loaded_at']) < self.ttl):
+            return state
+
+        with self._lock:
+            state = self._state
+            if (state is not None) and (state['version'] == version) and ((time.monotonic() - state['loaded_at']) < self.ttl):
+                return state
+            return self._load(conn, version)
+
+    def values(self, conn, dimension):
+        assert dimension in self.dimensions, f"dimension must be one of {', '.join(self.dimensions)}"
+        return self.state(conn)['sets'][dimension]
+
+    def contains(self, conn, dimension, value):
+        return value in self.values(conn, dimension)
+
+    def analytes_for(self, conn, sitename = None, firstbmp = None, lastbmp = None, bmptype = None):
+        # analytes found for a site/bmp combination, or for a bmptype
+        state = self.state(conn)
+        if bmptype is not None:
+            return state['bmptype_analytes'].get(bmptype, frozenset())
+        return state['site_analytes'].get((sitename, firstbmp, lastbmp), frozenset())
+
+    def combos(self, conn):
+        return self.state(conn)['combos']
+
+    def tree(self, conn):
+        """
+        The whole catalog as one nested structure, for /catalog - returns (tree, etag)
+
+            {
+                "version"  : <data version>,
+                "sites"    : { sitename: { firstbmp: { lastbmp: [ { "analytename": ..., "unit": ... }, ... ] } } },
+                "bmptypes" : [ { "bmpcode": ..., "bmpcategory": ..., "analytes": [ { "analytename": ..., "unit": ... }, ... ] }, ... ]
+            }
+
+        It is built from the catalog's DISTINCT query (plus lu_bmptype) the first time it is asked for, and kept until the catalog reloads
+        The etag is a hash of the content, so it only changes when something in the tree does
+        """
+        state = self.state(conn)
+        tree = state.get('tree')
+        if tree is None:
+            # two threads may both build it right after a reload - they build the same thing, so either one can win
+            tree = state['tree'] = self._build_tree(conn, state)
+        return tree
+
+    @staticmethod
+    def _analyte_list(rows):
+        # distinct analyte/unit pairs sorted by analyte, the same records /analytes gives back
+        pairs = rows[['analyte', 'unit']].drop_duplicates().sort_values(['analyte', 'unit'], na_position = 'first')
+        return [
+            {"analytename": analyte, "unit": unit if pd.notnull(unit) else None}
+            for analyte, unit in pairs.itertuples(index = False)
+            if pd.notnull(analyte)
+        ]
+
+    def _build_tree(self, conn, state):
+        combos = state['combos']
+
+        sites = dict()
+        for (sitename, firstbmp, lastbmp), rows in combos.groupby(['sitename', 'firstbmp', 'lastbmp'], sort = True):
+            sites.setdefault(sitename, dict()).setdefault(firstbmp, dict())[lastbmp] = self._analyte_list(rows)
+
+        bmptype_analytes = { bmptype: self._analyte_list(rows) for bmptype, rows in combos.groupby('bmptype', sort = True) }
+        qry, params = bmptypes_query()
+        bmptypes = [
+            {**b, "analytes": bmptype_analytes.get(b['bmpcode'], [])}
+            for b in pd.read_sql(qry, conn, params = params).to_dict('records')
+        ]
+
+        tree = {"version": state['version'], "sites": sites, "bmptypes": bmptypes}
+        etag = hashlib.sha256(json.dumps(tree, sort_keys = True, default = str).encode('utf-8')).hexdigest()[:32]
+        return tree, etag
+
+    def invalidate(self):
+        with self._lock:
+            self._state = None
+
+
+# One catalog per worker process, shared by all the routes
+rawdata_catalog = Catalog()
@@ -0,0 +1,157 @@
+import os, threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+from .versioning import get_data_version
+from .snapshot import raw_snapshot, USE_SNAPSHOT
+from .queries import emc_values_query
+
+# Whether /threshval, /percentileval, their batch versions and threshdata's percentile step use the in memory index (default) or ask postgres
+USE_EMC_INDEX = os.environ.get('USE_EMC_INDEX', 'true').lower() in ('1', 'true', 'yes')
+
+# The index stops growing past this many EMC values in total - the least recently used arrays get dropped first
+EMC_INDEX_MAX_VALUES = int(os.environ.get('EMC_INDEX_MAX_VALUES', 5000000))
+
+
+class EMCIndex:
+    """
+    Pre sorted inflow and outflow EMC arrays, keyed by (scope, analyte, inflow|outflow)
+
+    scope is one of
+        ('site', sitename, firstbmp)  - same filter /threshval and /percentileval use
+        ('bmptype', bmptype)
+        ('all',)                      - every row for the analyte (threshdata's percentiles)
+
+    An array is loaded from the database the first time it is asked for, and after that percentiles and percentile ranks
+    are a lookup into the sorted array. Everything gets dropped when the data version changes
+    """
+
+    def __init__(self, max_values = EMC_INDEX_MAX_VALUES):
+        self.max_values = max_values
+        self._entries = OrderedDict()
+        self._n_values = 0
+        self._version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _scope_filter(scope):
+        # the scope as keyword arguments for the query builders (see scope_filter)
+        if scope[0] == 'site':
+            return {"sitename": scope[1], "firstbmp": scope[2]}
+        if scope[0] == 'bmptype':
+            return {"bmptype": scope[1]}
+        if scope[0] == 'all':
+            return {}
+        raise ValueError(f"Unknown EMC index scope {scope}")
+
+    def _load(self, conn, scope, analyte):
+        if USE_SNAPSHOT:
+            df = self._snapshot_rows(conn, scope, analyte)
+        else:
+            qry, params = emc_values_query(analyte, **self._scope_filter(scope))
+            df = pd.read_sql(qry, conn, params = params)
+
+        # Both flows come back from the same query, so both get stored
+        # n_total counts every row, including the ones with a null EMC - CUME_DIST counts those too
+        entries = dict()
+        for flow in ('inflow', 'outflow'):
+            values = pd.to_numeric(df[f"{flow}_emc"], errors = 'coerce').to_numpy(dtype = float, na_value = np.nan)
+            entries[(scope, analyte, flow)] = (np.sort(values[~np.isnan(values)]), len(df))
+        return entries
+
+    @staticmethod
+    def _snapshot_rows(conn, scope, analyte):
+        # same rows as the query in _load, taken from the in memory snapshot of the view
+        if scope[0] == 'site':
+            rows = raw_snapshot.rows(conn, sitename = scope[1], firstbmp = scope[2])
+        elif scope[0] == 'bmptype':
+            rows = raw_snapshot.rows(conn, bmptype = scope[1])
+        elif scope[0] == 'all':
+            rows = raw_snapshot.state(conn)['frame']
+        else:
+            raise ValueError(f"Unknown EMC index scope {scope}")
+        return rows.loc[rows.analyte == analyte, ['inflow_emc', 'outflow_emc']]
+
+    def get(self, conn, scope, analyte, flow):
+        # returns (sorted non null values, total number of rows)
+        assert flow in ('inflow', 'outflow'), "flow must be inflow or outflow"
+        key = (tuple(scope), analyte, flow)
+        version = get_data_version(conn)
+
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._n_values = 0
+                self._version = version
+
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        # Loaded outside of the lock so one slow query does not hold up every other lookup
+        entries = self._load(conn, key[0], analyte)
+
+        with self._lock:
+            self.misses += 1
+            if version == self._version:
+                for k, v in entries.items():
+                    if k not in self._entries:
+                        self._entries[k] = v
+                        self._n_values += len(v[0])
+                    self._entries.move_to_end(k)
+
+                while (self._n_values > self.max_values) and (len(self._entries) > 2):
+                    _, (values, _) = self._entries.popitem(last = False)
+                    self._n_values -= len(values)
+
+        return entries[key]
+
+    def percentile(self, conn, scope, analyte, flow, percentile):
+        # Same as postgres PERCENTILE_CONT(percentile) WITHIN GROUP (ORDER BY <flow>_emc) - None if there are no values
+        assert 0 <= percentile <= 1, f"percentile must be between 0 and 1, not {percentile}"
+        values, _ = self.get(conn, scope, analyte, flow)
+        if len(values) == 0:
+            return None
+
+        position = percentile * (len(values) - 1)
+        first_row = int(np.floor(position))
+        second_row = int(np.ceil(position))
+        first = values[first_row]
+        if second_row == first_row:
+            return float(first)
+        # linear interpolation between the two rows, written out the same way postgres does it
+        return float(first + (values[second_row] - first) * (position - first_row))
+
+    def percentile_rank(self, conn, scope, analyte, flow, value):
+        # Same as the MAX(CUME_DIST()) of the rows at or below value, which is what /percentileval gets from postgres
+        # None if no rows are at or below value
+        values, n_total = self.get(conn, scope, analyte, flow)
+        n_below = int(np.searchsorted(values, value, side = 'right'))
+        if n_below == 0:
+            return None
+        return n_below / n_total
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries"    : len(self._entries),
+                "n_values"   : self._n_values,
+                "max_values" : self.max_values,
+                "hits"       : self.hits,
+                "misses"     : self.misses,
+                "version"    : self._version,
+            }
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._n_values = 0
+            self._version = None
+
+
+# One index per worker process
+emc_index = EMCIndex()
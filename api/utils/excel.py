@@ -1,6 +1,8 @@
 import os, shutil
 from io import BytesIO
 
+import pandas as pd
+
 from openpyxl import load_workbook
 from openpyxl.comments import Comment
 from openpyxl.styles import Font, Border, Side, PatternFill
@@ -8,9 +10,21 @@ from openpyxl.styles import Font, Border, Side, PatternFill
 from flask import session
 from math import floor
 
-def format_existing_excel(file_path_or_bytes_object, header_row = 1, cushion = 5, freeze_headers = True):
+# xlsxwriter versions of the styles format_existing_excel applies with openpyxl
+# shared by the single pass writers, which add each one to the workbook once and reuse it for every cell
+HEADER_STYLE = {'bold': True, 'border': 1, 'border_color': '#000000', 'bg_color': '#BABABA', 'pattern': 1}
+BODY_STYLE = {'border': 1, 'border_color': '#AAAAAA'}
+STRIPE_STYLE = {**BODY_STYLE, 'bg_color': '#DBDBDB', 'pattern': 1}
+
+
+def format_existing_excel(file_path_or_bytes_object, header_row = 1, cushion = 5, freeze_headers = True, streaming = False):
     
     assert isinstance(file_path_or_bytes_object, (str, BytesIO)), "file_path_or_bytes_object must be a string or BytesIO"
+
+    if streaming:
+        # Large workbooks on disk - read and rewrite them row by row rather than loading the whole object model
+        assert isinstance(file_path_or_bytes_object, str), "streaming mode only works on a file path"
+        return _format_existing_excel_streaming(file_path_or_bytes_object, header_row = header_row, cushion = cushion, freeze_headers = freeze_headers)
     # Load the workbook and iterate through sheets
     
     if isinstance(file_path_or_bytes_object, BytesIO):
@@ -84,4 +98,164 @@ def format_existing_excel(file_path_or_bytes_object, header_row = 1, cushion = 5
     else:
         workbook.save(file_path_or_bytes_object)
         return
-        
\ No newline at end of file
+
+
+def _format_existing_excel_streaming(file_path, header_row = 1, cushion = 5, freeze_headers = True):
+    """
+    Same result as format_existing_excel, for a workbook on disk, without ever holding the whole sheet in memory
+
+    The original is read row by row with openpyxl in read only mode, and each row is written straight away, with the styling,
+    to a new workbook in xlsxwriter's constant memory mode, which then replaces the original file.
+    Column widths are measured as the rows go by - xlsxwriter puts the column settings in place when the file is closed,
+    so they can be set after the last row (openpyxl's write only sheets need them before the first one)
+    Every cell shares one of a handful of formats, so memory depends on the width of a row, not the size of the sheet
+    """
+    import xlsxwriter
+
+    source = load_workbook(file_path, read_only = True)
+
+    # Written next to the original, then renamed over it, so a failure part way through leaves the original alone
+    tmp_path = f"{file_path}.{os.getpid()}.tmp.xlsx"
+    workbook = xlsxwriter.Workbook(tmp_path, {'constant_memory': True, 'remove_timezone': True})
+
+    # formats are keyed on (style, number format) so dates and numbers keep the number format they had
+    formats = dict()
+    def get_format(style_name, number_format):
+        key = (style_name, number_format)
+        if key not in formats:
+            style = {'header': HEADER_STYLE, 'body': BODY_STYLE, 'stripe': STRIPE_STYLE, 'plain': {}}[style_name]
+            if number_format not in (None, 'General'):
+                style = {**style, 'num_format': number_format}
+            formats[key] = workbook.add_format(style)
+        return formats[key]
+
+    try:
+        for sheet_name in source.sheetnames:
+            sheet = source[sheet_name]
+            outsheet = workbook.add_worksheet(sheet_name)
+
+            widths = dict()
+            last_row = -1
+            last_col = -1
+            for i, row in enumerate(sheet.iter_rows(), start = 1):
+                if i < header_row:
+                    style_name = 'plain'
+                elif i == header_row:
+                    style_name = 'header'
+                elif i % 2 == 0:  # For even row numbers
+                    style_name = 'stripe'
+                else:
+                    style_name = 'body'
+
+                for c, cell in enumerate(row):
+                    value = cell.value
+                    cell_format = get_format(style_name, getattr(cell, 'number_format', None))
+                    if value is None:
+                        outsheet.write_blank(i - 1, c, None, cell_format)
+                    else:
+                        outsheet.write(i - 1, c, value, cell_format)
+
+                    # Set the column widths based on max length in column (from the header row down)
+                    if i >= header_row:
+                        length = len(str(value)) if value is not None else 0
+                        widths[c] = max(widths.get(c, 0), length)
+
+                last_row = i - 1
+                last_col = max(last_col, len(row) - 1)
+
+            for c, max_length in widths.items():
+                outsheet.set_column(c, c, max_length + cushion)
+
+            if freeze_headers == True:
+                # Freeze the row just below the header row
+                outsheet.freeze_panes(header_row, 0)
+
+            # Apply filters to the specified header row
+            if (last_row + 1 >= header_row) and (last_col >= 0):
+                outsheet.autofilter(0, 0, last_row, last_col)
+
+        workbook.close()
+    except Exception:
+        source.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    source.close()
+    os.replace(tmp_path, file_path)
+    return
+
+
+def write_styled_excel(df, output = None, sheet_name = 'Sheet1', cushion = 5, freeze_headers = True, chunksize = 10000):
+    """
+    Writes a dataframe to an xlsx file with the same look format_existing_excel gives a workbook
+    (bold grey header, bordered body with zebra striping, frozen header row, autofilter, column widths from the longest value)
+    but in one pass with xlsxwriter, instead of writing the file, re-reading it with openpyxl and styling it cell by cell
+
+    The workbook is written in constant memory mode - rows go to disk as they are written,
+    and the dataframe is converted to python values chunksize rows at a time
+    output can be a file path or a BytesIO - if it is not given, a new BytesIO is returned (rewound to the start)
+    """
+    import xlsxwriter
+
+    if output is None:
+        output = BytesIO()
+    assert isinstance(output, (str, BytesIO)), "output must be a string or BytesIO"
+
+    # Column widths - length of the longest value (or header) in each column
+    # missing values count as zero, same as format_existing_excel
+    # (measured the way the values read back out of the written file - whole floats lose the .0, dates show the time too)
+    widths = []
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            strings = df[col].dt.strftime('%Y-%m-%d %H:%M:%S')
+        elif pd.api.types.is_float_dtype(df[col]):
+            strings = df[col].astype(str).str.replace(r'\.0$', '', regex = True)
+        else:
+            strings = df[col].astype(str)
+        lengths = strings.str.len().where(df[col].notnull(), 0)
+        widths.append(max(len(str(col)), int(lengths.max()) if len(df) > 0 else 0) + cushion)
+
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'remove_timezone': True})
+    sheet = workbook.add_worksheet(sheet_name)
+
+    header_format = workbook.add_format(HEADER_STYLE)
+
+    # one pair of formats (plain row, striped row) per column - date columns need a number format on top of the styling
+    date_columns = [pd.api.types.is_datetime64_any_dtype(df[col]) for col in df.columns]
+    body_formats = [
+        workbook.add_format({**BODY_STYLE, 'num_format': 'yyyy-mm-dd hh:mm:ss'}) if is_date else workbook.add_format(BODY_STYLE)
+        for is_date in date_columns
+    ]
+    stripe_formats = [
+        workbook.add_format({**STRIPE_STYLE, 'num_format': 'yyyy-mm-dd hh:mm:ss'}) if is_date else workbook.add_format(STRIPE_STYLE)
+        for is_date in date_columns
+    ]
+
+    for c, width in enumerate(widths):
+        sheet.set_column(c, c, width)
+
+    # constant memory mode only keeps the current row, so everything has to be written top to bottom, left to right
+    sheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
+
+    for start in range(0, len(df), chunksize):
+        chunk = df.iloc[start:start + chunksize]
+        chunk = chunk.astype(object).where(chunk.notnull(), None)
+        for i, values in enumerate(chunk.itertuples(index = False, name = None), start = start + 1):
+            # zebra striping on the even numbered rows (excel row numbers start at 1, so that is every other data row starting with the first)
+            formats = stripe_formats if (i + 1) % 2 == 0 else body_formats
+            for c, value in enumerate(values):
+                sheet.write(i, c, value, formats[c])
+
+    if freeze_headers:
+        # Freeze the row just below the header row
+        sheet.freeze_panes(1, 0)
+
+    if len(df.columns) > 0:
+        sheet.autofilter(0, 0, len(df), len(df.columns) - 1)
+
+    workbook.close()
+
+    if isinstance(output, BytesIO):
+        output.seek(0)
+    return output
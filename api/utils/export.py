@@ -0,0 +1,114 @@
+import io
+import pandas as pd
+
+
+# Raw data download formats (/rawdata?format=...)
+EXPORT_FORMATS = {
+    'xlsx'    : {'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'extension': 'xlsx'},
+    'csv'     : {'mimetype': 'text/csv', 'extension': 'csv'},
+    'parquet' : {'mimetype': 'application/vnd.apache.parquet', 'extension': 'parquet'},
+}
+
+
+def payload_to_dataframe(payload):
+    """
+    Turns a posted table into a dataframe. Two shapes are accepted
+
+        [ {col: value, ...}, ... ]                             - a list of row dictionaries (what the UIs have always sent)
+        { "columns": [col, ...], "data": {col: [values], ...} } - columnar, a fraction of the size for the same table
+
+    Anything else goes straight to pd.DataFrame, like it always has
+    """
+    if isinstance(payload, dict) and ('columns' in payload) and ('data' in payload):
+        columns = payload['columns']
+        data = payload['data']
+        assert isinstance(columns, list), "columns must be a list of column names"
+        assert isinstance(data, dict), "data must be an object with a list of values for each column"
+        assert set(columns).issubset(data.keys()), f"data is missing column(s) {set(columns) - set(data.keys())}"
+        assert len(set(len(data[col]) for col in columns)) <= 1, "every column in data must have the same number of values"
+        return pd.DataFrame({col: data[col] for col in columns}, columns = columns)
+
+    return pd.DataFrame(payload)
+
+
+def stream_csv(chunks, columns = None):
+    # Generator of CSV text, one piece per dataframe chunk - the header goes out with the first one
+    # columns (a list of the column names) is for when there are no chunks at all - the header still goes out on its own
+    header = True
+    for chunk in chunks:
+        yield chunk.to_csv(index = False, header = header)
+        header = False
+
+    if header and (columns is not None):
+        yield pd.DataFrame(columns = list(columns)).to_csv(index = False)
+
+
+class _ByteSink(io.RawIOBase):
+    """
+    Write only file object that just collects what is written to it, so that a parquet file can be sent out
+    in pieces as the row groups are written, instead of being built up in full first
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer.extend(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def stream_parquet(chunks, columns = None):
+    """
+    Generator of parquet file bytes - each dataframe chunk is written as its own row group and sent out right away
+    
+    columns is a dictionary of column name -> "float" or "string" (see raw_wq_columns) that the schema is built from
+    Without it, the schema comes from the first chunk - and a column that is all null in that chunk has no type yet, so it is taken to be a string column
+    (a later chunk with numbers in that column then fails, so pass columns whenever they are known)
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = _ByteSink()
+    writer = None
+    schema = None
+
+    if columns is not None:
+        schema = pa.schema([
+            pa.field(name, pa.float64() if coltype == 'float' else pa.string())
+            for name, coltype in columns.items()
+        ])
+
+    for chunk in chunks:
+        if writer is None:
+            if schema is None:
+                schema = pa.Schema.from_pandas(chunk, preserve_index = False)
+                schema = pa.schema([
+                    pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field
+                    for field in schema
+                ])
+            writer = pq.ParquetWriter(sink, schema)
+
+        writer.write_table(pa.Table.from_pandas(chunk, schema = schema, preserve_index = False))
+        data = sink.drain()
+        if data:
+            yield data
+
+    if writer is None:
+        # no rows at all - still send back a valid (empty) file, with the columns if they are known
+        writer = pq.ParquetWriter(sink, schema if schema is not None else pa.schema([]))
+
+    # the footer (with the schema and the row group offsets) goes out last
+    writer.close()
+    yield sink.drain()
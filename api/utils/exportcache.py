@@ -0,0 +1,120 @@
+import os, time, hashlib, tempfile, threading
+
+# Generated raw data downloads are kept on local disk, so a repeat download of the same site is just a send_file
+USE_EXPORT_CACHE = os.environ.get('USE_EXPORT_CACHE', 'true').lower() in ('1', 'true', 'yes')
+
+# Where the files go - every uwsgi worker on the machine shares the same directory
+EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'ahp_ranksum_export_cache'))
+
+# Total size (bytes) the cached files are allowed to take up - least recently used files get deleted past this
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get('EXPORT_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+
+
+class ExportCache:
+    """
+    Disk cache of generated download files, keyed by (sitename, format, data version)
+
+    The file name is a hash of the key, which doubles as the ETag - so the ETag changes whenever the data version does
+    Files are written under a temporary name and renamed into place, so a worker never serves a half written file
+    The last access time of a file is set on every hit, and eviction deletes the files with the oldest access times first
+    (the modification time is left alone, it is when the file was generated, which is what goes out as Last-Modified)
+    """
+
+    def __init__(self, directory = EXPORT_CACHE_DIR, max_bytes = EXPORT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def etag(sitename, fmt, version):
+        return hashlib.sha256(repr((sitename, fmt, version)).encode('utf-8')).hexdigest()[:32]
+
+    def path(self, sitename, fmt, version):
+        return os.path.join(self.directory, f"{self.etag(sitename, fmt, version)}.{fmt}")
+
+    def get(self, sitename, fmt, version):
+        # path to the cached file, or None if it has not been generated yet
+        path = self.path(sitename, fmt, version)
+        try:
+            stat = os.stat(path)
+            os.utime(path, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def temp_path(self, sitename, fmt, version):
+        # where a new file gets written before commit moves it into place
+        os.makedirs(self.directory, exist_ok = True)
+        return f"{self.path(sitename, fmt, version)}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def commit(self, tmp_path, sitename, fmt, version):
+        path = self.path(sitename, fmt, version)
+        os.replace(tmp_path, path)
+        self.evict()
+        return path
+
+    def discard(self, tmp_path):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    def tee(self, pieces, sitename, fmt, version):
+        """
+        Passes a streamed response body through, while also writing it to the cache
+        The file is only committed once the whole body has gone out - if the client goes away part way through, it is thrown out
+        """
+        tmp_path = self.temp_path(sitename, fmt, version)
+        complete = False
+        try:
+            with open(tmp_path, 'wb') as f:
+                for piece in pieces:
+                    data = piece.encode('utf-8') if isinstance(piece, str) else piece
+                    f.write(data)
+                    yield data
+            complete = True
+        finally:
+            if complete:
+                self.commit(tmp_path, sitename, fmt, version)
+            else:
+                self.discard(tmp_path)
+
+    def evict(self):
+        # Deletes the least recently used files until the cache fits in max_bytes
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                files.append((stat.st_atime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # another worker got to it first
+                pass
+            total -= size
+
+    def stats(self):
+        files = [e for e in os.scandir(self.directory) if e.is_file() and not e.name.endswith('.tmp')] if os.path.isdir(self.directory) else []
+        with self._lock:
+            return {
+                "directory"  : self.directory,
+                "files"      : len(files),
+                "bytes"      : sum(e.stat().st_size for e in files),
+                "max_bytes"  : self.max_bytes,
+                "hits"       : self.hits,
+                "misses"     : self.misses,
+            }
+
+
+# The directory is shared, the hit/miss counts are per worker process
+export_cache = ExportCache()
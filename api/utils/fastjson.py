@@ -0,0 +1,60 @@
+import json
+import numpy as np
+import pandas as pd
+from flask.json.provider import DefaultJSONProvider, _default as _flask_default
+
+# orjson parses (and writes) JSON several times faster than the standard library - it is optional, json is used if it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(data):
+    # data can be bytes or str
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _numpy_pandas_default(o):
+    # Called for anything the encoder does not know how to write
+    # pandas missing values become null, numpy scalars and arrays become their python equivalents, anything else is left to flask
+    if (o is pd.NA) or (o is pd.NaT):
+        return None
+    if isinstance(o, np.generic):
+        return o.item()
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    return _flask_default(o)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider (app.json) that writes the responses with orjson, which also knows numpy arrays and scalars natively
+    Keys are still sorted and debug mode still indents, same as flask's default provider,
+    and dates are still written the way flask writes them (HTTP date strings)
+
+    NaN and infinity come out as null with orjson (the standard library writes NaN, which is not valid JSON)
+    Without orjson installed, this is the default provider plus numpy/pandas support
+    """
+
+    default = staticmethod(_numpy_pandas_default)
+
+    def dumps(self, obj, **kwargs):
+        # anything other than these arguments is something only the json module understands
+        if (orjson is None) or (set(kwargs.keys()) - {'indent', 'separators', 'default', 'sort_keys'}):
+            return super().dumps(obj, **kwargs)
+
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+
+        return orjson.dumps(obj, default = kwargs.get('default', self.default), option = option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if (orjson is None) or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
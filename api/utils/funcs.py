@@ -1,31 +1,113 @@
+import os, logging
+from functools import lru_cache
 import pandas as pd
 import numpy as np
 import ahpy
 
+from .catalog import rawdata_catalog
+from .queries import build_raw_wq_query
+from .snapshot import raw_snapshot, USE_SNAPSHOT
+from .metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Which implementation wq_index uses when the caller does not say
+# "numpy" - vectorized, categories stored as small integer codes (default)
+# "pandas" - the original row by row implementation, kept around to check the numpy engine against
+WQ_INDEX_ENGINE = os.environ.get('WQ_INDEX_ENGINE', 'numpy')
+
+# Maximum number of distinct rank configurations remembered by the AHP and rank sum weight caches (each has its own)
+WEIGHT_CACHE_SIZE = int(os.environ.get('WEIGHT_CACHE_SIZE', 256))
+
+# Number of rows per chunk when raw data is streamed out (iter_raw_wq_data)
+RAWDATA_CHUNKSIZE = int(os.environ.get('RAWDATA_CHUNKSIZE', 10000))
+
+
 # Rank Sum Algorithm
 def calc_ranksum_weights(rankings):
     # rankings should be a list or array
+    # People tend to re-submit the same few rankings, so the weights are memoized on the rank tuple - see weight_cache_info
+    return np.array(_cached_ranksum_weights(tuple(float(r) for r in rankings)))
+
+
+@lru_cache(maxsize = WEIGHT_CACHE_SIZE)
+def _cached_ranksum_weights(rankings):
+    return tuple(_ranksum_weights(rankings))
+
+
+def _ranksum_weights(rankings):
+    return calc_ranksum_weights_batch(np.asarray(rankings, dtype = float)[np.newaxis, :])[0]
+
 
-    max_rank_plus1 = max(rankings) + 1
-    ranksum = 0
-    weights = np.zeros(len(rankings))
+def calc_ranksum_weights_batch(rankings):
+    # Rank sum weights for many rankings at once
+    # rankings should be a 2D array - one row per scenario, one column per analyte
+    # returns an array of the same shape, each row being the weights for that scenario's ranking
+    rankings = np.asarray(rankings, dtype = float)
+    assert rankings.ndim == 2, "rankings must be a 2D array (scenarios x analytes)"
 
-    # Iterate through the rankings
-    for ii in range(len(rankings)):
-        # The weight is the (max_rank + 1 - Rank) so that the lowest rankings get the highest weight 
-        weights[ii] = max_rank_plus1 - rankings[ii]
+    # The weight is the (max_rank + 1 - Rank) so that the lowest rankings get the highest weight 
+    weights = rankings.max(axis = 1, keepdims = True) + 1 - rankings
 
-        # Accumulate the weight
-        ranksum = ranksum + (max_rank_plus1 - rankings[ii])
+    # Accumulate the weight
+    # one analyte at a time (vectorized over the scenarios), which is the same order the one ranking at a time version added them up in
+    ranksum = np.zeros(rankings.shape[0])
+    for ii in range(rankings.shape[1]):
+        ranksum = ranksum + weights[:, ii]
     
     # Normalize each rank weight by the cumulative weight so that sum(weights) = 1
-    weights = weights/ranksum
-    return weights
+    return weights / ranksum[:, np.newaxis]
 
 
-def calc_ahp_weights(constituents, rankings):
+# Which solver calc_ahp_weights uses when the caller does not say
+# "numpy" - the closed form 1 / rank weights of calc_ahp_weights_batch (default)
+# "ahpy" - the ahpy library, kept around to check the numpy solver against
+AHP_SOLVER = os.environ.get('AHP_SOLVER', 'numpy')
+
+
+def calc_ahp_weights_batch(rankings, precision = 3):
+    # AHP weights for many rankings at once - rankings should be a 2D array, one row per scenario, one column per analyte
+    # The comparison matrix this app builds is rank j / rank i, which is always perfectly consistent (consistency ratio 0)
+    # and the principal eigenvector of such a matrix is proportional to 1 / rank - so no matrix or eigenvector iteration is needed
+    # Unlike calc_ahp_weights, the weights are NOT sorted - column i of the result is the weight of analyte i
+    rankings = np.asarray(rankings, dtype = float)
+    assert rankings.ndim == 2, "rankings must be a 2D array (scenarios x analytes)"
+    assert np.all(rankings > 0), "All rankings must be greater than zero"
+    inverse = 1 / rankings
+    return (inverse / inverse.sum(axis = 1, keepdims = True)).round(precision)
+
+
+def calc_ahp_weights(constituents, rankings, solver = None):
     # constituents should be a list or array
     # rankings should be a list or array
+    # solver is either "numpy" or "ahpy" - if not given, it is taken from the AHP_SOLVER environment variable (default numpy)
+    #
+    # The weights are returned the same way ahpy returns them - sorted from largest to smallest weight (ties keep the order they were given in)
+    # The numpy solver matches ahpy's weights to within 0.001 - they only differ when a weight lands right on a rounding boundary
+    # (ahpy squares the matrix in floating point, the numpy solver uses the exact 1 / rank form, so the last bit can fall either way)
+    #
+    # Results are memoized on (analyte order, rank tuple, solver) - see weight_cache_info
+    
+    solver = AHP_SOLVER if solver is None else solver
+    assert solver in ('numpy', 'ahpy'), f"solver must be either numpy or ahpy, not {solver}"
+    assert len(constituents) == len(rankings), "constituents and rankings must be the same length"
+    
+    return np.array(
+        _cached_ahp_weights(tuple(str(c) for c in constituents), tuple(float(r) for r in rankings), solver)
+    )
+
+
+@lru_cache(maxsize = WEIGHT_CACHE_SIZE)
+def _cached_ahp_weights(constituents, rankings, solver):
+    return tuple(_ahp_weights(constituents, rankings, solver))
+
+
+def _ahp_weights(constituents, rankings, solver):
+    
+    if solver == 'numpy':
+        weights = calc_ahp_weights_batch(np.asarray(rankings, dtype = float)[np.newaxis, :], precision = 3)[0]
+        # stable sort, so that tied weights stay in the order they were given in, same as ahpy
+        return weights[np.argsort(-weights, kind = 'stable')]
     
     # Initialize an empty dictionary to store the combinations and rankings
     comp_ratios = {}
@@ -52,18 +134,44 @@ def calc_ahp_weights(constituents, rankings):
 
 
 
+def weight_cache_info():
+    # hit/miss counts for the memoized AHP and rank sum weights
+    info = dict()
+    for name, cached in (('ahp', _cached_ahp_weights), ('ranksum', _cached_ranksum_weights)):
+        stats = cached.cache_info()
+        info[name] = {
+            "hits"     : stats.hits,
+            "misses"   : stats.misses,
+            "maxsize"  : stats.maxsize,
+            "currsize" : stats.currsize,
+            "hit_ratio": round(stats.hits / (stats.hits + stats.misses), 4) if (stats.hits + stats.misses) > 0 else None
+        }
+    return info
+
+
+def clear_weight_cache():
+    _cached_ahp_weights.cache_clear()
+    _cached_ranksum_weights.cache_clear()
+
+
 def mashup_index(scores, weights):
     # "scores" represents a list (or array) of scores (separate scores per constituent)
     # weights represents the AHP or Ranksum weights list (or array)
-    
-    # Now calculate the Mashup2 from the hardcode rankings and scores
-    perf_weights = []
+    return mashup_index_batch(np.asarray(scores, dtype = float)[np.newaxis, :], np.asarray(weights, dtype = float)[np.newaxis, :])[0]
 
-    # Weighted average is the score from each performance index category times the rank weight
-    for i in range(len(scores)):
-        perf_weights.append(scores[i] * weights[i])
 
-    performance_index = sum(perf_weights)
+def mashup_index_batch(scores, weights):
+    # Mashup scores for many (scores, weights) combinations at once
+    # scores and weights should be 2D arrays - one row per scenario, one column per constituent
+    # either one can also be a single 1D row, which then gets used for every scenario
+    # returns a 1D array with the mashup score of each scenario
+    scores, weights = np.broadcast_arrays(np.atleast_2d(np.asarray(scores, dtype = float)), np.atleast_2d(np.asarray(weights, dtype = float)))
+    
+    # Weighted average is the score from each performance index category times the rank weight
+    # accumulated one constituent at a time (vectorized over the scenarios), same order as the original one scenario version
+    performance_index = np.zeros(scores.shape[0])
+    for i in range(scores.shape[1]):
+        performance_index = performance_index + scores[:, i] * weights[:, i]
 
     return performance_index
 
@@ -79,7 +187,8 @@ def wq_index(
         "Marginal"     : 3,
         "Insufficient" : 4,
         "Failure"      : 10
-    }
+    },
+    engine = None
 ):
     """
     df represents the dataframe that has the waterquality data for various rain events at a BMP site
@@ -96,12 +205,18 @@ def wq_index(
     Prep the data such that there is only one threshold value per analyte. 
     If multple thresholds are found, the function will choose the lowest threshold value so please check the data appropriately and correctly
     
+    engine is either "numpy" or "pandas" - both give the same output, numpy is much faster on large frames
+    If not given, it is taken from the WQ_INDEX_ENGINE environment variable (default numpy)
+    
     """
     assert isinstance(category_score_values, dict), f"category_score_values parameter must be a dictionary, not {type(category_score_values)}"
     
     wq_index_categories = ["Success", "Excess", "Marginal", "Insufficient", "Failure"]
     assert set(wq_index_categories) == set(category_score_values.keys()), f"Category score values dictionary must have the keys {', '.join(wq_index_categories)}"
     
+    engine = WQ_INDEX_ENGINE if engine is None else engine
+    assert engine in ('numpy', 'pandas'), f"engine must be either numpy or pandas, not {engine}"
+    
     # assign default threshold
     if 'threshold' not in df.columns:
         print(f"warning - threshold not provided - using default {default_threshold}")
@@ -126,6 +241,8 @@ def wq_index(
         eff_thresh_ratio = df.outflow_emc / df.threshold,
     )
 
+    if engine == 'numpy':
+        return _wq_index_numpy(df, grouping_columns, wq_index_categories, category_score_values)
 
     # Get the categories based on the pre defined criteria
     df = df.assign(
@@ -161,81 +278,237 @@ def wq_index(
         
         
     return indexdf
+
+
+def _wq_index_numpy(df, grouping_columns, wq_index_categories, category_score_values):
+    # Vectorized version of the categorization and aggregation steps in wq_index
+    # expects the frame wq_index has already prepped (thresholds merged on, ratios calculated)
+    
+    inf = df['inf_thresh_ratio'].to_numpy(dtype = float, na_value = np.nan)
+    eff = df['eff_thresh_ratio'].to_numpy(dtype = float, na_value = np.nan)
+    
+    # Category codes are the position in wq_index_categories - the conditions are checked in the same order as the row by row version
+    # The extra code at the end (len(wq_index_categories)) is for rows that fit no category (missing threshold for example)
+    # those rows count towards the number of events but not towards any category
+    na_code = len(wq_index_categories)
+    category_codes = np.select(
+        [
+            (inf > 1) & (eff < 1),
+            (eff < inf) & (inf <= 1),
+            (inf <= eff) & (eff < 1),
+            (eff >= 1) & (eff >= inf),
+            (1 <= eff) & (eff < inf),
+        ],
+        [
+            wq_index_categories.index('Success'),
+            wq_index_categories.index('Excess'),
+            wq_index_categories.index('Marginal'),
+            wq_index_categories.index('Failure'),
+            wq_index_categories.index('Insufficient'),
+        ],
+        default = na_code
+    ).astype(np.int8)
+    
+    grouped = df.groupby([*grouping_columns, 'analyte'])
+    group_codes = grouped.ngroup().to_numpy()
+    groupkeys = grouped.size().index
+    n_groups = len(groupkeys)
+    
+    # rows with a null grouping value are dropped by groupby, so they get a group code of -1
+    valid = group_codes >= 0
+    
+    # counts matrix - one row per group, one column per category (plus the uncategorized column)
+    counts = np.bincount(
+        group_codes[valid].astype(np.int64) * (na_code + 1) + category_codes[valid],
+        minlength = n_groups * (na_code + 1)
+    ).reshape(n_groups, na_code + 1)
+    
+    number_of_events = counts.sum(axis = 1)
+    score_vector = np.array([category_score_values.get(c) for c in wq_index_categories], dtype = float)
+    
+    # performance index is the (category share matrix) x (score vector) product
+    # it is accumulated one category at a time, in the same order as the row by row version adds them up,
+    # so that the two engines agree exactly rather than just to floating point noise
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        shares = counts[:, :na_code] / number_of_events[:, None]
+    performance_index = np.zeros(n_groups)
+    for k in range(na_code):
+        performance_index = performance_index + shares[:, k] * score_vector[k]
+    
+    indexdf = groupkeys.to_frame(index = False).assign(
+        performance_index = performance_index,
+        # the row by row version builds a float Series per group, so the event counts come out as floats there as well
+        number_of_events = number_of_events.astype(float)
+    )
+    
+    return indexdf
         
     
 # Essentially here "None" means the argument was not provided    
 def get_raw_wq_data(conn, sitename = None, firstbmp = None, lastbmp = None, bmptype = None, threshold_values = None, analytes = None):
     
+    # (not timed as its own stage here - the routes time their validation, and this would count it a second time)
+    analytes = _validate_raw_wq_args(conn, sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp, bmptype = bmptype, threshold_values = threshold_values, analytes = analytes)
+    
+    if USE_SNAPSHOT:
+        # a slice of the in memory copy of the view, no query at all
+        with timed('snapshot_slice'):
+            df = raw_snapshot.raw_wq_data(conn, sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp, bmptype = bmptype, analytes = analytes)
+    else:
+        qry, params = build_raw_wq_query(conn, sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp, bmptype = bmptype, analytes = analytes)
+        with timed('query'):
+            df = pd.read_sql( qry, conn, params = params )
+    
+    if threshold_values is not None:
+        df = set_threshold_values(df, threshold_values)
+    
+    return df
+
+
+def iter_raw_wq_data(conn, sitename = None, firstbmp = None, lastbmp = None, bmptype = None, analytes = None, chunksize = RAWDATA_CHUNKSIZE):
+    """
+    Same query as get_raw_wq_data, but handed back as a generator of dataframes of at most chunksize rows
+    The rows come off a server side cursor (stream_results), so the full result is never held in memory - for the downloads
+    
+    conn has to be an engine here - the generator checks out its own connection and keeps it until the last chunk has been read
+    The arguments are validated right away, not when the first chunk is asked for, so a bad sitename still fails before a response starts
+    """
+    analytes = _validate_raw_wq_args(conn, sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp, bmptype = bmptype, analytes = analytes)
+    
+    if USE_SNAPSHOT:
+        # already in memory - just hand it out in pieces
+        df = raw_snapshot.raw_wq_data(conn, sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp, bmptype = bmptype, analytes = analytes)
+        return (df.iloc[start:start + chunksize] for start in range(0, len(df), chunksize))
+    
+    qry, params = build_raw_wq_query(conn, sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp, bmptype = bmptype, analytes = analytes)
+    
+    def chunks():
+        with conn.connect() as connection:
+            connection = connection.execution_options(stream_results = True, max_row_buffer = chunksize)
+            for chunk in pd.read_sql( qry, connection, params = params, chunksize = chunksize ):
+                yield chunk
+    
+    return chunks()
+
+
+def _validate_raw_wq_args(conn, sitename = None, firstbmp = None, lastbmp = None, bmptype = None, threshold_values = None, analytes = None):
+    # Checks the arguments of get_raw_wq_data against the catalog, and returns the list of analytes to query (None for all of them)
     assert not all([x is None for x in [sitename, firstbmp, lastbmp, bmptype]]), "sitename and bmp names OR bmptype, must be provided to query the water quality data"
     
+    # valid values come from the in memory catalog rather than DISTINCT queries against the view
+    # so once the catalog is loaded, the data query itself is the only round trip get_raw_wq_data makes
     if bmptype is None:
-        valid_sitenames = pd.read_sql(f"SELECT DISTINCT sitename FROM vw_mashup_index_comparison_rawdata ORDER BY 1", conn).sitename.values
-        valid_firstbmps = pd.read_sql(f"SELECT DISTINCT firstbmp FROM vw_mashup_index_comparison_rawdata ORDER BY 1", conn).firstbmp.values
-        valid_lastbmps = pd.read_sql(f"SELECT DISTINCT lastbmp FROM vw_mashup_index_comparison_rawdata ORDER BY 1", conn).lastbmp.values
+        valid_sitenames = rawdata_catalog.values(conn, 'sitename')
+        valid_firstbmps = rawdata_catalog.values(conn, 'firstbmp')
+        valid_lastbmps = rawdata_catalog.values(conn, 'lastbmp')
         
         assert sitename in valid_sitenames, f"sitename {sitename} not found in list of valid sitenames (distinct sitenames in the water quality table)"
         assert (firstbmp in valid_firstbmps) or (firstbmp is None), f"firstbmp {firstbmp} not found in list of valid firstbmps (distinct firstbmps in the water quality table)"
         assert (lastbmp in valid_lastbmps) or (lastbmp is None), f"lastbmp {lastbmp} not found in list of valid lastbmps (distinct lastbmps in the water quality table)"
-        
-        qry = f"""
-            SELECT sitename, firstbmp, lastbmp, analyte, inflow_emc, outflow_emc, inflow_emc_unit AS unit FROM vw_mashup_index_comparison_rawdata WHERE sitename = '{sitename}'
-        """
-        
-        if firstbmp is not None:
-            qry += f" AND firstbmp = '{firstbmp}'"
-        if lastbmp is not None:
-            qry += f" AND lastbmp = '{lastbmp}'"
             
     else:
-        valid_bmptypes = pd.read_sql(f"SELECT DISTINCT bmptype FROM vw_mashup_index_comparison_rawdata ORDER BY 1", conn).bmptype.values
+        valid_bmptypes = rawdata_catalog.values(conn, 'bmptype')
         assert bmptype in valid_bmptypes, f"bmptype {bmptype} not found in list of valid bmptypes (distinct bmptypes in the water quality table)"
-        
-        qry = f"SELECT firstbmptype AS bmptype, analyte, inflow_emc, outflow_emc, inflow_emc_unit AS unit FROM vw_mashup_index_comparison_rawdata WHERE firstbmptype = '{bmptype}'"
     
-    valid_analytes = pd.read_sql(f"SELECT DISTINCT analyte FROM vw_mashup_index_comparison_rawdata", conn).analyte.tolist()
+    valid_analytes = rawdata_catalog.values(conn, 'analyte')
     
     
     if threshold_values is not None:
         assert isinstance(threshold_values, dict), "threshold_values argument must be a dictionary whose keys are analyte names, and values are arbitrary threshold values set by a user"
         assert \
-            set(threshold_values.keys()).issubset(set(valid_analytes)), \
-            f"Analyte(s) from thresh values {set(threshold_values.keys()) - set(valid_analytes)} not found in the list of valid analytes (distinct analytes in the wq table)"
+            set(threshold_values.keys()).issubset(valid_analytes), \
+            f"Analyte(s) from thresh values {set(threshold_values.keys()) - valid_analytes} not found in the list of valid analytes (distinct analytes in the wq table)"
         
-        qry += " AND analyte IN ('{}')".format("','".join(threshold_values.keys()))
+        analytes = list(threshold_values.keys())
         
-    # pretty much this next code block is probably not going to get used....
+    # threshdata uses this - it queries the analytes once and applies the thresholds for each percentile afterwards with set_threshold_values
     elif analytes is not None:
-        assert set(analytes).issubset(set(valid_analytes)), f"Analyte(s) {set(analytes) - set(valid_analytes)} not found in the list of valid analytes (distinct analytes in the wq table)"
-        
-        qry += " AND analyte IN ('{}')".format("','".join(analytes))
-        
-        
-    df = pd.read_sql( qry, conn )
+        assert set(analytes).issubset(valid_analytes), f"Analyte(s) {set(analytes) - valid_analytes} not found in the list of valid analytes (distinct analytes in the wq table)"
     
-    if threshold_values is not None:
-        # sets the threshold column according to the values specified in the dictionary
-        df['threshold'] = df.analyte.apply(lambda analytename: threshold_values.get(analytename).get('threshold_value'))
-        df['threshold_unit'] = df.analyte.apply(lambda analytename: threshold_values.get(analytename).get('unit'))
+    return analytes
+
+
+def set_threshold_values(df, threshold_values):
+    # sets the threshold and threshold_unit columns according to the values specified in the dictionary
+    # threshold_values is the same dictionary get_raw_wq_data takes - keys are analyte names, values are dictionaries with threshold_value and unit
+    # Returns a new dataframe, so the same raw data can be reused with different sets of thresholds without querying it again
+    assert isinstance(threshold_values, dict), "threshold_values argument must be a dictionary whose keys are analyte names, and values are arbitrary threshold values set by a user"
     
-    return df
+    return df.assign(
+        threshold = df.analyte.map({k: v.get('threshold_value') for k, v in threshold_values.items()}),
+        threshold_unit = df.analyte.map({k: v.get('unit') for k, v in threshold_values.items()})
+    )
 
 
-def fix_thresh_units(df):
+# Different spellings of the same unit - these get replaced with the canonical spelling before converting
+UNIT_ALIASES = {
+    'μg/L'       : 'ug/L',  # greek mu
+    'µg/L'       : 'ug/L',  # micro sign
+    'MPN/100 mL' : 'MPN/100mL',
+    'CFU/100 mL' : 'CFU/100mL',
+}
+
+# How to convert a threshold from the unit it was given in (first) to the unit of the data (second)
+# values are (multiply by, divide by) rather than a single factor, so that converting a threshold gives exactly the same float
+# as the old hard coded threshold / 1000 and threshold * 1000 did
+# Same unit to same unit never needs an entry - add any other pairs that show up in the data here
+UNIT_CONVERSION_FACTORS = {
+    ('ug/L', 'mg/L') : (1, 1000),
+    ('mg/L', 'ug/L') : (1000, 1),
+    ('ng/L', 'ug/L') : (1, 1000),
+    ('ug/L', 'ng/L') : (1000, 1),
+    ('ng/L', 'mg/L') : (1, 1000000),
+    ('mg/L', 'ng/L') : (1000000, 1),
+}
+
+
+def fix_thresh_units(df, on_unknown = 'warn'):
+    # Converts the threshold column into the same units as the data, then drops the threshold_unit column
+    # Unit pairs without an entry in UNIT_CONVERSION_FACTORS leave the threshold empty (NaN)
+    # on_unknown says what to do about those - "warn" logs them all in one warning, "raise" raises a ValueError, "ignore" does nothing
     required_cols = ['unit', 'threshold_unit', 'threshold']
     assert set(required_cols).issubset(set(df.columns)), f"in fix thresh units function {','.join(required_cols)} not found in columns of data frame"
+    assert on_unknown in ('warn', 'raise', 'ignore'), f"on_unknown must be warn, raise or ignore, not {on_unknown}"
     
-    df = df.replace('μg/L','ug/L')
-    df['threshold'] = df.apply(
-        lambda row: 
-            row.threshold 
-            if row.unit == row.threshold_unit
-            else (row.threshold / 1000) if ((row.unit == 'mg/L') and (row.threshold_unit == 'ug/L'))
-            else (row.threshold * 1000) if ((row.unit == 'ug/L') and (row.threshold_unit == 'mg/L'))
-            else pd.NA
-        ,axis = 1
+    df = df.assign(
+        unit = df.unit.replace(UNIT_ALIASES),
+        threshold_unit = df.threshold_unit.replace(UNIT_ALIASES)
     )
     
+    # There are only ever a few distinct (threshold unit, data unit) pairs, so the lookup is done once per pair
+    # and every row just picks up its pair's factor by integer code
+    pair_codes, pairs = pd.MultiIndex.from_arrays([df.threshold_unit, df.unit]).factorize()
+    
+    multiply_by = np.full(len(pairs), np.nan)
+    divide_by = np.ones(len(pairs))
+    unknown_pairs = []
+    for i, (threshold_unit, unit) in enumerate(pairs):
+        if (threshold_unit == unit) and pd.notnull(unit):
+            multiply_by[i] = 1
+        elif (threshold_unit, unit) in UNIT_CONVERSION_FACTORS:
+            multiply_by[i], divide_by[i] = UNIT_CONVERSION_FACTORS[(threshold_unit, unit)]
+        else:
+            unknown_pairs.append((threshold_unit, unit))
+    
+    # rows with a missing unit get a code of -1 from factorize
+    multiply_by = np.append(multiply_by, np.nan)
+    divide_by = np.append(divide_by, 1)
+    
+    threshold = pd.to_numeric(df.threshold, errors = 'coerce').to_numpy(dtype = float, na_value = np.nan)
+    df['threshold'] = threshold * multiply_by[pair_codes] / divide_by[pair_codes]
+    
+    unconverted = np.isnan(multiply_by[pair_codes])
+    if unconverted.any():
+        analytes = sorted(df.analyte[unconverted].astype(str).unique()) if 'analyte' in df.columns else []
+        msg = \
+            f"No unit conversion for (threshold unit, data unit) pair(s) {unknown_pairs} - " \
+            f"thresholds left empty for {unconverted.sum()} rows" + \
+            (f" (analytes {', '.join(analytes)})" if len(analytes) > 0 else "")
+        if on_unknown == 'raise':
+            raise ValueError(msg)
+        if on_unknown == 'warn':
+            logger.warning(msg)
+    
     df.drop('threshold_unit', axis = 'columns', inplace = True)
     
     return df
-
@@ -0,0 +1,86 @@
+import os, time, threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import request, has_request_context
+
+# Upper bounds (seconds) of the histogram buckets - comma separated in the environment
+METRICS_BUCKETS = tuple(
+    float(b) for b in os.environ.get('METRICS_BUCKETS', '0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30').split(',')
+)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """
+    Prometheus style histogram - one set of bucket counts, a sum and a count for each combination of label values
+    Everything is per worker process (each uwsgi worker keeps its own), so prometheus should scrape the workers individually,
+    or the numbers should be read as a sample of the traffic
+    """
+
+    def __init__(self, name, description, labelnames, buckets = METRICS_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(l, '')) for l in self.labelnames)
+        # counts are kept per bucket, and made cumulative when rendered (the last slot is +Inf)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                labels = ','.join(f'{l}="{_escape(v)}"' for l, v in zip(self.labelnames, key))
+                cumulative = 0
+                for bound, count in zip([*self.buckets, '+Inf'], series["counts"]):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else repr(float(bound))
+                    lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f"{self.name}_sum{{{labels}}} {series['sum']!r}")
+                lines.append(f"{self.name}_count{{{labels}}} {series['count']}")
+        return lines
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Time spent handling a request, by route',
+    ['route', 'method', 'status']
+)
+
+stage_duration = Histogram(
+    'pipeline_stage_duration_seconds', 'Time spent in each stage of a route (validation, queries, wq_index, weights, serialization, excel)',
+    ['route', 'stage']
+)
+
+
+@contextmanager
+def timed(stage):
+    # with timed('wq_index'): ... - records how long the block took under the current route
+    route = request.endpoint if has_request_context() else 'none'
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_duration.observe(time.perf_counter() - start, route = route, stage = stage)
+
+
+def render_metrics():
+    # All the histograms in the prometheus text exposition format
+    lines = []
+    for histogram in (request_duration, stage_duration):
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,274 @@
+import os
+from sqlalchemy import table, column, select, func, bindparam, any_, true, String, Float
+from sqlalchemy.dialects.postgresql import ARRAY
+
+# Every query the app runs against the data, written once with sqlalchemy core
+# so the same functions work against Postgres (production) or an embedded DuckDB file built by export_duckdb (offline sweeps, local testing)
+# - point DB_CONNECTION_STRING at duckdb:////path/to/file.duckdb for the latter
+#
+# Each builder returns (query, params) - the query only has bound parameters in it, never values, so it goes straight to pd.read_sql( query, conn, params = params )
+
+
+rawdata_view = table(
+    'vw_mashup_index_comparison_rawdata',
+    column('sitename', String),
+    column('firstbmp', String),
+    column('lastbmp', String),
+    column('firstbmptype', String),
+    column('analyte', String),
+    column('inflow_emc', Float),
+    column('outflow_emc', Float),
+    column('inflow_emc_unit', String),
+)
+
+lu_bmptype = table(
+    'lu_bmptype',
+    column('bmpcode', String),
+    column('bmpcategory', String),
+)
+
+
+def analysis_table(analysistype):
+    # analysis_wq or analysis_hydrology - the routes check analysistype before this gets called
+    assert analysistype in ('wq', 'hydrology'), "analysistype must be wq or hydrology"
+    return table(f"analysis_{analysistype}", column('sitename', String), column('firstbmp', String), column('lastbmp', String))
+
+
+# Dialects that take a list as a single array parameter
+ARRAY_PARAM_DIALECTS = ('postgresql', 'duckdb')
+
+
+def in_list(conn, col, name):
+    # col = ANY(:name) where there are array parameters - the SQL is the same whatever the number of values, so the database can reuse its plan
+    # anything else (sqlite) gets a regular IN ( ... ) list
+    if conn.dialect.name in ARRAY_PARAM_DIALECTS:
+        return col == any_(bindparam(name, type_ = ARRAY(String)))
+    return col.in_(bindparam(name, expanding = True))
+
+
+def scope_filter(sitename = None, firstbmp = None, bmptype = None):
+    # The rows of a site/firstbmp, or of a bmptype - the filter /threshval, /percentileval, their batch versions and the EMC index use
+    # (no sitename and no bmptype means every row)
+    v = rawdata_view.c
+    if bmptype is not None:
+        return v.firstbmptype == bindparam('bmptype'), {"bmptype": bmptype}
+    if sitename is not None:
+        return (v.sitename == bindparam('sitename')) & (v.firstbmp == bindparam('firstbmp')), {"sitename": sitename, "firstbmp": firstbmp}
+    return true(), {}
+
+
+def sitenames_query(analysistype = 'wq'):
+    t = analysis_table(analysistype)
+    return select(t.c.sitename).distinct().order_by(t.c.sitename), {}
+
+
+def bmpnames_query(analysistype = 'wq', bmpplacement = 'first', sitename = None):
+    t = analysis_table(analysistype)
+    bmpcol = t.c[f"{bmpplacement}bmp"]
+    qry = select(bmpcol.label('bmpname')).distinct().order_by(bmpcol)
+    if sitename is None:
+        return qry, {}
+    return qry.where(t.c.sitename == bindparam('sitename')), {"sitename": sitename}
+
+
+def bmptypes_query():
+    return select(lu_bmptype.c.bmpcode, lu_bmptype.c.bmpcategory).order_by(lu_bmptype.c.bmpcode), {}
+
+
+def analytes_query(sitename = None, firstbmp = None, lastbmp = None, bmptype = None):
+    # distinct analyte/unit pairs for a site/bmp combination, or for a bmptype
+    v = rawdata_view.c
+    qry = select(v.analyte.label('analytename'), v.inflow_emc_unit.label('unit')).distinct().order_by(v.analyte)
+    if bmptype is not None:
+        return qry.where(v.firstbmptype == bindparam('bmptype')), {"bmptype": bmptype}
+    return (
+        qry.where((v.sitename == bindparam('sitename')) & (v.firstbmp == bindparam('firstbmp')) & (v.lastbmp == bindparam('lastbmp'))),
+        {"sitename": sitename, "firstbmp": firstbmp, "lastbmp": lastbmp}
+    )
+
+
+def threshval_query(analyte, percentile, inflow_or_outflow = 'inflow', sitename = None, firstbmp = None, bmptype = None):
+    # the EMC at a percentile of an analyte's rows
+    v = rawdata_view.c
+    where, params = scope_filter(sitename = sitename, firstbmp = firstbmp, bmptype = bmptype)
+    qry = select(
+        func.percentile_cont(bindparam('percentile')).within_group(v[f"{inflow_or_outflow}_emc"]).label('threshval')
+    ).where((v.analyte == bindparam('analyte')) & where)
+    return qry, {"analyte": analyte, "percentile": float(percentile), **params}
+
+
+def percentile_rank_query(analyte, threshval, sitename = None, firstbmp = None, bmptype = None):
+    # the share of an analyte's rows with an inflow EMC at or below threshval (null if there are none)
+    v = rawdata_view.c
+    where, params = scope_filter(sitename = sitename, firstbmp = firstbmp, bmptype = bmptype)
+    # (cume_dist is typed as Float - sqlalchemy would treat it as Numeric, and hand it back rounded to 10 decimal places)
+    ranked = select(
+        v.inflow_emc,
+        func.cume_dist(type_ = Float).over(order_by = v.inflow_emc).label('cumulative_distribution')
+    ).where((v.analyte == bindparam('analyte')) & where).cte('RankedValues')
+
+    qry = select(func.max(ranked.c.cumulative_distribution).label('percentile_rank')).where(ranked.c.inflow_emc <= bindparam('threshval'))
+    return qry, {"analyte": analyte, "threshval": float(threshval), **params}
+
+
+def threshvals_batch_query(conn, pairs, inflow_or_outflow = 'inflow', sitename = None, firstbmp = None, bmptype = None):
+    # One PERCENTILE_CONT column per (analyte, percentile) pair, all in one grouped query
+    # column threshval_i is only read back off of analyte i's row
+    v = rawdata_view.c
+    where, params = scope_filter(sitename = sitename, firstbmp = firstbmp, bmptype = bmptype)
+    emc = v[f"{inflow_or_outflow}_emc"]
+
+    cols = []
+    for i, (analyte, percentile) in enumerate(pairs):
+        cols.append(func.percentile_cont(bindparam(f"percentile_{i}")).within_group(emc).label(f"threshval_{i}"))
+        params[f"percentile_{i}"] = float(percentile)
+
+    qry = select(v.analyte, *cols).where(where & in_list(conn, v.analyte, 'analytes')).group_by(v.analyte)
+    return qry, {**params, "analytes": [analyte for analyte, _ in pairs]}
+
+
+def percentile_ranks_batch_query(conn, pairs, inflow_or_outflow = 'inflow', sitename = None, firstbmp = None, bmptype = None):
+    # The percentile rank CUME_DIST gives is the share of the analyte's rows at or below the threshold value
+    # so instead of a window over every row, it is a filtered count (n_below_i) and the total count (n_total)
+    v = rawdata_view.c
+    where, params = scope_filter(sitename = sitename, firstbmp = firstbmp, bmptype = bmptype)
+    emc = v[f"{inflow_or_outflow}_emc"]
+
+    cols = []
+    for i, (analyte, threshval) in enumerate(pairs):
+        cols.append(func.count().filter(emc <= bindparam(f"threshval_{i}")).label(f"n_below_{i}"))
+        params[f"threshval_{i}"] = float(threshval)
+
+    qry = select(v.analyte, func.count().label('n_total'), *cols).where(where & in_list(conn, v.analyte, 'analytes')).group_by(v.analyte)
+    return qry, {**params, "analytes": [analyte for analyte, _ in pairs]}
+
+
+def thresh_percentiles_query(conn, analytes, percentiles):
+    # inflow EMC percentiles of each analyte over every row in the view - one thresh_<percentile * 100> column per percentile
+    v = rawdata_view.c
+    params = {"analytes": list(analytes)}
+
+    cols = []
+    for i, percentile in enumerate(percentiles):
+        cols.append(func.percentile_cont(bindparam(f"percentile_{i}")).within_group(v.inflow_emc).label(f"thresh_{round(float(percentile) * 100)}"))
+        params[f"percentile_{i}"] = float(percentile)
+
+    return select(v.analyte, *cols).where(in_list(conn, v.analyte, 'analytes')).group_by(v.analyte), params
+
+
+def build_raw_wq_query(conn, sitename = None, firstbmp = None, lastbmp = None, bmptype = None, analytes = None):
+    """
+    Builds the query get_raw_wq_data runs, with every user supplied value passed as a bound parameter
+    Returns the query and the dictionary of parameters to go with it
+
+    The SQL only depends on which arguments were given, not on their values,
+    so Postgres sees a handful of fixed query shapes that it can cache plans for (and that can be prepared server side)
+    The analyte list is sent as a single array parameter (see in_list) for the same reason
+    """
+    v = rawdata_view.c
+    params = dict()
+
+    if bmptype is None:
+        qry = select(v.sitename, v.firstbmp, v.lastbmp, v.analyte, v.inflow_emc, v.outflow_emc, v.inflow_emc_unit.label('unit')) \
+            .where(v.sitename == bindparam('sitename'))
+        params['sitename'] = sitename
+
+        if firstbmp is not None:
+            qry = qry.where(v.firstbmp == bindparam('firstbmp'))
+            params['firstbmp'] = firstbmp
+        if lastbmp is not None:
+            qry = qry.where(v.lastbmp == bindparam('lastbmp'))
+            params['lastbmp'] = lastbmp
+    else:
+        qry = select(v.firstbmptype.label('bmptype'), v.analyte, v.inflow_emc, v.outflow_emc, v.inflow_emc_unit.label('unit')) \
+            .where(v.firstbmptype == bindparam('bmptype'))
+        params['bmptype'] = bmptype
+
+    if analytes is None:
+        return qry, params
+
+    params['analytes'] = list(analytes)
+    return qry.where(in_list(conn, v.analyte, 'analytes')), params
+
+
+def raw_wq_columns(bmptype = None):
+    # The columns build_raw_wq_query selects, and the type of each one - "float" or "string"
+    # The downloads need them even when there are no rows, or when a chunk has nothing but nulls in a column
+    qry, _ = build_raw_wq_query(None, bmptype = bmptype)
+    return {col.name: 'float' if isinstance(col.type, Float) else 'string' for col in qry.selected_columns}
+
+
+def emc_values_query(analyte, sitename = None, firstbmp = None, bmptype = None):
+    # inflow and outflow EMCs of an analyte's rows (what the EMC index sorts)
+    v = rawdata_view.c
+    where, params = scope_filter(sitename = sitename, firstbmp = firstbmp, bmptype = bmptype)
+    return select(v.inflow_emc, v.outflow_emc).where((v.analyte == bindparam('analyte')) & where), {"analyte": analyte, **params}
+
+
+def catalog_query():
+    # every distinct site/bmp/bmptype/analyte/unit combination (the catalog)
+    v = rawdata_view.c
+    return select(
+        v.sitename, v.firstbmp, v.lastbmp, v.firstbmptype.label('bmptype'), v.analyte, v.inflow_emc_unit.label('unit')
+    ).distinct(), {}
+
+
+def snapshot_query():
+    # the whole view, with the columns the in memory snapshot keeps
+    v = rawdata_view.c
+    return select(
+        v.sitename, v.firstbmp, v.lastbmp, v.firstbmptype.label('bmptype'), v.analyte, v.inflow_emc, v.outflow_emc, v.inflow_emc_unit.label('unit')
+    ), {}
+
+
+def export_duckdb(path, conn = None, snapshot_file = None):
+    """
+    Builds an embedded DuckDB file with the tables the queries above read, for DB_CONNECTION_STRING to point at (duckdb:///path)
+
+    The rows come from the database (conn), or from an Arrow snapshot file written by export_snapshot.py - so a copy of the data
+    can be made and used without a connection to the database at all
+    Only the columns the queries use are copied (and only the water quality analysis table)
+    From a snapshot file, the rows are in the snapshot's order (sorted by site), analysis_wq is the distinct site/bmp combinations of the view,
+    and lu_bmptype only has the bmp codes (no categories)
+    It is written under a temporary name and renamed over path, like the snapshot file
+    """
+    import duckdb
+    import pandas as pd
+
+    assert (conn is None) != (snapshot_file is None), "Give either a database connection or a snapshot file to build the DuckDB file from"
+
+    if snapshot_file is not None:
+        import pyarrow as pa
+        rawdata = pa.ipc.open_file(pa.memory_map(snapshot_file, 'r')).read_all().to_pandas()
+        rawdata = rawdata.rename(columns = {'bmptype': 'firstbmptype', 'unit': 'inflow_emc_unit'})
+        rawdata = rawdata.astype({c: object for c in rawdata.columns if isinstance(rawdata[c].dtype, pd.CategoricalDtype)})
+        sites = None
+        bmptypes = None
+    else:
+        analysis_wq = analysis_table('wq')
+        rawdata = pd.read_sql(select(*rawdata_view.c), conn)
+        sites = pd.read_sql(select(analysis_wq.c.sitename, analysis_wq.c.firstbmp, analysis_wq.c.lastbmp).distinct(), conn)
+        bmptypes = pd.read_sql(select(*lu_bmptype.c), conn)
+
+    rawdata = rawdata[[c.name for c in rawdata_view.c]]
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    con = duckdb.connect(tmp_path)
+    try:
+        con.register('rawdata', rawdata)
+        con.execute("CREATE TABLE vw_mashup_index_comparison_rawdata AS SELECT * FROM rawdata")
+        if sites is not None:
+            con.register('sites', sites)
+            con.execute("CREATE TABLE analysis_wq AS SELECT * FROM sites")
+            con.register('bmptypes', bmptypes)
+            con.execute("CREATE TABLE lu_bmptype AS SELECT * FROM bmptypes")
+        else:
+            con.execute("CREATE TABLE analysis_wq AS SELECT DISTINCT sitename, firstbmp, lastbmp FROM vw_mashup_index_comparison_rawdata")
+            con.execute(
+                "CREATE TABLE lu_bmptype AS SELECT DISTINCT firstbmptype AS bmpcode, CAST(NULL AS VARCHAR) AS bmpcategory FROM vw_mashup_index_comparison_rawdata WHERE firstbmptype IS NOT NULL"
+            )
+    finally:
+        con.close()
+    os.replace(tmp_path, path)
+
+    return len(rawdata)
@@ -0,0 +1,116 @@
+import os, time, json, hashlib, threading
+from functools import wraps
+from collections import OrderedDict
+
+from flask import request, g, current_app
+
+from .versioning import get_data_version
+
+# Whether /direct-comparison-data and /thresh-comparison-data keep their responses around for identical requests
+USE_RESULT_CACHE = os.environ.get('USE_RESULT_CACHE', 'true').lower() in ('1', 'true', 'yes')
+
+# How long (seconds) a stored response is good for, even if the data version has not changed
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 3600))
+
+# Maximum number of stored responses (per worker process) - the least recently used go first
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 512))
+
+
+class ResultCache:
+    """
+    Responses of the comparison routes, keyed by a hash of (route, posted payload, data version)
+
+    Those routes are a pure function of what gets posted and of the data, so an identical request
+    gets the stored response body back without any SQL, wq_index or AHP
+    The payload is hashed as canonical JSON (sorted keys, no whitespace), so key order in the request does not matter
+    Only successful JSON responses are stored - errors always go through to the route
+    """
+
+    def __init__(self, ttl = RESULT_CACHE_TTL, max_entries = RESULT_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    @staticmethod
+    def key(route, payload, version):
+        canonical = json.dumps(payload, sort_keys = True, separators = (',', ':'), default = str)
+        return hashlib.sha256(f"{route}\n{version}\n{canonical}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        # returns the stored (body, mimetype), or None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            body, mimetype, elapsed, stored_at = entry
+            if (time.monotonic() - stored_at) >= self.ttl:
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # what the request took to compute the first time is the time this hit saved
+            self.seconds_saved += elapsed
+            return body, mimetype
+
+    def put(self, key, body, mimetype, elapsed):
+        with self._lock:
+            self._entries[key] = (body, mimetype, elapsed, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+    def cached(self, f):
+        # decorator for a route that takes a JSON payload - goes under the @blueprint.route decorator
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            payload = request.get_json(silent = True)
+            if (not USE_RESULT_CACHE) or (payload is None):
+                return f(*args, **kwargs)
+
+            key = self.key(request.path, payload, get_data_version(g.eng))
+            stored = self.get(key)
+            if stored is not None:
+                body, mimetype = stored
+                return current_app.response_class(body, mimetype = mimetype)
+
+            start = time.perf_counter()
+            # routes return a response or a (response, status) tuple - make_response turns either into a response object
+            rv = current_app.make_response(f(*args, **kwargs))
+            elapsed = time.perf_counter() - start
+
+            if (rv.status_code == 200) and rv.is_json:
+                self.put(key, rv.get_data(), rv.mimetype, elapsed)
+
+            return rv
+
+        return wrapper
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries"         : len(self._entries),
+                "max_entries"     : self.max_entries,
+                "ttl"             : self.ttl,
+                "bytes"           : sum(len(body) for body, _, _, _ in self._entries.values()),
+                "hits"            : self.hits,
+                "misses"          : self.misses,
+                "hit_ratio"       : round(self.hits / lookups, 4) if lookups > 0 else 0,
+                "seconds_saved"   : round(self.seconds_saved, 6),
+            }
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# One cache per worker process
+result_cache = ResultCache()
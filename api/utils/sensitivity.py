@@ -0,0 +1,111 @@
+import os, math, itertools, threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from .funcs import calc_ahp_weights_batch, calc_ranksum_weights_batch, mashup_index_batch
+
+# Every ranking gets evaluated as long as there are no more than this many of them (9! by default)
+# past that, a random sample of SWEEP_SAMPLE_SIZE rankings is used instead
+SWEEP_MAX_PERMUTATIONS = int(os.environ.get('SWEEP_MAX_PERMUTATIONS', math.factorial(9)))
+SWEEP_SAMPLE_SIZE = int(os.environ.get('SWEEP_SAMPLE_SIZE', 100000))
+
+# Number of processes to split the rankings across - 1 means do it all in the worker handling the request
+SWEEP_WORKERS = int(os.environ.get('SWEEP_WORKERS', 1))
+
+# Rankings are scored this many at a time, which keeps the weight arrays from getting too big
+SWEEP_CHUNK_SIZE = int(os.environ.get('SWEEP_CHUNK_SIZE', 50000))
+
+SWEEP_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+# One process pool per worker process, started the first time a sweep needs it and reused by every sweep after that
+# (it is sized by the first call - SWEEP_WORKERS unless that call says otherwise)
+# (same idea as get_engine in api/db.py - a pool inherited from the parent process belongs to the parent, so a forked child starts its own)
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def rank_permutations(n, max_permutations = SWEEP_MAX_PERMUTATIONS, sample_size = SWEEP_SAMPLE_SIZE, seed = None):
+    # Returns a 2D array of rankings (one row per ranking, ranks 1 through n) and whether it is every possible ranking or a sample
+    if math.factorial(n) <= max_permutations:
+        rankings = np.fromiter(
+            itertools.chain.from_iterable(itertools.permutations(range(1, n + 1))),
+            dtype = np.int16,
+            count = math.factorial(n) * n
+        ).reshape(-1, n)
+        return rankings, True
+    
+    rng = np.random.default_rng(seed)
+    rankings = rng.permuted(np.tile(np.arange(1, n + 1, dtype = np.int16), (sample_size, 1)), axis = 1)
+    return rankings, False
+
+
+def score_rankings(scores, rankings):
+    # AHP and rank sum mashup scores of one set of individual analyte scores, under every ranking in the rankings array
+    ahp = mashup_index_batch(scores, calc_ahp_weights_batch(rankings))
+    ranksum = mashup_index_batch(scores, calc_ranksum_weights_batch(rankings))
+    return ahp, ranksum
+
+
+def _score_chunk(args):
+    # top level function so that it can be sent to the process pool
+    scores, rankings = args
+    return score_rankings(scores, rankings)
+
+
+def get_sweep_pool(workers = SWEEP_WORKERS):
+    global _pool, _pool_pid
+
+    if (_pool is not None) and (_pool_pid == os.getpid()):
+        return _pool
+
+    with _pool_lock:
+        if (_pool is not None) and (_pool_pid == os.getpid()):
+            return _pool
+
+        # an inherited pool's processes are the parent's children - just drop the reference, do not shut it down from here
+        _pool = ProcessPoolExecutor(max_workers = workers)
+        _pool_pid = os.getpid()
+
+    return _pool
+
+
+def summarize_distribution(values, quantiles = SWEEP_QUANTILES, decimals = 4):
+    summary = {
+        "min"  : round(float(np.min(values)), decimals),
+        "max"  : round(float(np.max(values)), decimals),
+        "mean" : round(float(np.mean(values)), decimals),
+        "std"  : round(float(np.std(values)), decimals),
+    }
+    for q, v in zip(quantiles, np.quantile(values, quantiles)):
+        summary[f"q{round(q * 100):02d}"] = round(float(v), decimals)
+    return summary
+
+
+def rank_sensitivity(scores, workers = SWEEP_WORKERS, chunk_size = SWEEP_CHUNK_SIZE, seed = None):
+    """
+    How much the AHP and Rank Sum mashup scores move around across all the possible rankings of the analytes
+    scores is the list (or array) of individual analyte performance index scores
+    
+    Returns the summary of the AHP score, the Rank Sum score and their difference (AHP - Rank Sum) over the rankings
+    """
+    scores = np.asarray(scores, dtype = float)
+    rankings, exhaustive = rank_permutations(len(scores), seed = seed)
+    
+    chunks = [(scores, rankings[i:i + chunk_size]) for i in range(0, len(rankings), chunk_size)]
+    
+    if (workers > 1) and (len(chunks) > 1):
+        results = list(get_sweep_pool(workers).map(_score_chunk, chunks))
+    else:
+        results = [_score_chunk(c) for c in chunks]
+    
+    ahp = np.concatenate([r[0] for r in results])
+    ranksum = np.concatenate([r[1] for r in results])
+    
+    return {
+        "n_rankings"           : int(len(rankings)),
+        "exhaustive"           : exhaustive,
+        "ahp_mashup_score"     : summarize_distribution(ahp),
+        "ranksum_mashup_score" : summarize_distribution(ranksum),
+        "difference"           : summarize_distribution(ahp - ranksum),
+    }
@@ -0,0 +1,268 @@
+import os, time, threading, logging
+import numpy as np
+import pandas as pd
+
+from .versioning import get_data_version
+from .queries import snapshot_query
+
+logger = logging.getLogger(__name__)
+
+# Arrow IPC file written by export_snapshot.py - if it is set, workers map this file instead of loading the view from the database
+# Every worker maps the same file, so the data sits in the page cache once, not once per uwsgi worker
+SNAPSHOT_FILE = os.environ.get('SNAPSHOT_FILE')
+
+# Whether get_raw_wq_data, /analytes and the EMC index read from an in memory copy of vw_mashup_index_comparison_rawdata
+# instead of querying it every time (off by default, unless there is a snapshot file)
+USE_SNAPSHOT = os.environ.get('USE_SNAPSHOT', 'true' if SNAPSHOT_FILE else 'false').lower() in ('1', 'true', 'yes')
+
+# How often (seconds) the background thread checks the data version to see if the snapshot needs to be reloaded
+SNAPSHOT_REFRESH_INTERVAL = float(os.environ.get('SNAPSHOT_REFRESH_INTERVAL', 300))
+
+# the text columns - stored as pandas categoricals (small integer codes plus one copy of each distinct string)
+SNAPSHOT_CATEGORY_COLUMNS = ['sitename', 'firstbmp', 'lastbmp', 'bmptype', 'analyte', 'unit']
+
+# the columns get_raw_wq_data returns, for a site/bmp query and for a bmptype query (same as build_raw_wq_query in queries.py)
+SITE_COLUMNS = ['sitename', 'firstbmp', 'lastbmp', 'analyte', 'inflow_emc', 'outflow_emc', 'unit']
+BMPTYPE_COLUMNS = ['bmptype', 'analyte', 'inflow_emc', 'outflow_emc', 'unit']
+
+
+def read_snapshot_frame(conn):
+    # The view, with the text columns as categoricals, sorted the way RawDataSnapshot needs it
+    qry, params = snapshot_query()
+    frame = pd.read_sql(qry, conn, params = params)
+    for col in SNAPSHOT_CATEGORY_COLUMNS:
+        frame[col] = frame[col].astype('category')
+
+    # stable sort so rows within a site stay in the order the view gave them
+    return frame.sort_values(['sitename', 'firstbmp', 'lastbmp'], kind = 'stable').reset_index(drop = True)
+
+
+def export_snapshot(conn, path):
+    """
+    Writes the view to an Arrow IPC file that RawDataSnapshot can memory map (see SNAPSHOT_FILE)
+
+    The rows are already sorted, the text columns are dictionary encoded, and the EMC columns keep NaN rather than a null bitmap
+    so that pandas can use the mapped float buffers as they are, without copying them
+    It is written under a temporary name and renamed over path, so workers only ever see a complete file - they pick up the new one on their next check
+    """
+    import pyarrow as pa
+
+    frame = read_snapshot_frame(conn)
+    version = get_data_version(conn, max_age = 0)
+
+    table = pa.table({
+        col: (pa.array(frame[col]) if col in SNAPSHOT_CATEGORY_COLUMNS else pa.array(frame[col].to_numpy(dtype = float), from_pandas = False))
+        for col in frame.columns
+    })
+    table = table.replace_schema_metadata({'data_version': str(version)})
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            # one record batch, so each column is one contiguous buffer in the file
+            writer.write_table(table, max_chunksize = max(len(table), 1))
+    os.replace(tmp_path, path)
+
+    return len(table)
+
+
+def _file_id(path):
+    # changes when a new file is renamed into place
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+def _group_offsets(frame, columns):
+    # frame has to be sorted on columns already - returns { key: (start, stop) } for each run of rows with the same values
+    # (the key is the value itself for one column, a tuple for several)
+    if len(frame) == 0:
+        return dict()
+
+    codes = np.column_stack([frame[c].cat.codes.to_numpy() for c in columns])
+    starts = np.concatenate([[0], np.flatnonzero(np.any(codes[1:] != codes[:-1], axis = 1)) + 1])
+    stops = np.concatenate([starts[1:], [len(frame)]])
+
+    keys = zip(*[frame[c].to_numpy()[starts] for c in columns]) if len(columns) > 1 else frame[columns[0]].to_numpy()[starts]
+    return {
+        (tuple(k) if len(columns) > 1 else k): (int(start), int(stop))
+        for k, start, stop in zip(keys, starts, stops)
+    }
+
+
+class RawDataSnapshot:
+    """
+    The whole of vw_mashup_index_comparison_rawdata, held in memory as one columnar dataframe
+
+    The rows are sorted by sitename, firstbmp, lastbmp, and the start/stop row of every sitename, (sitename, firstbmp)
+    and (sitename, firstbmp, lastbmp) is worked out when it loads, so getting a site's rows is a slice rather than a query
+    bmptype gets the same treatment through a second row order, sorted by bmptype
+
+    It is loaded the first time it is needed. After that a background thread checks the data version every SNAPSHOT_REFRESH_INTERVAL seconds,
+    and when it has changed, builds a new snapshot and swaps it in - requests keep using the old one until the new one is complete
+    With a snapshot file (SNAPSHOT_FILE), the file is memory mapped instead of querying the view, and the thread watches for a new file instead
+    """
+
+    def __init__(self, refresh_interval = SNAPSHOT_REFRESH_INTERVAL, path = SNAPSHOT_FILE):
+        self.refresh_interval = refresh_interval
+        self.path = path
+        self._state = None
+        self._lock = threading.Lock()
+        self._engine = None
+        self._refresher_pid = None
+        self.refreshes = 0
+
+    def _load(self, conn, version):
+        return self._index(read_snapshot_frame(conn), version)
+
+    def _load_file(self, path):
+        # Maps the exported file - nothing is read from the database
+        import pyarrow as pa
+
+        file_id = _file_id(path)
+        mapped = pa.memory_map(path, 'r')
+        table = pa.ipc.open_file(mapped).read_all()
+        # the float columns point straight at the mapped pages (split_blocks keeps pandas from consolidating them into a copy)
+        frame = table.to_pandas(split_blocks = True)
+
+        state = self._index(frame, (table.schema.metadata or {}).get(b'data_version', b'').decode('utf-8'))
+        state['file_id'] = file_id
+        # the mapping has to stay open as long as the frame is in use - it goes with the state, and closes when the state is dropped
+        state['mapped'] = mapped
+        return state
+
+    def _index(self, frame, version):
+        # frame has to be sorted by sitename, firstbmp, lastbmp already
+        bmptype_order = np.argsort(frame['bmptype'].cat.codes.to_numpy(), kind = 'stable')
+
+        return {
+            "frame"             : frame,
+            "version"           : version,
+            "loaded_at"         : time.time(),
+            "site_offsets"      : _group_offsets(frame, ['sitename']),
+            "sitebmp_offsets"   : _group_offsets(frame, ['sitename', 'firstbmp']),
+            "sitebmps_offsets"  : _group_offsets(frame, ['sitename', 'firstbmp', 'lastbmp']),
+            "bmptype_order"     : bmptype_order,
+            "bmptype_offsets"   : _group_offsets(frame.iloc[bmptype_order], ['bmptype']),
+        }
+
+    def state(self, conn):
+        self._start_refresher(conn)
+
+        state = self._state
+        if state is not None:
+            return state
+
+        with self._lock:
+            if self._state is None:
+                if self.path is not None:
+                    self._state = self._load_file(self.path)
+                else:
+                    self._state = self._load(conn, get_data_version(conn))
+            return self._state
+
+    def _start_refresher(self, conn):
+        # one refresh thread per worker process - under uwsgi the workers are forked, and threads do not survive a fork
+        if self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._engine = conn
+            self._refresher_pid = os.getpid()
+            threading.Thread(target = self._refresh_loop, name = 'rawdata-snapshot-refresh', daemon = True).start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception:
+                # keep serving the snapshot we have - the next check will try again
+                logger.exception("Error refreshing the raw data snapshot")
+
+    def refresh(self, force = False):
+        # reloads the snapshot if the data version has changed (or if force is True)
+        # with a snapshot file, it is reloaded when a new file has been renamed into place instead
+        if self.path is not None:
+            state = self._state
+            if (not force) and (state is not None) and (state.get('file_id') == _file_id(self.path)):
+                return False
+            self._state = self._load_file(self.path)
+            self.refreshes += 1
+            return True
+
+        version = get_data_version(self._engine, max_age = 0)
+        state = self._state
+        if (not force) and (state is not None) and (state['version'] == version):
+            return False
+
+        new_state = self._load(self._engine, version)
+        # swapping in the whole dictionary at once means a request never sees half of an old snapshot and half of a new one
+        self._state = new_state
+        self.refreshes += 1
+        return True
+
+    def rows(self, conn, sitename = None, firstbmp = None, lastbmp = None, bmptype = None):
+        # The snapshot rows for a site (optionally narrowed down to a firstbmp and lastbmp) or for a bmptype - still with categorical columns
+        state = self.state(conn)
+        frame = state['frame']
+
+        if bmptype is not None:
+            start, stop = state['bmptype_offsets'].get(bmptype, (0, 0))
+            return frame.take(state['bmptype_order'][start:stop])
+
+        if (firstbmp is not None) and (lastbmp is not None):
+            start, stop = state['sitebmps_offsets'].get((sitename, firstbmp, lastbmp), (0, 0))
+            return frame.iloc[start:stop]
+
+        if firstbmp is not None:
+            start, stop = state['sitebmp_offsets'].get((sitename, firstbmp), (0, 0))
+            return frame.iloc[start:stop]
+
+        start, stop = state['site_offsets'].get(sitename, (0, 0))
+        rows = frame.iloc[start:stop]
+        if lastbmp is not None:
+            rows = rows[rows.lastbmp == lastbmp]
+        return rows
+
+    def raw_wq_data(self, conn, sitename = None, firstbmp = None, lastbmp = None, bmptype = None, analytes = None):
+        # Same dataframe the get_raw_wq_data query gives back (same columns, plain text columns with None for missing values)
+        rows = self.rows(conn, sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp, bmptype = bmptype)
+        if analytes is not None:
+            rows = rows[rows.analyte.isin(list(analytes))]
+
+        df = rows[SITE_COLUMNS if bmptype is None else BMPTYPE_COLUMNS].reset_index(drop = True)
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(object).where(df[col].notnull(), None)
+        return df
+
+    def analytes(self, conn, sitename = None, firstbmp = None, lastbmp = None, bmptype = None):
+        # distinct analytename / unit pairs, sorted - what /analytes gets from its DISTINCT query
+        rows = self.rows(conn, sitename = sitename, firstbmp = firstbmp, lastbmp = lastbmp, bmptype = bmptype)
+        pairs = rows[['analyte', 'unit']].astype(object).drop_duplicates()
+        pairs = pairs.where(pairs.notnull(), None).rename(columns = {'analyte': 'analytename'})
+        return pairs.sort_values('analytename', key = lambda s: s.astype(str), kind = 'stable').to_dict('records')
+
+    def stats(self):
+        state = self._state
+        if state is None:
+            return {"loaded": False, "refreshes": self.refreshes}
+        return {
+            "loaded"            : True,
+            "rows"              : len(state['frame']),
+            "bytes"             : int(state['frame'].memory_usage(deep = True).sum()),
+            "version"           : state['version'],
+            "age_s"             : round(time.time() - state['loaded_at'], 1),
+            "refreshes"         : self.refreshes,
+            "refresh_interval"  : self.refresh_interval,
+            "file"              : self.path,
+        }
+
+    def invalidate(self):
+        with self._lock:
+            self._state = None
+
+
+# One snapshot per worker process
+raw_snapshot = RawDataSnapshot()
@@ -0,0 +1,67 @@
+import os, re, time, threading, logging
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# The data version is a cheap token that changes whenever vw_mashup_index_comparison_rawdata changes
+# Anything cached in memory (the catalog, for example) compares its token against this one to know when it has gone stale
+#
+# A row count alone does not see rows that are edited in place, so the token should also carry the latest modified time of the view
+# DATA_VERSION_TIMESTAMP_COLUMN names that column (last_edited_date, for example) and the default query becomes
+#   SELECT COUNT(*) AS nrows, MAX(<column>) AS last_modified FROM vw_mashup_index_comparison_rawdata
+# If the view has no such column, set DATA_VERSION_SQL to some other query that changes when the data does
+# With neither one set, the token is only the row count - a warning is logged the first time it is used (see the README)
+DATA_VERSION_TIMESTAMP_COLUMN = os.environ.get('DATA_VERSION_TIMESTAMP_COLUMN')
+assert (DATA_VERSION_TIMESTAMP_COLUMN is None) or re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', DATA_VERSION_TIMESTAMP_COLUMN), \
+    f"DATA_VERSION_TIMESTAMP_COLUMN must be a plain column name, not {DATA_VERSION_TIMESTAMP_COLUMN}"
+
+DATA_VERSION_SQL = os.environ.get(
+    'DATA_VERSION_SQL',
+    "SELECT COUNT(*) AS nrows FROM vw_mashup_index_comparison_rawdata"
+    if DATA_VERSION_TIMESTAMP_COLUMN is None else
+    f"SELECT COUNT(*) AS nrows, MAX({DATA_VERSION_TIMESTAMP_COLUMN}) AS last_modified FROM vw_mashup_index_comparison_rawdata"
+)
+
+# True when the token can only see rows being added or removed
+DATA_VERSION_COUNT_ONLY = ('DATA_VERSION_SQL' not in os.environ) and (DATA_VERSION_TIMESTAMP_COLUMN is None)
+
+# Checking the version is a query too - so the answer is reused for this many seconds
+DATA_VERSION_CHECK_INTERVAL = float(os.environ.get('DATA_VERSION_CHECK_INTERVAL', 60))
+
+_version = None
+_checked_at = None
+_version_lock = threading.Lock()
+
+
+def get_data_version(conn, max_age = None):
+    global _version, _checked_at
+
+    max_age = DATA_VERSION_CHECK_INTERVAL if max_age is None else max_age
+
+    if (_checked_at is not None) and ((time.monotonic() - _checked_at) < max_age):
+        return _version
+
+    with _version_lock:
+        if (_checked_at is not None) and ((time.monotonic() - _checked_at) < max_age):
+            return _version
+
+        if DATA_VERSION_COUNT_ONLY and (_version is None):
+            logger.warning(
+                "The data version is only the row count of vw_mashup_index_comparison_rawdata - rows edited in place will not "
+                "refresh the cached catalog, snapshot or results until the row count changes. "
+                "Set DATA_VERSION_TIMESTAMP_COLUMN (or DATA_VERSION_SQL) - see the README"
+            )
+
+        # the token is every value in the first row of the version query, joined together
+        row = pd.read_sql(DATA_VERSION_SQL, conn).iloc[0].tolist()
+        _version = '-'.join(str(v) for v in row)
+        _checked_at = time.monotonic()
+
+    return _version
+
+
+def invalidate_data_version():
+    # forces the next get_data_version call to go back to the database
+    global _checked_at
+    with _version_lock:
+        _checked_at = None
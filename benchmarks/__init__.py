@@ -0,0 +1,2 @@
+# Benchmarks for the hot functions in api/utils - see benchmarks/run.py
+# They need numpy/pandas/ahpy/openpyxl/xlsxwriter like the app does, but no database
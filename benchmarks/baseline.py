@@ -0,0 +1,36 @@
+# Functions as they were before they were vectorized, copied unchanged from the first commit of api/utils/funcs.py
+# run.py checks the current versions against these - only on the inputs these ones already handled
+import pandas as pd
+
+
+# the (threshold unit, data unit) pairs fix_thresh_units converted - anything else came back empty
+# (units equal to each other were left alone, and the greek mu was replaced with a u first)
+FIX_THRESH_UNITS_PAIRS = {('ug/L', 'mg/L'), ('mg/L', 'ug/L')}
+
+
+def fix_thresh_units(df):
+    required_cols = ['unit', 'threshold_unit', 'threshold']
+    assert set(required_cols).issubset(set(df.columns)), f"in fix thresh units function {','.join(required_cols)} not found in columns of data frame"
+    
+    df = df.replace('μg/L','ug/L')
+    df['threshold'] = df.apply(
+        lambda row: 
+            row.threshold 
+            if row.unit == row.threshold_unit
+            else (row.threshold / 1000) if ((row.unit == 'mg/L') and (row.threshold_unit == 'ug/L'))
+            else (row.threshold * 1000) if ((row.unit == 'ug/L') and (row.threshold_unit == 'mg/L'))
+            else pd.NA
+        ,axis = 1
+    )
+    
+    df.drop('threshold_unit', axis = 'columns', inplace = True)
+    
+    return df
+
+
+def fix_thresh_units_supported(df):
+    # boolean mask of the rows of df whose unit pair the baseline fix_thresh_units knew how to convert
+    unit = df['unit'].astype(object).replace('μg/L', 'ug/L')
+    threshold_unit = df['threshold_unit'].astype(object).replace('μg/L', 'ug/L')
+    pairs = pd.Series(list(zip(threshold_unit, unit)), index = df.index)
+    return (unit == threshold_unit) | pairs.isin(FIX_THRESH_UNITS_PAIRS)
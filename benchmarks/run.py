@@ -0,0 +1,267 @@
+"""
+Timing and peak memory benchmarks for the hot functions in api/utils, on synthetic data (benchmarks/synthetic.py)
+
+    python -m benchmarks.run                                   # small scale, results printed
+    python -m benchmarks.run --scale medium --out bench.json   # save the results
+    python -m benchmarks.run --scale medium --compare bench.json --tolerance 1.25
+
+Each benchmark is run --repeat times for the timings, then once more under tracemalloc for the peak memory
+Functions that have more than one engine (wq_index numpy/pandas, AHP numpy/ahpy, the batch versions, excel styling)
+are also checked against each other - any check that fails is reported, and makes the exit code 1
+With --compare, every benchmark's median time is compared to the saved run, and anything slower than --tolerance times the old median counts as a regression
+"""
+import os, sys, json, time, argparse, platform, subprocess, tempfile, tracemalloc
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from api.utils import (
+    wq_index, fix_thresh_units, set_threshold_values, calc_ahp_weights, calc_ahp_weights_batch, calc_ranksum_weights, calc_ranksum_weights_batch,
+    mashup_index, mashup_index_batch, format_existing_excel, write_styled_excel, clear_weight_cache
+)
+from . import baseline
+from .synthetic import SCALES, make_rawdata, make_threshold_values, make_rankings
+
+# the row by row pandas engine of wq_index takes minutes on the large scale - it only gets run on (at most) this many rows
+PANDAS_ENGINE_MAX_ROWS = int(os.environ.get('BENCH_PANDAS_ENGINE_MAX_ROWS', 50000))
+
+# openpyxl is slow too, so the excel benchmarks use at most this many rows
+EXCEL_MAX_ROWS = int(os.environ.get('BENCH_EXCEL_MAX_ROWS', 20000))
+
+# number of rankings in the batch weight / mashup benchmarks
+BATCH_SIZE = int(os.environ.get('BENCH_BATCH_SIZE', 5000))
+
+
+def measure(fn, setup = None, repeat = 5):
+    # runs fn(*setup()) repeat times for the timings, then once more for the peak memory (setup is not timed)
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+
+    args = setup() if setup is not None else ()
+    tracemalloc.start()
+    try:
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "repeat"     : repeat,
+        "min_s"      : min(times),
+        "median_s"   : float(np.median(times)),
+        "mean_s"     : float(np.mean(times)),
+        "peak_mb"    : round(peak / 1024 / 1024, 3),
+    }
+
+
+def compare_values(a, b):
+    # max absolute difference between two arrays (or frames) of numbers, and whether they are identical (NaN in the same places)
+    a = np.asarray(a, dtype = float)
+    b = np.asarray(b, dtype = float)
+    if a.shape != b.shape:
+        return {"identical": False, "max_abs_diff": None, "message": f"shapes differ {a.shape} {b.shape}"}
+    same_nan = bool(np.array_equal(np.isnan(a), np.isnan(b)))
+    diff = np.abs(a - b)
+    max_abs_diff = float(np.nanmax(diff)) if np.any(~np.isnan(diff)) else 0.0
+    return {"identical": same_nan and max_abs_diff == 0, "max_abs_diff": max_abs_diff}
+
+
+def excel_values(output):
+    from openpyxl import load_workbook
+    sheet = load_workbook(output, read_only = True).worksheets[0]
+    return [tuple(row) for row in sheet.iter_rows(values_only = True)]
+
+
+def run_scale(scale, repeat = 5, only = None):
+    params = SCALES[scale]
+    rawdata = make_rawdata(**params)
+    threshold_values = make_threshold_values(params['n_analytes'])
+    constituents, rankings = make_rankings(params['n_analytes'])
+    wqdata = set_threshold_values(rawdata, threshold_values)
+    fixed = fix_thresh_units(wqdata, on_unknown = 'ignore')
+    grouping_columns = ['sitename', 'firstbmp', 'lastbmp']
+
+    rng = np.random.default_rng(1)
+    batch_rankings = np.argsort(rng.random((BATCH_SIZE, params['n_analytes'])), axis = 1).astype(float) + 1
+    batch_scores = rng.uniform(0, 10, (BATCH_SIZE, params['n_analytes']))
+
+    pandas_rows = fixed.iloc[:PANDAS_ENGINE_MAX_ROWS]
+    excel_df = rawdata.iloc[:EXCEL_MAX_ROWS]
+
+    def excel_bytes():
+        output = BytesIO()
+        with pd.ExcelWriter(output, engine = 'xlsxwriter') as writer:
+            excel_df.to_excel(writer, index = False)
+        output.seek(0)
+        return output
+
+    # the streamed excel benchmark needs a file on disk - the directory is removed when the run is over
+    with tempfile.TemporaryDirectory(prefix = 'bench_excel_') as tmpdir:
+        def excel_file():
+            path = os.path.join(tmpdir, 'bench.xlsx')
+            excel_bytes_ = excel_bytes()
+            with open(path, 'wb') as f:
+                f.write(excel_bytes_.getvalue())
+            return (path,)
+
+        def cold_ahp(solver):
+            # the weights are memoized, so the cache is cleared first to time the actual solve
+            clear_weight_cache()
+            return calc_ahp_weights(constituents, rankings, solver = solver)
+
+        # name -> (function, setup, rows it works on)
+        benchmarks = {
+            "wq_index[numpy]"                : (lambda: wq_index(fixed, grouping_columns = grouping_columns, engine = 'numpy'), None, len(fixed)),
+            "wq_index[pandas]"               : (lambda: wq_index(pandas_rows, grouping_columns = grouping_columns, engine = 'pandas'), None, len(pandas_rows)),
+            "wq_index[numpy,pandas_rows]"    : (lambda: wq_index(pandas_rows, grouping_columns = grouping_columns, engine = 'numpy'), None, len(pandas_rows)),
+            "fix_thresh_units"               : (lambda: fix_thresh_units(wqdata, on_unknown = 'ignore'), None, len(wqdata)),
+            "set_threshold_values"           : (lambda: set_threshold_values(rawdata, threshold_values), None, len(rawdata)),
+            "calc_ahp_weights[numpy]"        : (lambda: cold_ahp('numpy'), None, 1),
+            "calc_ahp_weights[ahpy]"         : (lambda: cold_ahp('ahpy'), None, 1),
+            "calc_ahp_weights_batch"         : (lambda: calc_ahp_weights_batch(batch_rankings), None, BATCH_SIZE),
+            "calc_ranksum_weights"           : (lambda: (clear_weight_cache(), calc_ranksum_weights(rankings)), None, 1),
+            "calc_ranksum_weights_batch"     : (lambda: calc_ranksum_weights_batch(batch_rankings), None, BATCH_SIZE),
+            "mashup_index"                   : (lambda: mashup_index(batch_scores[0], batch_rankings[0] / batch_rankings[0].sum()), None, 1),
+            "mashup_index_batch"             : (lambda: mashup_index_batch(batch_scores, calc_ranksum_weights_batch(batch_rankings)), None, BATCH_SIZE),
+            "format_existing_excel[memory]"  : (lambda output: format_existing_excel(output), lambda: (excel_bytes(),), len(excel_df)),
+            "format_existing_excel[stream]"  : (lambda path: format_existing_excel(path, streaming = True), excel_file, len(excel_df)),
+            "write_styled_excel"             : (lambda: write_styled_excel(excel_df), None, len(excel_df)),
+        }
+
+        results = dict()
+        for name, (fn, setup, rows) in benchmarks.items():
+            if (only is not None) and (only not in name):
+                continue
+            result = measure(fn, setup = setup, repeat = repeat)
+            result['rows'] = rows
+            results[f"{scale}/{name}"] = result
+            print(f"{scale:>7} {name:<32} median {result['median_s'] * 1000:10.3f} ms   peak {result['peak_mb']:9.3f} MB   rows {rows}")
+
+        # Equivalence of the alternative engines
+        checks = dict()
+
+        numpy_index = wq_index(pandas_rows, grouping_columns = grouping_columns, engine = 'numpy').sort_values([*grouping_columns, 'analyte']).reset_index(drop = True)
+        pandas_index = wq_index(pandas_rows, grouping_columns = grouping_columns, engine = 'pandas').sort_values([*grouping_columns, 'analyte']).reset_index(drop = True)
+        numeric = [c for c in numpy_index.columns if pd.api.types.is_numeric_dtype(numpy_index[c])]
+        checks["wq_index numpy == pandas"] = {
+            **compare_values(numpy_index[numeric], pandas_index[numeric]),
+            "same_groups": numpy_index[[*grouping_columns, 'analyte']].equals(pandas_index[[*grouping_columns, 'analyte']])
+        }
+        checks["wq_index numpy == pandas"]['ok'] = checks["wq_index numpy == pandas"]['identical'] and checks["wq_index numpy == pandas"]['same_groups']
+
+        # against the original row by row fix_thresh_units - on the unit pairs it already converted (the rest it left empty)
+        supported = wqdata[baseline.fix_thresh_units_supported(wqdata)].iloc[:PANDAS_ENGINE_MAX_ROWS]
+        checks["fix_thresh_units == baseline"] = compare_values(
+            fix_thresh_units(supported, on_unknown = 'raise').threshold, pd.to_numeric(baseline.fix_thresh_units(supported.copy()).threshold)
+        )
+        checks["fix_thresh_units == baseline"]['ok'] = checks["fix_thresh_units == baseline"]['identical'] and (len(supported) > 0)
+
+        clear_weight_cache()
+        ahp_check = compare_values(calc_ahp_weights(constituents, rankings, solver = 'numpy'), calc_ahp_weights(constituents, rankings, solver = 'ahpy'))
+        # the two solvers agree to the 3 decimal places the weights are rounded to (see calc_ahp_weights)
+        ahp_check['ok'] = (ahp_check['max_abs_diff'] is not None) and (ahp_check['max_abs_diff'] <= 0.001 + 1e-12)
+        checks["calc_ahp_weights numpy ~= ahpy (0.001)"] = ahp_check
+
+        sample = batch_rankings[:200]
+        checks["calc_ahp_weights_batch == calc_ahp_weights"] = compare_values(
+            -np.sort(-calc_ahp_weights_batch(sample), axis = 1),
+            np.array([calc_ahp_weights(constituents, r, solver = 'numpy') for r in sample])
+        )
+        checks["calc_ranksum_weights_batch == calc_ranksum_weights"] = compare_values(
+            calc_ranksum_weights_batch(sample), np.array([calc_ranksum_weights(r) for r in sample])
+        )
+        weights = calc_ranksum_weights_batch(sample)
+        checks["mashup_index_batch == mashup_index"] = compare_values(
+            mashup_index_batch(batch_scores[:200], weights), np.array([mashup_index(s, w) for s, w in zip(batch_scores[:200], weights)])
+        )
+        for name in ("calc_ahp_weights_batch == calc_ahp_weights", "calc_ranksum_weights_batch == calc_ranksum_weights", "mashup_index_batch == mashup_index"):
+            checks[name]['ok'] = checks[name]['identical']
+
+        path, = excel_file()
+        format_existing_excel(path, streaming = True)
+        in_memory = excel_values(format_existing_excel(excel_bytes()))
+        checks["excel streaming == in memory == single pass"] = {
+            "ok": in_memory == excel_values(path) == excel_values(write_styled_excel(excel_df))
+        }
+
+        for name, check in checks.items():
+            print(f"{scale:>7} check {name:<48} {'ok' if check['ok'] else 'FAILED'}   max abs diff {check.get('max_abs_diff')}")
+
+        return results, {f"{scale}/{name}": check for name, check in checks.items()}
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True, cwd = os.path.dirname(__file__)).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "timestamp"  : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "commit"     : commit or None,
+        "python"     : platform.python_version(),
+        "numpy"      : np.__version__,
+        "pandas"     : pd.__version__,
+        "platform"   : platform.platform(),
+        "cpu_count"  : os.cpu_count(),
+    }
+
+
+def compare_runs(new, old, tolerance):
+    # prints new vs old median times, returns the names of the benchmarks that got slower than tolerance allows
+    regressions = []
+    print(f"\n{'benchmark':<48} {'old ms':>10} {'new ms':>10} {'ratio':>7}")
+    for name, result in new['results'].items():
+        if name not in old.get('results', {}):
+            continue
+        old_median = old['results'][name]['median_s']
+        ratio = result['median_s'] / old_median if old_median > 0 else float('inf')
+        flag = ''
+        if ratio > tolerance:
+            regressions.append(name)
+            flag = '  <-- slower'
+        print(f"{name:<48} {old_median * 1000:10.3f} {result['median_s'] * 1000:10.3f} {ratio:7.2f}{flag}")
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', nargs = '+', default = ['small'], choices = list(SCALES.keys()))
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--only', help = 'only run the benchmarks whose name contains this')
+    parser.add_argument('--out', help = 'save the results to this JSON file')
+    parser.add_argument('--compare', help = 'JSON file of an earlier run to compare against')
+    parser.add_argument('--tolerance', type = float, default = 1.25, help = 'new median / old median above this counts as a regression')
+    args = parser.parse_args(argv)
+
+    run = {"meta": {**metadata(), "scales": args.scale, "repeat": args.repeat}, "results": dict(), "checks": dict()}
+    for scale in args.scale:
+        results, checks = run_scale(scale, repeat = args.repeat, only = args.only)
+        run['results'].update(results)
+        run['checks'].update(checks)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(run, f, indent = 2)
+        print(f"\nResults saved to {args.out}")
+
+    failed = [name for name, check in run['checks'].items() if not check['ok']]
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_runs(run, json.load(f), args.tolerance)
+
+    if failed:
+        print(f"\nFailed checks: {', '.join(failed)}")
+    if regressions:
+        print(f"\nRegressions: {', '.join(regressions)}")
+
+    return 1 if (failed or regressions) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
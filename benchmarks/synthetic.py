@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+# (analyte, unit of the data, unit the threshold is usually given in, typical EMC, typical threshold)
+# a few thresholds are deliberately given in a different unit than the data, and one unit uses the greek mu spelling,
+# so that fix_thresh_units has real conversions and aliases to deal with
+ANALYTES = [
+    ('Copper',                   'ug/L',      'ug/L',       12.0,   9.0),
+    ('Dissolved Copper',         'ug/L',      'mg/L',        6.0,   0.005),
+    ('Zinc',                     'μg/L',      'ug/L',       80.0,  120.0),
+    ('Dissolved Zinc',           'ug/L',      'ug/L',       40.0,  100.0),
+    ('Lead',                     'ug/L',      'ug/L',        5.0,    2.5),
+    ('Cadmium',                  'ug/L',      'ng/L',        0.4,  250.0),
+    ('Total Suspended Solids',   'mg/L',      'mg/L',       60.0,   30.0),
+    ('Total Phosphorus',         'mg/L',      'ug/L',        0.3,  200.0),
+    ('Total Nitrogen',           'mg/L',      'mg/L',        2.0,    1.5),
+    ('Nitrate',                  'mg/L',      'mg/L',        0.8,    1.0),
+    ('Enterococcus',             'MPN/100mL', 'MPN/100 mL', 900.0, 104.0),
+    ('E. coli',                  'MPN/100mL', 'MPN/100mL',  1500.0, 400.0),
+]
+
+BMPTYPES = ['BI', 'BS', 'DB', 'GS', 'MF', 'PP', 'RP', 'WB']
+
+SCALES = {
+    'small'  : dict(n_sites = 10,  bmps_per_site = 3, n_analytes = 8,  events = 25),
+    'medium' : dict(n_sites = 60,  bmps_per_site = 4, n_analytes = 10, events = 40),
+    'large'  : dict(n_sites = 300, bmps_per_site = 5, n_analytes = 12, events = 60),
+}
+
+
+def make_rawdata(n_sites = 10, bmps_per_site = 3, n_analytes = 8, events = 25, missing_fraction = 0.03, seed = 0):
+    """
+    Synthetic version of what get_raw_wq_data gives back for a query over every site -
+    sitename, firstbmp, lastbmp, bmptype, analyte, inflow_emc, outflow_emc, unit
+
+    Every site gets bmps_per_site BMPs (each its own firstbmp/lastbmp pair with a random bmptype),
+    and every BMP gets a random number of storm events (around the events argument) for each of the first n_analytes analytes
+    EMCs are lognormal around the analyte's typical value, and the outflow is usually (not always) lower than the inflow
+    A missing_fraction of the inflow and outflow EMCs are left empty, like the real data
+    """
+    assert 1 <= n_analytes <= len(ANALYTES), f"n_analytes must be between 1 and {len(ANALYTES)}"
+    rng = np.random.default_rng(seed)
+
+    analytes = ANALYTES[:n_analytes]
+    frames = []
+    for s in range(n_sites):
+        sitename = f"Site {s:04d}"
+        for b in range(bmps_per_site):
+            bmpname = f"{sitename} BMP {b}"
+            bmptype = BMPTYPES[rng.integers(len(BMPTYPES))]
+            for analyte, unit, _, typical, _ in analytes:
+                n = max(1, int(rng.poisson(events)))
+                inflow = rng.lognormal(np.log(typical), 0.9, n)
+                outflow = inflow * rng.lognormal(-0.4, 0.6, n)
+                frames.append(pd.DataFrame({
+                    'sitename'    : sitename,
+                    'firstbmp'    : bmpname,
+                    'lastbmp'     : bmpname,
+                    'bmptype'     : bmptype,
+                    'analyte'     : analyte,
+                    'inflow_emc'  : inflow,
+                    'outflow_emc' : outflow,
+                    'unit'        : unit,
+                }))
+
+    df = pd.concat(frames, ignore_index = True)
+    df.loc[rng.random(len(df)) < missing_fraction, 'inflow_emc'] = np.nan
+    df.loc[rng.random(len(df)) < missing_fraction, 'outflow_emc'] = np.nan
+    return df
+
+
+def make_view(rawdata):
+    # the same rows with the column names of vw_mashup_index_comparison_rawdata - for loading into a database
+    return rawdata.rename(columns = {'bmptype': 'firstbmptype', 'unit': 'inflow_emc_unit'}).assign(
+        lastbmptype = rawdata.bmptype,
+        outflow_emc_unit = rawdata.unit
+    )
+
+
+def make_threshold_values(n_analytes = 8):
+    # the threshold_values dictionary the comparison routes build from the request (analyte -> threshold_value, unit)
+    return {
+        analyte: {"threshold_value": threshold, "unit": threshold_unit}
+        for analyte, _, threshold_unit, _, threshold in ANALYTES[:n_analytes]
+    }
+
+
+def make_rankings(n_analytes = 8, seed = 0):
+    # a random priority ranking (1 = most important) of the first n_analytes analytes
+    rng = np.random.default_rng(seed)
+    return [a[0] for a in ANALYTES[:n_analytes]], (rng.permutation(n_analytes) + 1).astype(float)
@@ -0,0 +1,20 @@
+# Builds an embedded DuckDB copy of the data the app queries, so it can run without the Postgres database
+# usage: python export_duckdb.py <path.duckdb> [snapshot file]
+#   with a snapshot file (written by export_snapshot.py), nothing is read from the database
+#   otherwise the tables are copied from DB_CONNECTION_STRING
+# then run the app (or anything else that uses api.utils) with DB_CONNECTION_STRING=duckdb:///<path.duckdb>
+import os, sys
+from sqlalchemy import create_engine
+
+from api.utils import export_duckdb
+
+if __name__ == '__main__':
+    assert len(sys.argv) > 1, "Give the path of the DuckDB file to write as an argument"
+    path = sys.argv[1]
+
+    if len(sys.argv) > 2:
+        nrows = export_duckdb(path, snapshot_file = sys.argv[2])
+    else:
+        eng = create_engine(os.environ.get("DB_CONNECTION_STRING"))
+        nrows = export_duckdb(path, conn = eng)
+    print(f"Wrote {nrows} rows to {path}")
@@ -0,0 +1,15 @@
+# Writes vw_mashup_index_comparison_rawdata to the Arrow snapshot file the workers memory map
+# usage: python export_snapshot.py [path]   (path defaults to the SNAPSHOT_FILE environment variable)
+# Run it again (from cron, for example) whenever the data changes - the new file is renamed into place and the workers pick it up on their own
+import os, sys
+from sqlalchemy import create_engine
+
+from api.utils import export_snapshot
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('SNAPSHOT_FILE')
+    assert path is not None, "Give the snapshot file path as an argument, or set the SNAPSHOT_FILE environment variable"
+
+    eng = create_engine(os.environ.get("DB_CONNECTION_STRING"))
+    nrows = export_snapshot(eng, path)
+    print(f"Wrote {nrows} rows to {path}")
@@ -0,0 +1,55 @@
+import os, sys, tempfile
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+# The app reads its settings from the environment when it is imported - a small sqlite copy of the tables it queries stands in for postgres
+FIXTURE_DIR = tempfile.mkdtemp(prefix = 'ahp_ranksum_tests_')
+os.environ['DB_CONNECTION_STRING'] = f"sqlite:///{os.path.join(FIXTURE_DIR, 'fixture.db')}"
+os.environ['EXPORT_CACHE_DIR'] = os.path.join(FIXTURE_DIR, 'export_cache')
+for setting in ('USE_SNAPSHOT', 'USE_RESULT_CACHE', 'USE_EMC_INDEX', 'USE_EXPORT_CACHE'):
+    os.environ.setdefault(setting, 'false')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ANALYTE_UNITS = {'Copper': 'ug/L', 'Lead': 'ug/L', 'TSS': 'mg/L', 'Total Phosphorus': 'mg/L', 'Zinc': 'ug/L'}
+BMPTYPES = {'BMP1': 'BI', 'BMP2': 'WB'}
+
+
+def make_fixture_db(connection_string, n = 3000, seed = 0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'sitename'   : rng.choice(['Site A', 'Site B'], n),
+        'firstbmp'   : rng.choice(list(BMPTYPES.keys()), n),
+        'analyte'    : rng.choice(list(ANALYTE_UNITS.keys()), n),
+        'inflow_emc' : rng.lognormal(1, 1, n),
+        'outflow_emc': rng.lognormal(0.7, 1, n),
+    })
+    df['lastbmp'] = df.firstbmp
+    df['firstbmptype'] = df.firstbmp.map(BMPTYPES)
+    df['inflow_emc_unit'] = df.analyte.map(ANALYTE_UNITS)
+
+    eng = create_engine(connection_string)
+    df.to_sql('vw_mashup_index_comparison_rawdata', eng, if_exists = 'replace', index = False)
+    df[['sitename', 'firstbmp', 'lastbmp']].drop_duplicates().to_sql('analysis_wq', eng, if_exists = 'replace', index = False)
+    pd.DataFrame({'bmpcode': ['BI', 'WB'], 'bmpcategory': ['Bioretention', 'Wetland Basin']}).to_sql('lu_bmptype', eng, if_exists = 'replace', index = False)
+    eng.dispose()
+
+
+@pytest.fixture(scope = 'session')
+def client():
+    make_fixture_db(os.environ['DB_CONNECTION_STRING'])
+    from api import app
+    return app.test_client()
+
+
+@pytest.fixture(scope = 'session')
+def duckdb_eng():
+    # the same tables in an embedded duckdb file - for the percentile functions sqlite does not have, and the duckdb query paths
+    pytest.importorskip('duckdb_engine')
+    connection_string = f"duckdb:///{os.path.join(FIXTURE_DIR, 'fixture.duckdb')}"
+    make_fixture_db(connection_string)
+    eng = create_engine(connection_string)
+    yield eng
+    eng.dispose()
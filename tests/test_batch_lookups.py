@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from api.utils import threshvals_batch_query, threshval_query
+
+SITE = {'sitename': 'Site A', 'firstbmp': 'BMP1'}
+
+
+def single_percentileval(client, analyte, threshval, **scope):
+    return client.get('/percentileval', query_string = {**scope, 'analyte': analyte, 'threshval': threshval}).json['percentile_rank']
+
+
+@pytest.mark.parametrize('use_emc_index', [False, True])
+@pytest.mark.parametrize('scope', [SITE, {'bmptype': 'WB'}])
+def test_percentileval_batch_matches_single_route(client, monkeypatch, use_emc_index, scope):
+    monkeypatch.setattr('api.data.USE_EMC_INDEX', use_emc_index)
+    pairs = [('Copper', 1), ('TSS', 2.5), ('Zinc', 10)]
+    resp = client.post('/percentileval-batch', json = {**scope, 'analytes': [{'analytename': a, 'threshval': t} for a, t in pairs]})
+    assert resp.status_code == 200
+    for analyte, threshval in pairs:
+        assert np.isclose(resp.json['percentile_ranks'][analyte], single_percentileval(client, analyte, threshval, **scope), rtol = 1e-12)
+
+
+def test_percentileval_batch_nothing_below(client):
+    resp = client.post('/percentileval-batch', json = {**SITE, 'analytes': [{'analytename': 'Copper', 'threshval': 0}]})
+    assert resp.json['percentile_ranks'] == {'Copper': None}
+
+
+def test_threshval_batch_matches_single_route(client, monkeypatch):
+    # sqlite has no PERCENTILE_CONT - the routes answer from the EMC index here, the SQL is checked against duckdb below
+    monkeypatch.setattr('api.data.USE_EMC_INDEX', True)
+    pairs = [('Copper', 0.25), ('TSS', 0.5), ('Zinc', 0.9)]
+    resp = client.post('/threshval-batch', json = {**SITE, 'inflow_or_outflow': 'outflow', 'analytes': [{'analytename': a, 'percentile': p} for a, p in pairs]})
+    assert resp.status_code == 200
+    for analyte, percentile in pairs:
+        expected = client.get('/threshval', query_string = {**SITE, 'analyte': analyte, 'percentile': percentile, 'inflow_or_outflow': 'outflow'}).json['threshval']
+        assert resp.json['threshvals'][analyte] == expected
+
+
+def test_threshvals_batch_query_matches_single_query(duckdb_eng):
+    pairs = [('Copper', 0.25), ('TSS', 0.5), ('Zinc', 0.9)]
+    qry, params = threshvals_batch_query(duckdb_eng, pairs, 'inflow', **SITE)
+    resultdf = pd.read_sql(qry, duckdb_eng, params = params).set_index('analyte')
+    for i, (analyte, percentile) in enumerate(pairs):
+        qry, params = threshval_query(analyte, percentile, 'inflow', **SITE)
+        assert np.isclose(resultdf.at[analyte, f"threshval_{i}"], pd.read_sql(qry, duckdb_eng, params = params).threshval.iloc[0], rtol = 1e-12)
+
+
+@pytest.mark.parametrize('route, payload', [
+    ('/threshval-batch', {**SITE, 'inflow_or_outflow': 'sideways', 'analytes': [{'analytename': 'Zinc', 'percentile': 0.5}]}),
+    ('/threshval-batch', {**SITE, 'analytes': []}),
+    ('/threshval-batch', {**SITE, 'analytes': 'Zinc'}),
+    ('/threshval-batch', {**SITE, 'analytes': [{'analytename': 'Zinc'}]}),
+    ('/threshval-batch', {**SITE, 'analytes': [{'analytename': 'Zinc', 'percentile': 0.5}, {'analytename': 'Zinc', 'percentile': 0.9}]}),
+    ('/threshval-batch', {**SITE, 'analytes': [{'analytename': 'Zinc', 'percentile': 'half'}]}),
+    ('/threshval-batch', {**SITE, 'analytes': [{'analytename': 'Zinc', 'percentile': 1.5}]}),
+    ('/threshval-batch', {'sitename': 'Nowhere', 'firstbmp': 'BMP1', 'analytes': [{'analytename': 'Zinc', 'percentile': 0.5}]}),
+    ('/threshval-batch', {'sitename': 'Site A', 'analytes': [{'analytename': 'Zinc', 'percentile': 0.5}]}),
+    ('/threshval-batch', {**SITE, 'bmptype': 'WB', 'analytes': [{'analytename': 'Zinc', 'percentile': 0.5}]}),
+    ('/threshval-batch', {'bmptype': 'XX', 'analytes': [{'analytename': 'Zinc', 'percentile': 0.5}]}),
+    ('/percentileval-batch', {**SITE, 'analytes': [{'analytename': 'Mercury', 'threshval': 1}]}),
+    ('/percentileval-batch', {**SITE, 'analytes': [{'analytename': 'Zinc', 'threshval': None}]}),
+])
+def test_bad_input(client, route, payload):
+    resp = client.post(route, json = payload)
+    assert resp.status_code == 400
+    assert 'error' in resp.json
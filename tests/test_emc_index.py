@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from api.utils import EMCIndex, threshval_query, percentile_rank_query
+
+SCOPES = [
+    (('site', 'Site A', 'BMP1'), {'sitename': 'Site A', 'firstbmp': 'BMP1'}),
+    (('bmptype', 'WB'), {'bmptype': 'WB'}),
+]
+
+
+@pytest.mark.parametrize('scope, filters', SCOPES)
+@pytest.mark.parametrize('flow', ['inflow', 'outflow'])
+@pytest.mark.parametrize('percentile', [0, 0.1, 0.25, 0.5, 0.9, 1])
+def test_percentile_matches_percentile_cont(duckdb_eng, scope, filters, flow, percentile):
+    qry, params = threshval_query('Zinc', percentile, flow, **filters)
+    expected = pd.read_sql(qry, duckdb_eng, params = params).threshval.iloc[0]
+    assert np.isclose(EMCIndex().percentile(duckdb_eng, scope, 'Zinc', flow, percentile), expected, rtol = 1e-12)
+
+
+@pytest.mark.parametrize('scope, filters', SCOPES)
+@pytest.mark.parametrize('threshval', [0.5, 1, 2.7, 10, 1000])
+def test_percentile_rank_matches_cume_dist(duckdb_eng, scope, filters, threshval):
+    qry, params = percentile_rank_query('Copper', threshval, **filters)
+    expected = pd.read_sql(qry, duckdb_eng, params = params).percentile_rank.iloc[0]
+    assert np.isclose(EMCIndex().percentile_rank(duckdb_eng, scope, 'Copper', 'inflow', threshval), expected, rtol = 1e-12)
+
+
+def test_percentile_rank_below_every_value(duckdb_eng):
+    # CUME_DIST has no rows to take the max of - null, and so is the index
+    assert EMCIndex().percentile_rank(duckdb_eng, ('site', 'Site A', 'BMP1'), 'Copper', 'inflow', 0) is None
+
+
+@pytest.mark.parametrize('percentile', ['1.5', '50'])
+def test_threshval_percentile_out_of_range(client, percentile):
+    resp = client.get('/threshval', query_string = {'sitename': 'Site A', 'firstbmp': 'BMP1', 'analyte': 'Zinc', 'percentile': percentile})
+    assert resp.status_code == 400
+    assert 'between 0 and 1' in resp.json['message']
+
+
+def test_threshval_negative_percentile(client):
+    resp = client.get('/threshval', query_string = {'sitename': 'Site A', 'firstbmp': 'BMP1', 'analyte': 'Zinc', 'percentile': '-0.1'})
+    assert resp.status_code == 400
+
+
+def test_threshval_percentile_in_range(client, monkeypatch):
+    monkeypatch.setattr('api.data.USE_EMC_INDEX', True)
+    resp = client.get('/threshval', query_string = {'sitename': 'Site A', 'firstbmp': 'BMP1', 'analyte': 'Zinc', 'percentile': '1'})
+    assert resp.status_code == 200
+    assert resp.json['threshval'] is not None
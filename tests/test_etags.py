@@ -0,0 +1,60 @@
+import io, sys
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def export_cache_on(monkeypatch):
+    # (api.download is the blueprint once the package is imported - the module itself is in sys.modules)
+    monkeypatch.setattr(sys.modules['api.download'], 'USE_EXPORT_CACHE', True)
+    return sys.modules['api.download']
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'parquet', 'xlsx'])
+def test_rawdata_etag_and_304(client, export_cache_on, fmt):
+    url = f"/rawdata?sitename=Site B&format={fmt}"
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers['ETag'].strip('"')
+    body = first.get_data()
+
+    # the client's copy is current - nothing is sent back
+    not_modified = client.get(url, headers = {'If-None-Match': f'"{etag}"'})
+    assert not_modified.status_code == 304
+    assert not_modified.get_data() == b''
+
+    # served from the file the first download left in the cache - same bytes, same ETag
+    again = client.get(url)
+    assert again.status_code == 200
+    assert again.headers['ETag'].strip('"') == etag
+    assert again.get_data() == body
+
+
+def test_rawdata_etag_follows_the_data_version(client, export_cache_on, monkeypatch):
+    url = "/rawdata?sitename=Site A&format=csv"
+    etag = client.get(url).headers['ETag']
+
+    monkeypatch.setattr(export_cache_on, 'get_data_version', lambda eng: 'a-new-version')
+    changed = client.get(url, headers = {'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert len(pd.read_csv(io.StringIO(changed.get_data(as_text = True)))) > 0
+
+
+def test_rawdata_without_the_cache_has_no_etag(client):
+    resp = client.get("/rawdata?sitename=Site A&format=csv")
+    assert resp.status_code == 200
+    assert 'ETag' not in resp.headers
+
+
+def test_catalog_etag_and_304(client):
+    first = client.get('/catalog')
+    assert first.status_code == 200
+    assert set(first.json['sites']) == {'Site A', 'Site B'}
+    assert [b['bmpcode'] for b in first.json['bmptypes']] == ['BI', 'WB']
+    etag = first.headers['ETag']
+
+    assert client.get('/catalog', headers = {'If-None-Match': etag}).status_code == 304
+    assert client.get('/catalog', headers = {'If-None-Match': '"something-else"'}).status_code == 200
+    # the etag is a hash of the content - asking again gives the same one
+    assert client.get('/catalog').headers['ETag'] == etag
@@ -0,0 +1,74 @@
+import logging
+import numpy as np
+import pandas as pd
+import pytest
+
+from api.utils import fix_thresh_units
+
+
+def frame(rows):
+    return pd.DataFrame(rows, columns = ['analyte', 'unit', 'threshold_unit', 'threshold'])
+
+
+@pytest.mark.parametrize('unit, threshold_unit, threshold, expected', [
+    ('ug/L', 'ug/L', 5.0, 5.0),
+    ('mg/L', 'ug/L', 5.0, 5.0 / 1000),
+    ('ug/L', 'mg/L', 5.0, 5.0 * 1000),
+    ('ug/L', 'ng/L', 250.0, 0.25),
+    ('mg/L', 'ng/L', 3.0, 3.0 / 1000000),
+    ('ng/L', 'mg/L', 3.0, 3000000.0),
+    ('MPN/100mL', 'MPN/100mL', 104.0, 104.0),
+])
+def test_conversions(unit, threshold_unit, threshold, expected):
+    df = fix_thresh_units(frame([('X', unit, threshold_unit, threshold)]), on_unknown = 'raise')
+    assert 'threshold_unit' not in df.columns
+    # exactly the same float the old threshold / 1000 and threshold * 1000 gave
+    assert df.threshold.iloc[0] == expected
+
+
+@pytest.mark.parametrize('unit, threshold_unit', [
+    ('μg/L', 'ug/L'),         # greek mu
+    ('µg/L', 'ug/L'),         # micro sign
+    ('ug/L', 'μg/L'),
+    ('MPN/100mL', 'MPN/100 mL'),
+    ('CFU/100 mL', 'CFU/100mL'),
+])
+def test_aliases(unit, threshold_unit):
+    df = fix_thresh_units(frame([('X', unit, threshold_unit, 7.0)]), on_unknown = 'raise')
+    assert df.threshold.iloc[0] == 7.0
+
+
+def test_alias_then_conversion():
+    df = fix_thresh_units(frame([('X', 'mg/L', 'μg/L', 200.0)]), on_unknown = 'raise')
+    assert df.threshold.iloc[0] == 0.2
+    assert df.unit.iloc[0] == 'mg/L'
+
+
+def test_unknown_pair_raises():
+    with pytest.raises(ValueError, match = 'Zinc'):
+        fix_thresh_units(frame([('Copper', 'ug/L', 'ug/L', 5.0), ('Zinc', 'ug/L', 'ppm', 5.0)]), on_unknown = 'raise')
+
+
+def test_unknown_pair_warns(caplog):
+    with caplog.at_level(logging.WARNING, logger = 'api.utils.funcs'):
+        df = fix_thresh_units(frame([('Copper', 'ug/L', 'ug/L', 5.0), ('Zinc', 'ug/L', 'ppm', 5.0)]))
+    assert df.threshold.iloc[0] == 5.0
+    assert np.isnan(df.threshold.iloc[1])
+    assert any('Zinc' in record.getMessage() for record in caplog.records)
+
+
+def test_unknown_pair_ignored(caplog):
+    with caplog.at_level(logging.WARNING, logger = 'api.utils.funcs'):
+        df = fix_thresh_units(frame([('Zinc', 'ug/L', 'ppm', 5.0)]), on_unknown = 'ignore')
+    assert np.isnan(df.threshold.iloc[0])
+    assert len(caplog.records) == 0
+
+
+def test_missing_units_are_left_empty():
+    df = fix_thresh_units(frame([('Copper', None, None, 5.0), ('Lead', 'ug/L', None, 5.0)]), on_unknown = 'ignore')
+    assert df.threshold.isnull().all()
+
+
+def test_bad_on_unknown():
+    with pytest.raises(AssertionError):
+        fix_thresh_units(frame([('X', 'ug/L', 'ug/L', 1.0)]), on_unknown = 'shout')
@@ -0,0 +1,27 @@
+import sys
+import pytest
+
+INTERNAL_ROUTES = ['/internal/pool-stats', '/internal/cache-stats', '/metrics']
+
+
+@pytest.mark.parametrize('route', INTERNAL_ROUTES)
+def test_loopback_allowed(client, route):
+    assert client.get(route, environ_base = {'REMOTE_ADDR': '127.0.0.1'}).status_code == 200
+
+
+@pytest.mark.parametrize('route', INTERNAL_ROUTES)
+def test_other_addresses_forbidden(client, route):
+    assert client.get(route, environ_base = {'REMOTE_ADDR': '203.0.113.7'}).status_code == 403
+
+
+def test_token_required_when_set(client, monkeypatch):
+    # (api.internal is the blueprint once the package is imported - the module itself is in sys.modules)
+    monkeypatch.setattr(sys.modules['api.internal'], 'INTERNAL_TOKEN', 's3cret')
+    # with a token set, being on the same box is not enough
+    assert client.get('/metrics', environ_base = {'REMOTE_ADDR': '127.0.0.1'}).status_code == 403
+    assert client.get('/metrics', headers = {'Authorization': 'Bearer wrong'}).status_code == 403
+    assert client.get('/metrics', headers = {'Authorization': 'Bearer s3cret'}, environ_base = {'REMOTE_ADDR': '203.0.113.7'}).status_code == 200
+
+
+def test_data_routes_not_restricted(client):
+    assert client.get('/sitenames', environ_base = {'REMOTE_ADDR': '203.0.113.7'}).status_code == 200
@@ -0,0 +1,77 @@
+import io, json, sys
+import pytest
+from openpyxl import load_workbook
+
+ROWS = [
+    {'analytename': 'Copper', 'individual_score': 2.5, 'rank': 1},
+    {'analytename': 'Zinc', 'individual_score': 7.25, 'rank': 2},
+    {'analytename': 'TSS', 'individual_score': None, 'rank': 3},
+]
+COLUMNAR = {
+    'columns': ['analytename', 'individual_score', 'rank'],
+    'data': {
+        'analytename': ['Copper', 'Zinc', 'TSS'],
+        'individual_score': [2.5, 7.25, None],
+        'rank': [1, 2, 3],
+    }
+}
+
+
+def workbook_values(resp):
+    sheet = load_workbook(io.BytesIO(resp.get_data()), read_only = True).worksheets[0]
+    return [tuple(row) for row in sheet.iter_rows(values_only = True)]
+
+
+def test_columnar_payload_gives_the_same_workbook(client):
+    records = client.post('/json-to-excel', json = ROWS)
+    columnar = client.post('/json-to-excel', json = COLUMNAR)
+    assert records.status_code == 200
+    assert columnar.status_code == 200
+    assert workbook_values(columnar) == workbook_values(records)
+    assert workbook_values(columnar)[0] == ('analytename', 'individual_score', 'rank')
+    assert len(workbook_values(columnar)) == 4
+
+
+def test_columnar_column_order(client):
+    # the columns list sets the order, whatever order the data object has
+    payload = {'columns': ['rank', 'analytename'], 'data': {'analytename': ['Copper'], 'rank': [1], 'ignored': [0]}}
+    assert workbook_values(client.post('/json-to-excel', json = payload)) == [('rank', 'analytename'), (1, 'Copper')]
+
+
+@pytest.mark.parametrize('payload', [
+    {'columns': ['a', 'b'], 'data': {'a': [1, 2], 'b': [1]}},
+    {'columns': ['a', 'b'], 'data': {'a': [1]}},
+    {'columns': 'a', 'data': {'a': [1]}},
+])
+def test_bad_columnar_payload(client, payload):
+    resp = client.post('/json-to-excel', json = payload)
+    assert resp.status_code == 400
+    assert resp.json['error'] == 'Invalid data'
+
+
+def test_invalid_json(client):
+    resp = client.post('/json-to-excel', data = b'{"not json', content_type = 'application/json')
+    assert resp.status_code == 400
+
+
+def test_too_large(client, monkeypatch):
+    # (api.download is the blueprint once the package is imported - the module itself is in sys.modules)
+    monkeypatch.setattr(sys.modules['api.download'], 'JSON_TO_EXCEL_MAX_BYTES', 100)
+    body = json.dumps(ROWS * 10).encode('utf-8')
+    resp = client.post('/json-to-excel', data = body, content_type = 'application/json')
+    assert resp.status_code == 413
+    assert resp.json['error'] == 'Request too large'
+
+    # under the limit still goes through
+    assert client.post('/json-to-excel', json = ROWS[:1]).status_code == 200
+
+
+def test_too_large_without_content_length(client, monkeypatch):
+    # a chunked body has no content length - the read itself is capped
+    # (werkzeug only reads a body like that when the server says it has ended it - wsgi.input_terminated)
+    monkeypatch.setattr(sys.modules['api.download'], 'JSON_TO_EXCEL_MAX_BYTES', 100)
+    body = json.dumps(ROWS * 10).encode('utf-8')
+    resp = client.post('/json-to-excel', input_stream = io.BytesIO(body), content_type = 'application/json', headers = {'Transfer-Encoding': 'chunked'},
+        environ_overrides = {'wsgi.input_terminated': True})
+    assert resp.status_code == 413
+    assert 'over the limit' in resp.json['message']
@@ -0,0 +1,27 @@
+from api.utils import stage_duration
+
+from test_rank_sensitivity import ANALYTES
+
+
+def stage_count(route, stage):
+    return stage_duration._series.get((route, stage), {}).get('count', 0)
+
+
+def test_validation_timed_once_per_request(client):
+    before = stage_count('data_api.directcomparison', 'validation')
+    resp = client.post('/direct-comparison-data', json = {'sitename': 'Site A', 'firstbmp': 'BMP1', 'analytes': ANALYTES})
+    assert resp.status_code == 200
+    assert stage_count('data_api.directcomparison', 'validation') - before == 1
+
+
+def test_thresh_percentiles_query_only_built_without_the_index(client, monkeypatch):
+    def no_query(*args, **kwargs):
+        raise AssertionError("thresh_percentiles_query should not be built when the EMC index answers")
+
+    monkeypatch.setattr('api.data.USE_EMC_INDEX', True)
+    monkeypatch.setattr('api.data.thresh_percentiles_query', no_query)
+    resp = client.post('/thresh-comparison-data', json = {
+        'sitename': 'Site A', 'firstbmp': 'BMP1', 'analytes': [{k: v for k, v in a.items() if k != 'threshold_value'} for a in ANALYTES],
+        'thresholds': [{'percentile': 0.5, 'plotcolor': '#FF0000'}]
+    })
+    assert resp.status_code == 200
@@ -0,0 +1,130 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, select
+
+from api.utils import (
+    in_list, rawdata_view, sitenames_query, bmpnames_query, bmptypes_query, analytes_query, build_raw_wq_query,
+    threshval_query, percentile_rank_query, threshvals_batch_query, percentile_ranks_batch_query, thresh_percentiles_query,
+    emc_values_query, catalog_query, export_duckdb
+)
+
+
+@pytest.fixture(scope = 'module')
+def sqlite_eng(client):
+    # the client fixture has already written the sqlite tables
+    eng = create_engine(os.environ['DB_CONNECTION_STRING'])
+    yield eng
+    eng.dispose()
+
+
+@pytest.fixture(scope = 'module')
+def rawdata(sqlite_eng):
+    return pd.read_sql('SELECT * FROM vw_mashup_index_comparison_rawdata', sqlite_eng)
+
+
+def run(builder, eng, *args, sort = None, **kwargs):
+    qry, params = builder(*args, **kwargs)
+    df = pd.read_sql(qry, eng, params = params)
+    return df.sort_values(sort or list(df.columns)).reset_index(drop = True)
+
+
+def test_in_list_is_one_array_parameter_on_duckdb(duckdb_eng, sqlite_eng):
+    # = ANY(:analytes) on duckdb (one parameter, whatever the number of values), an expanding IN list on sqlite
+    v = rawdata_view.c
+    duckdb_sql = str(select(v.analyte).where(in_list(duckdb_eng, v.analyte, 'analytes')).compile(dialect = duckdb_eng.dialect))
+    sqlite_sql = str(select(v.analyte).where(in_list(sqlite_eng, v.analyte, 'analytes')).compile(dialect = sqlite_eng.dialect))
+    assert 'ANY' in duckdb_sql.upper()
+    assert ' IN ' in sqlite_sql.upper()
+
+    for eng in (duckdb_eng, sqlite_eng):
+        qry = select(v.analyte).distinct().where(in_list(eng, v.analyte, 'analytes'))
+        assert set(pd.read_sql(qry, eng, params = {'analytes': ['Zinc', 'TSS', 'Mercury']}).analyte) == {'Zinc', 'TSS'}
+        assert len(pd.read_sql(qry, eng, params = {'analytes': ['Zinc']})) == 1
+
+
+@pytest.mark.parametrize('builder, kwargs', [
+    (sitenames_query, {}),
+    (bmpnames_query, {}),
+    (bmpnames_query, {'bmpplacement': 'last', 'sitename': 'Site A'}),
+    (bmptypes_query, {}),
+    (analytes_query, {'sitename': 'Site A', 'firstbmp': 'BMP1', 'lastbmp': 'BMP1'}),
+    (analytes_query, {'bmptype': 'WB'}),
+    (emc_values_query, {'analyte': 'Zinc', 'sitename': 'Site B', 'firstbmp': 'BMP2'}),
+    (emc_values_query, {'analyte': 'Zinc', 'bmptype': 'BI'}),
+    (catalog_query, {}),
+])
+def test_builders_agree_on_duckdb_and_sqlite(duckdb_eng, sqlite_eng, builder, kwargs):
+    pd.testing.assert_frame_equal(run(builder, duckdb_eng, **kwargs), run(builder, sqlite_eng, **kwargs), check_dtype = False)
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'sitename': 'Site A'},
+    {'sitename': 'Site A', 'firstbmp': 'BMP2', 'lastbmp': 'BMP2'},
+    {'sitename': 'Site B', 'firstbmp': 'BMP1', 'analytes': ['Copper', 'Lead']},
+    {'bmptype': 'WB'},
+    {'bmptype': 'BI', 'analytes': ['TSS']},
+])
+def test_raw_wq_query(duckdb_eng, sqlite_eng, rawdata, kwargs):
+    duckdb_df = run(lambda **kw: build_raw_wq_query(duckdb_eng, **kw), duckdb_eng, **kwargs)
+    pd.testing.assert_frame_equal(duckdb_df, run(lambda **kw: build_raw_wq_query(sqlite_eng, **kw), sqlite_eng, **kwargs), check_dtype = False)
+
+    # the same rows as filtering the table in pandas
+    expected = rawdata
+    if 'bmptype' in kwargs:
+        expected = expected[expected.firstbmptype == kwargs['bmptype']]
+    else:
+        expected = expected[expected.sitename == kwargs['sitename']]
+        if 'firstbmp' in kwargs:
+            expected = expected[expected.firstbmp == kwargs['firstbmp']]
+    if 'analytes' in kwargs:
+        expected = expected[expected.analyte.isin(kwargs['analytes'])]
+    assert len(duckdb_df) == len(expected)
+    assert np.isclose(duckdb_df.inflow_emc.sum(), expected.inflow_emc.sum())
+
+
+def test_percentile_queries(duckdb_eng, rawdata):
+    # PERCENTILE_CONT is the linear interpolation numpy.quantile does by default
+    rows = rawdata[(rawdata.analyte == 'Lead') & (rawdata.sitename == 'Site A') & (rawdata.firstbmp == 'BMP1')]
+    for percentile in (0, 0.3, 0.5, 1):
+        threshval = run(threshval_query, duckdb_eng, 'Lead', percentile, 'outflow', sitename = 'Site A', firstbmp = 'BMP1').threshval.iloc[0]
+        assert np.isclose(threshval, np.quantile(rows.outflow_emc, percentile), rtol = 1e-12)
+
+    rank = run(percentile_rank_query, duckdb_eng, 'Lead', 3, sitename = 'Site A', firstbmp = 'BMP1').percentile_rank.iloc[0]
+    assert np.isclose(rank, (rows.inflow_emc <= 3).mean(), rtol = 1e-12)
+
+    everything = rawdata[rawdata.analyte.isin(['Lead', 'Zinc'])]
+    thresh = run(lambda: thresh_percentiles_query(duckdb_eng, ['Lead', 'Zinc'], [0.25, 0.75]), duckdb_eng).set_index('analyte')
+    assert list(thresh.columns) == ['thresh_25', 'thresh_75']
+    for analyte in ('Lead', 'Zinc'):
+        assert np.isclose(thresh.at[analyte, 'thresh_75'], np.quantile(everything[everything.analyte == analyte].inflow_emc, 0.75), rtol = 1e-12)
+
+
+def test_batch_queries(duckdb_eng, sqlite_eng, rawdata):
+    pairs = [('Copper', 2.0), ('Zinc', 5.0)]
+    counts = {
+        name: run(lambda: percentile_ranks_batch_query(eng, pairs, 'inflow', bmptype = 'BI'), eng).set_index('analyte')
+        for name, eng in (('duckdb', duckdb_eng), ('sqlite', sqlite_eng))
+    }
+    pd.testing.assert_frame_equal(counts['duckdb'], counts['sqlite'], check_dtype = False)
+
+    rows = rawdata[rawdata.firstbmptype == 'BI']
+    for i, (analyte, threshval) in enumerate(pairs):
+        assert counts['duckdb'].at[analyte, 'n_total'] == (rows.analyte == analyte).sum()
+        assert counts['duckdb'].at[analyte, f"n_below_{i}"] == ((rows.analyte == analyte) & (rows.inflow_emc <= threshval)).sum()
+
+    threshvals = run(lambda: threshvals_batch_query(duckdb_eng, [('Copper', 0.5), ('Zinc', 0.1)], 'inflow', bmptype = 'BI'), duckdb_eng).set_index('analyte')
+    assert np.isclose(threshvals.at['Zinc', 'threshval_1'], np.quantile(rows[rows.analyte == 'Zinc'].inflow_emc, 0.1), rtol = 1e-12)
+
+
+def test_export_duckdb(sqlite_eng, rawdata, tmp_path):
+    path = str(tmp_path / 'exported.duckdb')
+    assert export_duckdb(path, conn = sqlite_eng) == len(rawdata)
+
+    eng = create_engine(f"duckdb:///{path}", connect_args = {'read_only': True})
+    try:
+        pd.testing.assert_frame_equal(run(catalog_query, eng), run(catalog_query, sqlite_eng), check_dtype = False)
+        pd.testing.assert_frame_equal(run(bmptypes_query, eng), run(bmptypes_query, sqlite_eng), check_dtype = False)
+    finally:
+        eng.dispose()
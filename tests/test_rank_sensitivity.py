@@ -0,0 +1,62 @@
+import numpy as np
+
+# ranks deliberately out of the (alphabetical) order wq_index gives the analytes back in
+ANALYTES = [
+    {'analytename': 'Copper', 'threshold_value': 5, 'unit': 'ug/L', 'rank': 3},
+    {'analytename': 'TSS', 'threshold_value': 3, 'unit': 'mg/L', 'rank': 1},
+    {'analytename': 'Zinc', 'threshold_value': 4, 'unit': 'ug/L', 'rank': 2},
+]
+
+
+def test_user_scores_match_direct_comparison(client):
+    payload = {'sitename': 'Site A', 'firstbmp': 'BMP1', 'analytes': ANALYTES}
+    direct = client.post('/direct-comparison-data', json = payload)
+    sweep = client.post('/rank-sensitivity-data', json = payload)
+    assert direct.status_code == 200
+    assert sweep.status_code == 200
+
+    assert sweep.json['user_ahp_mashup_score'] == direct.json['ahp_mashup_score']
+    assert sweep.json['user_ranksum_mashup_score'] == direct.json['ranksum_mashup_score']
+
+
+def test_direct_comparison_weights_follow_the_ranks(client):
+    # each analyte gets the weight of its own rank - 1 / rank, normalized
+    resp = client.post('/direct-comparison-data', json = {'sitename': 'Site A', 'firstbmp': 'BMP1', 'analytes': ANALYTES})
+    inverse = {a['analytename']: 1 / a['rank'] for a in ANALYTES}
+    total = sum(inverse.values())
+
+    analytes = resp.json['analytes']
+    for a in analytes:
+        assert a['ahp_weight'] == round(inverse[a['analytename']] / total, 3)
+
+    expected = sum(a['individual_score'] * a['ahp_weight'] for a in analytes)
+    assert np.isclose(resp.json['ahp_mashup_score'], expected, atol = 0.01)
+
+
+def test_bmptype_sweep(client):
+    resp = client.post('/rank-sensitivity-data', json = {'bmptype': 'WB', 'analytes': ANALYTES})
+    assert resp.status_code == 200
+    assert resp.json['bmptype'] == 'WB'
+    assert resp.json['analytenames'] == ['Copper', 'TSS', 'Zinc']
+    assert resp.json['n_rankings'] == 6
+    assert resp.json['ahp_mashup_score']['min'] <= resp.json['user_ahp_mashup_score'] <= resp.json['ahp_mashup_score']['max']
+
+
+def test_bmptype_comparison_routes(client, monkeypatch):
+    # the comparison routes group a bmptype request on bmptype too, and give the user score the sweep gives
+    payload = {'bmptype': 'WB', 'analytes': ANALYTES}
+    direct = client.post('/direct-comparison-data', json = payload)
+    sweep = client.post('/rank-sensitivity-data', json = payload)
+    assert direct.status_code == 200
+    assert sweep.json['user_ahp_mashup_score'] == direct.json['ahp_mashup_score']
+    assert sweep.json['user_ranksum_mashup_score'] == direct.json['ranksum_mashup_score']
+
+    # sqlite has no PERCENTILE_CONT - the thresholds come from the in memory EMC index instead
+    monkeypatch.setattr('api.data.USE_EMC_INDEX', True)
+    thresh = client.post('/thresh-comparison-data', json = {
+        'bmptype': 'WB', 'analytes': [{k: v for k, v in a.items() if k != 'threshold_value'} for a in ANALYTES],
+        'thresholds': [{'percentile': 0.5, 'plotcolor': '#FF0000'}]
+    })
+    assert thresh.status_code == 200
+    assert len(thresh.json) == 1
+    assert thresh.json[0]['n_params'] == 3
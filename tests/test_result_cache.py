@@ -0,0 +1,73 @@
+import sys
+import pytest
+
+from api.utils import result_cache
+
+from test_rank_sensitivity import ANALYTES
+
+PAYLOAD = {'sitename': 'Site A', 'firstbmp': 'BMP1', 'analytes': ANALYTES}
+
+
+@pytest.fixture
+def cache_on(monkeypatch):
+    # the data version is pinned, so the test decides when the data "changes"
+    module = sys.modules['api.utils.resultcache']
+    version = {'current': 'v1'}
+    monkeypatch.setattr(module, 'USE_RESULT_CACHE', True)
+    monkeypatch.setattr(module, 'get_data_version', lambda conn: version['current'])
+    result_cache.invalidate()
+    yield version
+    result_cache.invalidate()
+
+
+@pytest.fixture
+def no_data_access(monkeypatch):
+    # once this is on, the route itself fails - only a stored response can answer
+    def fail(*args, **kwargs):
+        raise AssertionError("the route ran - the response should have come from the result cache")
+    return lambda: monkeypatch.setattr('api.data.get_raw_wq_data', fail)
+
+
+def test_identical_request_is_a_hit(client, cache_on, no_data_access):
+    first = client.post('/direct-comparison-data', json = PAYLOAD)
+    assert first.status_code == 200
+    hits = result_cache.hits
+
+    no_data_access()
+    # the same payload with its keys in another order is the same request
+    second = client.post('/direct-comparison-data', json = dict(reversed(list(PAYLOAD.items()))))
+    assert second.status_code == 200
+    assert second.get_data() == first.get_data()
+    assert result_cache.hits == hits + 1
+
+
+def test_new_data_version_is_a_miss(client, cache_on, monkeypatch):
+    first = client.post('/direct-comparison-data', json = PAYLOAD)
+    misses = result_cache.misses
+
+    cache_on['current'] = 'v2'
+    calls = []
+    real = sys.modules['api.data'].get_raw_wq_data
+    monkeypatch.setattr('api.data.get_raw_wq_data', lambda *args, **kwargs: calls.append(1) or real(*args, **kwargs))
+
+    second = client.post('/direct-comparison-data', json = PAYLOAD)
+    assert second.status_code == 200
+    assert len(calls) == 1
+    assert result_cache.misses == misses + 1
+    # the data did not really change, so neither does the answer
+    assert second.json == first.json
+
+
+def test_errors_are_not_stored(client, cache_on):
+    bad = {'sitename': 'Nowhere', 'firstbmp': 'BMP1', 'analytes': ANALYTES}
+    assert client.post('/direct-comparison-data', json = bad).status_code == 400
+    assert client.post('/direct-comparison-data', json = bad).status_code == 400
+    assert result_cache.stats()['entries'] == 0
+
+
+def test_cache_off_always_runs_the_route(client, no_data_access):
+    # USE_RESULT_CACHE is off in the test settings
+    assert client.post('/direct-comparison-data', json = PAYLOAD).status_code == 200
+    no_data_access()
+    with pytest.raises(AssertionError):
+        client.post('/direct-comparison-data', json = PAYLOAD)
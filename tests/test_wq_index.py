@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from api.utils import wq_index
+
+
+def make_wqdata(n = 2000, seed = 0):
+    # ratios on both sides of 1, exact ties with the threshold, and a few missing EMCs - every branch of the categorization
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'sitename'    : rng.choice(['Site A', 'Site B'], n),
+        'firstbmp'    : rng.choice(['BMP1', 'BMP2'], n),
+        'analyte'     : rng.choice(['Copper', 'Lead', 'TSS', 'Zinc'], n),
+        'inflow_emc'  : rng.choice([0.5, 1, 2, 4, 8], n) * rng.choice([1, 1, 1.1], n),
+        'outflow_emc' : rng.choice([0.25, 1, 2, 4, 8], n) * rng.choice([1, 1, 0.9], n),
+        'threshold'   : 2.0,
+    })
+    df['lastbmp'] = df.firstbmp
+    df['bmptype'] = df.firstbmp.map({'BMP1': 'BI', 'BMP2': 'WB'})
+    df.loc[rng.random(n) < 0.05, 'inflow_emc'] = np.nan
+    df.loc[rng.random(n) < 0.05, 'outflow_emc'] = np.nan
+    # a second, lower threshold inside one group - wq_index takes the lowest
+    df.loc[(df.analyte == 'Zinc') & (df.sitename == 'Site A'), 'threshold'] = rng.choice([2.0, 1.0], ((df.analyte == 'Zinc') & (df.sitename == 'Site A')).sum())
+    return df
+
+
+@pytest.mark.parametrize('grouping_columns', [['sitename', 'firstbmp', 'lastbmp'], ['bmptype']])
+def test_numpy_engine_matches_pandas_engine(grouping_columns):
+    df = make_wqdata()
+    keys = [*grouping_columns, 'analyte']
+    numpy_index = wq_index(df, grouping_columns = grouping_columns, engine = 'numpy').sort_values(keys).reset_index(drop = True)
+    pandas_index = wq_index(df, grouping_columns = grouping_columns, engine = 'pandas').sort_values(keys).reset_index(drop = True)
+
+    pd.testing.assert_frame_equal(numpy_index[keys], pandas_index[keys])
+    np.testing.assert_array_equal(numpy_index.number_of_events.to_numpy(dtype = float), pandas_index.number_of_events.to_numpy(dtype = float))
+    np.testing.assert_array_equal(numpy_index.performance_index.to_numpy(dtype = float), pandas_index.performance_index.to_numpy(dtype = float))
+
+
+def test_custom_category_scores():
+    df = make_wqdata(n = 500, seed = 1)
+    scores = {"Success": 1, "Excess": 2, "Marginal": 5, "Insufficient": 7, "Failure": 20}
+    numpy_index = wq_index(df, grouping_columns = ['sitename'], category_score_values = scores, engine = 'numpy')
+    pandas_index = wq_index(df, grouping_columns = ['sitename'], category_score_values = scores, engine = 'pandas')
+    np.testing.assert_array_equal(numpy_index.performance_index.to_numpy(dtype = float), pandas_index.performance_index.to_numpy(dtype = float))
+
+
+def test_unknown_engine():
+    with pytest.raises(AssertionError):
+        wq_index(make_wqdata(n = 10), grouping_columns = ['sitename'], engine = 'polars')